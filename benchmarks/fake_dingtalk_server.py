@@ -0,0 +1,280 @@
+"""
+A stand-in for DingTalk: it signs the message callbacks like DingTalk does, and serves the APIs used by the robot
+(session webhooks, gettoken, messageFiles/download). Run main.py with DINGTALK_SERVER_BASE_URL pointing here.
+Messages can also be pushed through Stream mode connections (DINGTALK_STREAM_ENABLE=true).
+
+    python benchmarks/fake_dingtalk_server.py 18100
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import struct
+import sys
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+
+def _tiny_png() -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff")) + chunk(b"IEND", b""))
+
+
+class Session:
+    """
+    The answer to one message, as received by its session webhook.
+    """
+
+    def __init__(self):
+        self.sent_at = time.perf_counter()  # when the callback was sent
+        self.first_reply_at: float = None
+        self.final_at: float = None
+        self.replies = []
+        self.failed = False
+        self.done = asyncio.Event()
+
+    def receive(self, data: dict) -> None:
+        now = time.perf_counter()
+        if self.first_reply_at is None:
+            self.first_reply_at = now
+        self.replies.append(data)
+        # Answers are text ending with the usage footer, errors are markdown.
+        if data.get("msgtype") == "markdown":
+            self.failed = True
+        elif "▦" not in data.get("text", {}).get("content", ""):
+            return
+        if self.final_at is None:
+            self.final_at = now
+            self.done.set()
+
+    def receive_card(self, content: str, finalize: bool, error: bool) -> None:
+        now = time.perf_counter()
+        if self.first_reply_at is None and len(content) > 0:
+            self.first_reply_at = now
+        self.replies.append(content)
+        if error:
+            self.failed = True
+        if (finalize or error) and self.final_at is None:
+            self.final_at = now
+            self.done.set()
+
+
+class FakeDingtalk:
+    BOT_MESSAGE_TOPIC = "/v1.0/im/bot/messages/get"
+
+    def __init__(self, app_key: str = "fake-app-key", app_secret: str = "fake-app-secret", send_latency: float = 0.0,
+                 ping_interval: float = 5.0):
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.send_latency = send_latency
+        self.ping_interval = ping_interval
+        self.base_url: str = None  # set once started
+        self.sessions: dict[str, Session] = {}
+        self.webhook_posts = 0
+        self.downloads = 0
+        self._last_timestamp = 0
+        self.user_sessions: dict[str, Session] = {}  # latest session of each user, for the cards sent to them
+        self.cards: dict[str, Session] = {}
+        self.card_updates = 0
+
+        # Stream mode
+        self.tickets = set()
+        self.stream_connections: list[web.WebSocketResponse] = []
+        self.stream_connections_opened = 0
+        self.stream_connected = asyncio.Event()
+        self.pongs = 0
+        self._acks: dict[str, asyncio.Future] = {}
+        self._round_robin = itertools.count()
+
+    def sign(self) -> dict:
+        """
+        Headers of a callback, signed like DingTalk does.
+        Two callbacks never share a timestamp, as the same signature would be rejected as a replay.
+        """
+        self._last_timestamp = max(int(time.time() * 1000), self._last_timestamp + 1)
+        timestamp = str(self._last_timestamp)
+        signed = hmac.new(self.app_secret.encode(), (timestamp + "\n" + self.app_secret).encode(),
+                          hashlib.sha256).digest()
+        return {"timestamp": timestamp, "sign": base64.b64encode(signed).decode()}
+
+    def new_message(self, text: str, user: str, picture: bool = False) -> dict:
+        """
+        A callback message from `user`, each one with its own session to follow its answer.
+        """
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = Session()
+        self.user_sessions["staff-" + user] = self.sessions[session_id]
+        message = {
+            "conversationType": "1",
+            "conversationId": "cid-" + user,
+            "msgId": "msg-" + session_id,
+            "senderNick": user,
+            "senderStaffId": "staff-" + user,
+            "robotCode": self.app_key,
+            "sessionWebhook": "%s/robot/sendBySession?session=%s" % (self.base_url, session_id),
+            "sessionWebhookExpiredTime": int(time.time() * 1000) + 3600 * 1000,
+            "msgtype": "text",
+            "text": {"content": text}
+        }
+        if picture:
+            message["msgtype"] = "picture"
+            message["content"] = {"downloadCode": session_id}
+            del message["text"]
+        return message
+
+    def session_of(self, message: dict) -> Session:
+        return self.sessions[message["sessionWebhook"].rsplit("=", 1)[1]]
+
+    async def _send_by_session(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+        self.webhook_posts += 1
+        session = self.sessions.get(request.query.get("session"))
+        if session is None:
+            return web.json_response({"errcode": 300001, "errmsg": "session expired"})
+        session.receive(data)
+        return web.json_response({"errcode": 0, "errmsg": "ok"})
+
+    async def _get_token(self, request: web.Request) -> web.Response:
+        if request.query.get("appkey") != self.app_key or request.query.get("appsecret") != self.app_secret:
+            return web.json_response({"errcode": 40089, "errmsg": "invalid appkey or appsecret"})
+        return web.json_response({"errcode": 0, "errmsg": "ok", "access_token": "fake-access-token",
+                                  "expires_in": 7200})
+
+    async def _download(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return web.json_response({"downloadUrl": "%s/files/%s.png" % (self.base_url, data["downloadCode"])})
+
+    async def _file(self, request: web.Request) -> web.Response:
+        self.downloads += 1
+        return web.Response(body=_tiny_png(), content_type="image/png")
+
+    async def _create_card(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+        session = self.user_sessions.get(data["openSpaceId"].rsplit(".", 1)[1])
+        if session is None:
+            return web.json_response({"code": "param.invalid", "message": "unknown open space"}, status=400)
+        self.cards[data["outTrackId"]] = session
+        return web.json_response({"success": True, "result": {"outTrackId": data["outTrackId"]}})
+
+    async def _stream_card(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+        self.card_updates += 1
+        session = self.cards.get(data["outTrackId"])
+        if session is None:
+            return web.json_response({"code": "param.invalid", "message": "unknown card"}, status=400)
+        session.receive_card(data["content"], data["isFinalize"], data["isError"])
+        return web.json_response({"success": True})
+
+    async def _batch_send(self, request: web.Request) -> web.Response:
+        return web.json_response({"processQueryKey": uuid.uuid4().hex})
+
+    async def _open_connection(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if data.get("clientId") != self.app_key or data.get("clientSecret") != self.app_secret:
+            return web.json_response({"code": "InvalidAuthentication", "message": "invalid client"}, status=401)
+        ticket = uuid.uuid4().hex
+        self.tickets.add(ticket)
+        return web.json_response({"endpoint": self.base_url.replace("http", "ws", 1) + "/connect", "ticket": ticket})
+
+    async def _connect(self, request: web.Request) -> web.WebSocketResponse:
+        if request.query.get("ticket") not in self.tickets:
+            raise web.HTTPUnauthorized()
+        self.tickets.discard(request.query["ticket"])
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.stream_connections.append(websocket)
+        self.stream_connections_opened += 1
+        self.stream_connected.set()
+        pinging = asyncio.create_task(self._ping(websocket))
+        try:
+            async for frame in websocket:
+                ack = json.loads(frame.data)
+                message_id = ack["headers"]["messageId"]
+                if message_id in self._acks:
+                    self._acks.pop(message_id).set_result(ack)
+                else:
+                    self.pongs += 1
+        finally:
+            pinging.cancel()
+            self.stream_connections.remove(websocket)
+            if len(self.stream_connections) == 0:
+                self.stream_connected.clear()
+        return websocket
+
+    @staticmethod
+    def _frame(kind: str, topic: str, data: str) -> str:
+        return json.dumps({"specVersion": "1.0", "type": kind, "data": data,
+                           "headers": {"contentType": "application/json", "messageId": uuid.uuid4().hex,
+                                       "time": str(int(time.time() * 1000)), "topic": topic}})
+
+    async def _ping(self, websocket: web.WebSocketResponse) -> None:
+        while not websocket.closed:
+            await asyncio.sleep(self.ping_interval)
+            await websocket.send_str(self._frame("SYSTEM", "ping", json.dumps({"opaque": uuid.uuid4().hex})))
+
+    async def push(self, message: dict, timeout: float = 30.0) -> dict:
+        """
+        Deliver a message through a Stream mode connection (in turn when there are several).
+        :return: its acknowledgement
+        """
+        await asyncio.wait_for(self.stream_connected.wait(), timeout)
+        websocket = self.stream_connections[next(self._round_robin) % len(self.stream_connections)]
+        frame = self._frame("CALLBACK", self.BOT_MESSAGE_TOPIC, json.dumps(message))
+        ack = asyncio.get_running_loop().create_future()
+        self._acks[json.loads(frame)["headers"]["messageId"]] = ack
+        await websocket.send_str(frame)
+        return await asyncio.wait_for(ack, timeout)
+
+    async def disconnect(self) -> None:
+        """
+        Ask the Stream mode connections to reconnect, and close them.
+        """
+        for websocket in list(self.stream_connections):
+            await websocket.send_str(self._frame("SYSTEM", "disconnect", json.dumps({"reason": "upgrading"})))
+            await websocket.close()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/robot/sendBySession", self._send_by_session)
+        app.router.add_get("/gettoken", self._get_token)
+        app.router.add_post("/v1.0/robot/messageFiles/download", self._download)
+        app.router.add_get("/files/{name}", self._file)
+        app.router.add_post("/v1.0/robot/oToMessages/batchSend", self._batch_send)
+        app.router.add_post("/v1.0/gateway/connections/open", self._open_connection)
+        app.router.add_post("/v1.0/card/instances/createAndDeliver", self._create_card)
+        app.router.add_put("/v1.0/card/streaming", self._stream_card)
+        app.router.add_get("/connect", self._connect)
+        return app
+
+    async def start(self, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        self.base_url = "http://127.0.0.1:%d" % port
+        return runner
+
+
+async def main(port: int):
+    fake_dingtalk = FakeDingtalk()
+    await fake_dingtalk.start(port)
+    print("Fake DingTalk listening on %s (app key: %s, app secret: %s)"
+          % (fake_dingtalk.base_url, fake_dingtalk.app_key, fake_dingtalk.app_secret))
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 18100))
@@ -0,0 +1,184 @@
+"""
+A stand-in for the chatbot servers: OpenAI chat completions, Anthropic messages and Dashscope multimodal generation,
+streaming or not, with a configurable time to first token, token rate and injected errors.
+
+    python benchmarks/fake_llm_server.py 18200 --ttft 0.5 --tokens-per-second 40 --error-rate 0.02
+
+    CHATBOT_SERVER_BASE_URL=http://127.0.0.1:18200/v1      (openai)
+    CHATBOT_SERVER_BASE_URL=http://127.0.0.1:18200         (anthropic)
+    DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:18200/api/v1  (dashscope)
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+WORDS = ["the", "robot", "answers", "quickly", "while", "streaming", "tokens", "to", "DingTalk", "users"]
+
+
+class FakeLlm:
+    def __init__(self,
+                 ttft: float = 0.3,
+                 tokens_per_second: float = 50.0,
+                 output_tokens: int = 200,
+                 error_rate: float = 0.0,
+                 error_status: int = 500,
+                 seed: int = None):
+        """
+        :param ttft: seconds before the first token
+        :param tokens_per_second: generation speed after the first token
+        :param output_tokens: tokens of each answer, in paragraphs of 30
+        :param error_rate: share of the requests failing with `error_status`
+        """
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    def _tokens(self):
+        for i in range(self.output_tokens):
+            # a new paragraph every 30 tokens, the break starting the token as most models do
+            yield ("\n\n" if i > 0 and i % 30 == 0 else " " if i > 0 else "") + WORDS[i % len(WORDS)]
+
+    def _fails(self) -> bool:
+        self.requests += 1
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def _generate(self):
+        """
+        Tokens at the configured pace.
+        """
+        await asyncio.sleep(self.ttft)
+        started_at = time.monotonic()
+        for i, token in enumerate(self._tokens()):
+            delay = started_at + i / self.tokens_per_second - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield token
+
+    async def _answer(self) -> str:
+        return "".join([token async for token in self._generate()])
+
+    @staticmethod
+    async def _event_stream(request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        return response
+
+    async def _openai(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if self._fails():
+            return web.json_response({"error": {"message": "injected error", "type": "server_error", "code": None}},
+                                     status=self.error_status)
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": await self._answer()},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 20, "completion_tokens": self.output_tokens,
+                          "total_tokens": 20 + self.output_tokens}})
+
+        def chunk(delta: dict, finish_reason: str = None) -> bytes:
+            return ("data: %s\n\n" % json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body["model"], "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            })).encode()
+
+        response = await self._event_stream(request)
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        async for token in self._generate():
+            await response.write(chunk({"content": token}))
+        await response.write(chunk({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def _anthropic(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if self._fails():
+            return web.json_response({"type": "error", "error": {"type": "api_error", "message": "injected error"}},
+                                     status=self.error_status)
+        message = {"id": "msg_" + uuid.uuid4().hex, "type": "message", "role": "assistant", "model": body["model"],
+                   "stop_sequence": None}
+        if not body.get("stream"):
+            return web.json_response(dict(message, content=[{"type": "text", "text": await self._answer()}],
+                                          stop_reason="end_turn",
+                                          usage={"input_tokens": 20, "output_tokens": self.output_tokens}))
+
+        response = await self._event_stream(request)
+
+        async def event(name: str, data: dict):
+            await response.write(("event: %s\ndata: %s\n\n" % (name, json.dumps(dict(data, type=name)))).encode())
+
+        await event("message_start", {"message": dict(message, content=[], stop_reason=None,
+                                                      usage={"input_tokens": 20, "output_tokens": 1})})
+        await event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        async for token in self._generate():
+            await event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": token}})
+        await event("content_block_stop", {"index": 0})
+        await event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": self.output_tokens}})
+        await event("message_stop", {})
+        return response
+
+    async def _dashscope(self, request: web.Request) -> web.Response:
+        await request.json()
+        request_id = uuid.uuid4().hex
+        if self._fails():
+            return web.json_response({"code": "InternalError", "message": "injected error", "request_id": request_id},
+                                     status=self.error_status)
+        return web.json_response({
+            "output": {"choices": [{"finish_reason": "stop",
+                                    "message": {"role": "assistant", "content": [{"text": await self._answer()}]}}]},
+            "usage": {"input_tokens": 20, "output_tokens": self.output_tokens},
+            "request_id": request_id})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._openai)
+        app.router.add_post("/v1/messages", self._anthropic)
+        app.router.add_post("/api/v1/services/aigc/multimodal-generation/generation", self._dashscope)
+        return app
+
+    async def start(self, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests failing")
+    parser.add_argument("--error-status", type=int, default=500)
+
+
+def from_arguments(arguments: argparse.Namespace) -> FakeLlm:
+    return FakeLlm(arguments.ttft, arguments.tokens_per_second, arguments.output_tokens, arguments.error_rate,
+                   arguments.error_status)
+
+
+async def main(arguments: argparse.Namespace):
+    await from_arguments(arguments).start(arguments.port)
+    print("Fake chatbot servers listening on http://127.0.0.1:%d" % arguments.port)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argument_parser.add_argument("port", type=int, nargs="?", default=18200)
+    add_arguments(argument_parser)
+    asyncio.run(main(argument_parser.parse_args()))
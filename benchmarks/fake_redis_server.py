@@ -0,0 +1,178 @@
+"""
+A stand-in for Redis, speaking enough of its protocol for RedisCoordination,
+to run several processes with COORDINATION_BACKEND=redis where no Redis is at hand.
+
+    python benchmarks/fake_redis_server.py 6379
+"""
+import asyncio
+import sys
+import time
+from collections import deque
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values: dict[bytes, bytes] = {}
+        self.expires: dict[bytes, float] = {}
+        self.lists: dict[bytes, deque] = {}
+        self.versions: dict[bytes, int] = {}  # for WATCH
+        self.list_pushed = asyncio.Condition()
+
+    def _alive(self, key: bytes) -> bool:
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+            self._touch(key)
+        return key in self.values
+
+    def _touch(self, key: bytes) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _set(self, key: bytes, value: bytes, ttl: float = None) -> None:
+        self.values[key] = value
+        if ttl is not None:
+            self.expires[key] = time.monotonic() + ttl
+        else:
+            self.expires.pop(key, None)
+        self._touch(key)
+
+    def execute(self, command: bytes, args: list):
+        if command == b"PING":
+            return "+PONG"
+        if command in (b"AUTH", b"SELECT"):
+            return "+OK"
+        if command == b"GET":
+            return self.values.get(args[0]) if self._alive(args[0]) else None
+        if command == b"SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            ttl = None
+            if b"EX" in options:
+                ttl = float(args[2 + options.index(b"EX") + 1])
+            elif b"PX" in options:
+                ttl = float(args[2 + options.index(b"PX") + 1]) / 1000
+            previous = self.values.get(key) if self._alive(key) else None
+            if b"NX" in options and previous is not None:
+                return None
+            self._set(key, value, ttl)
+            return previous if b"GET" in options else "+OK"
+        if command == b"EXPIRE":
+            if not self._alive(args[0]):
+                return 0
+            self.expires[args[0]] = time.monotonic() + float(args[1])
+            return 1
+        if command == b"DEL":
+            deleted = 0
+            for key in args:
+                if self._alive(key):
+                    del self.values[key]
+                    self.expires.pop(key, None)
+                    self._touch(key)
+                    deleted += 1
+            return deleted
+        if command == b"RPUSH":
+            self.lists.setdefault(args[0], deque()).extend(args[1:])
+            return len(self.lists[args[0]])
+        if command == b"LLEN":
+            return len(self.lists.get(args[0], ()))
+        raise ValueError("unknown command '%s'" % command.decode())
+
+
+async def _read_command(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:-2])
+    args = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return reply.encode() + b"\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+    raise TypeError(reply)
+
+
+def serve(redis: FakeRedis):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        watched: dict[bytes, int] = {}
+        transaction = None
+        try:
+            while True:
+                args = await _read_command(reader)
+                if args is None:
+                    break
+                command, args = args[0].upper(), args[1:]
+                if command == b"QUIT":
+                    writer.write(_encode("+OK"))
+                    await writer.drain()
+                    break
+                try:
+                    if command == b"WATCH":
+                        for key in args:
+                            watched[key] = redis.versions.get(key, 0)
+                        reply = "+OK"
+                    elif command == b"UNWATCH":
+                        watched.clear()
+                        reply = "+OK"
+                    elif command == b"MULTI":
+                        transaction = []
+                        reply = "+OK"
+                    elif command == b"EXEC":
+                        if any(redis.versions.get(key, 0) != version for key, version in watched.items()):
+                            reply = None
+                        else:
+                            reply = [redis.execute(queued, queued_args) for queued, queued_args in transaction]
+                        transaction = None
+                        watched.clear()
+                    elif transaction is not None:
+                        transaction.append((command, args))
+                        reply = "+QUEUED"
+                    elif command == b"BLPOP":
+                        key, timeout = args[0], float(args[-1])
+                        deadline = time.monotonic() + (timeout if timeout > 0 else 1e9)
+                        async with redis.list_pushed:
+                            while len(redis.lists.get(key, ())) == 0 and time.monotonic() < deadline:
+                                try:
+                                    await asyncio.wait_for(redis.list_pushed.wait(), deadline - time.monotonic())
+                                except asyncio.TimeoutError:
+                                    break
+                        items = redis.lists.get(key)
+                        reply = [key, items.popleft()] if items else None
+                    else:
+                        reply = redis.execute(command, args)
+                        if command == b"RPUSH":
+                            async with redis.list_pushed:
+                                redis.list_pushed.notify_all()
+                except Exception as e:
+                    reply = "-ERR %s" % e
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def main(port: int):
+    server = await asyncio.start_server(serve(FakeRedis()), "127.0.0.1", port)
+    print("Fake Redis listening on 127.0.0.1:%d" % port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
@@ -0,0 +1,217 @@
+"""
+Load test of main.py against local stand-ins of DingTalk and of the chatbot server.
+For each combination of worker threads and streaming, main.py is started, `--users` users each send messages
+one after the other (the next one once the answer is complete), and the throughput and latencies are reported:
+
+- time to first message: from sending the callback to the first message received by the session webhook
+- end to end: from sending the callback to the complete answer
+
+    python benchmarks/load_generator.py --provider openai --workers 1,4 --streaming true,false --users 8 --messages 64
+
+With `--ingestion stream` the messages are pushed through a DingTalk Stream mode connection instead of HTTP callbacks.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_dingtalk_server import FakeDingtalk  # noqa: E402
+from fake_llm_server import FakeLlm, add_arguments, from_arguments  # noqa: E402
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list, percentile: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+class Result:
+    def __init__(self, workers: int, streaming: bool):
+        self.workers = workers
+        self.streaming = streaming
+        self.sent = 0
+        self.failed = 0
+        self.duration = 0.0
+        self.first_message_latencies = []
+        self.end_to_end_latencies = []
+
+    @property
+    def completed(self) -> int:
+        return len(self.end_to_end_latencies)
+
+    HEADER = "%8s %9s %8s %7s %8s %13s %13s %11s %11s" % (
+        "workers", "streaming", "messages", "failed", "msg/s", "first p50(s)", "first p99(s)", "e2e p50(s)",
+        "e2e p99(s)")
+
+    def __str__(self):
+        return "%8d %9s %8d %7d %8.2f %13.3f %13.3f %11.3f %11.3f" % (
+            self.workers, str(self.streaming).lower(), self.sent, self.failed,
+            self.completed / self.duration if self.duration > 0 else 0.0,
+            _percentile(self.first_message_latencies, 50), _percentile(self.first_message_latencies, 99),
+            _percentile(self.end_to_end_latencies, 50), _percentile(self.end_to_end_latencies, 99))
+
+
+def _main_env(arguments: argparse.Namespace, fake_dingtalk: FakeDingtalk, llm_port: int, port: int, workers: int,
+              streaming: bool, work_dir: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "CHATBOT_SERVER_TYPE": arguments.provider,
+        "CHATBOT_SERVER_API_KEY": "fake-api-key",
+        "CHATBOT_SERVER_STREAMING_ENABLE": str(streaming).lower(),
+        "CHATBOT_SERVER_MULTIMODAL_ENABLE": str(arguments.picture_ratio > 0).lower(),
+        "DINGTALK_APP_KEY": fake_dingtalk.app_key,
+        "DINGTALK_APP_SECRET": fake_dingtalk.app_secret,
+        "DINGTALK_SERVER_BASE_URL": fake_dingtalk.base_url,
+        "DOWNLOAD_DIR": os.path.join(work_dir, "downloads"),
+        "MESSAGE_HANDLER_WORKER_THREADS": str(workers),
+        "SERVER_PORT": str(port),
+        "DINGTALK_STREAM_ENABLE": str(arguments.ingestion == "stream").lower(),
+        "READINESS_GRACE_PERIOD": "0",
+        "PYTHONUNBUFFERED": "1"
+    })
+    if arguments.provider == "openai":
+        env["CHATBOT_SERVER_BASE_URL"] = "http://127.0.0.1:%d/v1" % llm_port
+    elif arguments.provider == "anthropic":
+        env["CHATBOT_SERVER_BASE_URL"] = "http://127.0.0.1:%d" % llm_port
+    else:
+        env["DASHSCOPE_HTTP_BASE_URL"] = "http://127.0.0.1:%d/api/v1" % llm_port
+    for setting in arguments.env:
+        name, value = setting.split("=", 1)
+        env[name] = value
+    return env
+
+
+async def _wait_until_ready(process: subprocess.Popen, url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("main.py exited with code %d" % process.returncode)
+            try:
+                async with session.get(url + "/metrics") as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError("main.py is not ready after %.0f s" % timeout)
+
+
+async def _user(name: str, session: aiohttp.ClientSession, url: str, fake_dingtalk: FakeDingtalk, messages: int,
+                arguments: argparse.Namespace, result: Result, picture_share: float) -> None:
+    for i in range(messages):
+        picture = int((i + 1) * picture_share) > int(i * picture_share)
+        message = fake_dingtalk.new_message("Question %d from %s, tell me something long." % (i, name), name,
+                                            picture=picture)
+        answer = fake_dingtalk.session_of(message)
+        result.sent += 1
+        answer.sent_at = time.perf_counter()
+        try:
+            if arguments.ingestion == "stream":
+                ack = await fake_dingtalk.push(message)
+                if ack["code"] != 200:
+                    result.failed += 1
+                    continue
+                # A busy or refused reply goes through the session webhook, it makes the answer fail.
+            else:
+                async with session.post(url, json=message, headers=fake_dingtalk.sign()) as response:
+                    reply = await response.json()
+                if reply.get("msgtype") != "empty":  # busy or refused, not queued
+                    result.failed += 1
+                    continue
+            await asyncio.wait_for(answer.done.wait(), arguments.timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            result.failed += 1
+            continue
+        if answer.failed:
+            result.failed += 1
+            continue
+        result.first_message_latencies.append(answer.first_reply_at - answer.sent_at)
+        result.end_to_end_latencies.append(answer.final_at - answer.sent_at)
+
+
+async def run(arguments: argparse.Namespace, workers: int, streaming: bool) -> Result:
+    fake_dingtalk = FakeDingtalk()
+    fake_llm: FakeLlm = from_arguments(arguments)
+    llm_port, port = _free_port(), _free_port()
+    runners = [await fake_dingtalk.start(_free_port()), await fake_llm.start(llm_port)]
+
+    work_dir = tempfile.mkdtemp(prefix="chatgpding-benchmark-")
+    log_path = os.path.join(work_dir, "main.log")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT_DIR, stdout=log, stderr=subprocess.STDOUT,
+                                   env=_main_env(arguments, fake_dingtalk, llm_port, port, workers, streaming,
+                                                 work_dir))
+    url = "http://127.0.0.1:%d" % port
+    result = Result(workers, streaming)
+    try:
+        await _wait_until_ready(process, url)
+        if arguments.ingestion == "stream":
+            await asyncio.wait_for(fake_dingtalk.stream_connected.wait(), 30)
+        messages_per_user = max(1, arguments.messages // arguments.users)
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            start_time = time.perf_counter()
+            await asyncio.gather(*[_user("user%d" % i, session, url, fake_dingtalk, messages_per_user, arguments,
+                                         result, arguments.picture_ratio) for i in range(arguments.users)])
+            result.duration = time.perf_counter() - start_time
+    finally:
+        process.send_signal(signal.SIGINT)  # graceful shutdown, the workers are drained by the stand-ins
+        deadline = time.monotonic() + 60
+        while process.poll() is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        if process.poll() is None:
+            process.kill()
+        for runner in runners:
+            await runner.cleanup()
+    print("  %d chatbot server request(s), %d injected error(s), %d webhook post(s), %d card update(s),"
+          " %d stream connection(s). main.py log: %s"
+          % (fake_llm.requests, fake_llm.errors, fake_dingtalk.webhook_posts, fake_dingtalk.card_updates,
+             fake_dingtalk.stream_connections_opened, log_path))
+    return result
+
+
+async def main(arguments: argparse.Namespace):
+    results = []
+    for workers in [int(value) for value in arguments.workers.split(",")]:
+        for streaming in [value.strip().lower() == "true" for value in arguments.streaming.split(",")]:
+            print("Running %s with %d worker(s), streaming %s ..." % (arguments.provider, workers, streaming))
+            results.append(await run(arguments, workers, streaming))
+    print()
+    print(Result.HEADER)
+    for result in results:
+        print(result)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argument_parser.add_argument("--provider", choices=["openai", "anthropic", "dashscope"], default="openai")
+    argument_parser.add_argument("--workers", default="2", help="worker threads to compare, e.g. 1,2,4")
+    argument_parser.add_argument("--streaming", default="true", help="streaming settings to compare: true,false")
+    argument_parser.add_argument("--users", type=int, default=4, help="users sending messages at the same time")
+    argument_parser.add_argument("--messages", type=int, default=20, help="messages sent, shared by the users")
+    argument_parser.add_argument("--ingestion", choices=["http", "stream"], default="http",
+                                 help="messages sent as HTTP callbacks or through a Stream mode connection")
+    argument_parser.add_argument("--picture-ratio", type=float, default=0.0,
+                                 help="share of picture messages (downloaded through messageFiles/download)")
+    argument_parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for an answer")
+    argument_parser.add_argument("--env", action="append", default=[],
+                                 help="more settings for main.py, e.g. --env RESPONSE_CACHE_ENABLE=true")
+    add_arguments(argument_parser)
+    asyncio.run(main(argument_parser.parse_args()))
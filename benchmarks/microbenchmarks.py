@@ -0,0 +1,242 @@
+"""
+Microbenchmarks of the CPU paths run on every message, compared with a baseline saved in benchmarks/baseline.json.
+
+    python benchmarks/microbenchmarks.py                 # run, compare with the baseline
+    python benchmarks/microbenchmarks.py --save          # run, save as the new baseline
+    python benchmarks/microbenchmarks.py -k organize     # only the benchmarks whose name contains "organize"
+
+Times are per call. A benchmark slower than the baseline by more than --threshold is reported as a regression,
+baselines are only comparable on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from components.ai_side.anthropic_chatbot_client import _build_message_param  # noqa: E402
+from components.ai_side.chatbot_client import ChatMessage, ImageBlock, TextBlock, TokenUsage  # noqa: E402
+from components.coordination import QueuedRequest  # noqa: E402
+from components.dingtalk_message_handler import _organize_iterable_response, _create_message_bottom  # noqa: E402
+from components.im_side.dingtalk_client import _hmac_sha256_base64_encode  # noqa: E402
+from components.im_side.signature_verifier import SignatureVerifier  # noqa: E402
+from components.tools import truncate_string  # noqa: E402
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+STREAMS_DIR = os.path.join(BENCHMARKS_DIR, "streams")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def measure(function: Callable[[], object], min_time: float = 0.2, rounds: int = 5) -> Dict[str, float]:
+    """
+    Time `function` over `rounds` rounds of at least `min_time` seconds each.
+    :return: mean, min and stdev of the seconds per call over the rounds
+    """
+    function()  # warm up
+    number = 1
+    while True:
+        start_time = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= min_time / 10:
+            break
+        number *= 2
+    number = max(1, round(number * min_time / max(elapsed, 1e-9)))  # calls in a round of min_time
+
+    per_call = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            function()
+        per_call.append((time.perf_counter() - start_time) / number)
+    return {"mean": statistics.mean(per_call), "min": min(per_call),
+            "stdev": statistics.stdev(per_call) if rounds > 1 else 0.0, "calls": number * rounds}
+
+
+def _stream(name: str) -> List[str]:
+    with open(os.path.join(STREAMS_DIR, name + ".json"), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _organize(chunks: List[str]) -> Callable[[], object]:
+    return lambda: list(_organize_iterable_response(iter(chunks)))
+
+
+def _check_signature(with_robot_code: bool) -> Callable[[], object]:
+    # the matching key last, every key is tried without the robot code
+    app_keys = ["dingapp%03d" % i for i in range(50)]
+    secret_keys = ["secret-%03d-%s" % (i, "x" * 40) for i in range(50)]
+    # the same signature checked again and again, the replay check would reject it
+    verifier = SignatureVerifier(",".join(app_keys), ",".join(secret_keys), replay_cache_size=0)
+    timestamp = str(int(time.time() * 1000))
+    signature = _hmac_sha256_base64_encode(secret_keys[-1], timestamp + "\n" + secret_keys[-1])
+    robot_code = app_keys[-1] if with_robot_code else None
+    return lambda: verifier.verify(timestamp, signature, robot_code)
+
+
+def _openai_client():
+    try:
+        from components.ai_side.openai_chatbot_client import OpenaiChatBotClient
+        return OpenaiChatBotClient(api_key="benchmark", base_url=None, model_name="gpt-4",
+                                   preset_system_prompt="You are a very helpful assistant.", enable_streaming=True,
+                                   enable_multimodal=False)
+    except Exception as e:
+        raise SkipBenchmark("OpenAI client unavailable (%s), the tiktoken encoding is downloaded on first use"
+                            % type(e).__name__)
+
+
+def _num_tokens_from_string(text: str) -> Callable[[], object]:
+    client = _openai_client()
+    return lambda: client.num_tokens_from_string(text)
+
+
+def _num_tokens_from_messages(messages: List[dict]) -> Callable[[], object]:
+    client = _openai_client()
+    return lambda: client._num_tokens_from_messages(messages)
+
+
+def _build_message_param_with_images(image_dir: str) -> Callable[[], object]:
+    contents = []
+    for i in range(10):
+        path = os.path.join(image_dir, "%08X.png" % i)
+        with open(path, "wb") as file:
+            file.write(os.urandom(200 * 1024))  # the size of a phone screenshot
+        contents.append(ImageBlock(image=path))
+    contents.append(TextBlock(text="What is the difference between these screenshots?"))
+    message = ChatMessage(role="user", content=contents)
+    return lambda: _build_message_param(message, enable_multimodal=True)
+
+
+def _message_objects() -> Callable[[], object]:
+    # what is created for each message: the queued request, the prompt with some history,
+    # and the usage counted chunk by chunk
+    history = [("user", "What is a closure?"), ("assistant", "A function with the variables it captured."),
+               ("user", "Show me one in Python."), ("assistant", "```python\ndef counter(): ...\n```")]
+
+    def create():
+        request = QueuedRequest(unique_identifier="http://hook/1", parameters={"content": "And in Go?"},
+                                request_id="1", enqueued_at=0.0, trace_id="0" * 32)
+        messages = [ChatMessage(role=role, content=content) for role, content in history]
+        messages.append(ChatMessage(role="user", content=[ImageBlock(image="A1B2C3D4.png"),
+                                                          TextBlock(text="And in Go?")]))
+        usage = TokenUsage(input_tokens=1234, output_tokens=0, image_tokens=0)
+        for _ in range(200):
+            usage.output_tokens += 1
+        return request, messages, usage.copy()
+
+    return create
+
+
+def benchmarks(work_dir: str) -> Dict[str, Callable[[], Callable[[], object]]]:
+    """
+    Name to a factory of the function to time, factories may raise SkipBenchmark.
+    """
+    prose = "".join(_stream("chinese_prose"))
+    code = "".join(_stream("code_heavy"))
+    messages = [{"role": "system", "content": "You are a very helpful assistant."},
+                {"role": "user", "content": prose},
+                {"role": "assistant", "content": code},
+                {"role": "user", "content": "And in Go?"}]
+    usage = TokenUsage(input_tokens=1234, output_tokens=567, image_tokens=0, cache_read_tokens=1000,
+                       cache_write_tokens=20)
+    return {
+        "organize_iterable_response[code_heavy]": lambda: _organize(_stream("code_heavy")),
+        "organize_iterable_response[chinese_prose]": lambda: _organize(_stream("chinese_prose")),
+        "organize_iterable_response[nested_fences]": lambda: _organize(_stream("nested_fences")),
+        "check_signature[50 app keys]": lambda: _check_signature(False),
+        "check_signature[50 app keys, robot code]": lambda: _check_signature(True),
+        "num_tokens_from_string[chinese_prose]": lambda: _num_tokens_from_string(prose),
+        "num_tokens_from_string[code_heavy]": lambda: _num_tokens_from_string(code),
+        "num_tokens_from_messages[4 messages]": lambda: _num_tokens_from_messages(messages),
+        "build_message_param[10 images]": lambda: _build_message_param_with_images(work_dir),
+        "message_objects[5 messages, 200 chunks]": _message_objects,
+        "truncate_string[chinese_prose]": lambda: (lambda: truncate_string(prose)),
+        "create_message_bottom": lambda: (lambda: _create_message_bottom(usage, "claude-3-opus-20240229",
+                                                                         ["A1B2C3D4.png"], cache_hit=True)),
+    }
+
+
+def run(selected: str = None, min_time: float = 0.2, rounds: int = 5) -> Dict[str, Dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, factory in benchmarks(work_dir).items():
+            if selected is not None and selected not in name:
+                continue
+            try:
+                function = factory()
+            except SkipBenchmark as e:
+                print("%-48s skipped: %s" % (name, e))
+                continue
+            results[name] = measure(function, min_time, rounds)
+    return results
+
+
+def _format_time(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return "%8.3f ms" % (seconds * 1e3)
+    return "%8.3f us" % (seconds * 1e6)
+
+
+def report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    """
+    Print the results against the baseline.
+    :return: names of the regressions
+    """
+    regressions = []
+    print("%-48s %11s %11s %9s %11s %8s" % ("benchmark", "mean", "min", "stdev", "baseline", "change"))
+    for name, result in results.items():
+        line = "%-48s %s %s %8.1f%%" % (name, _format_time(result["mean"]), _format_time(result["min"]),
+                                        result["stdev"] / result["mean"] * 100 if result["mean"] > 0 else 0.0)
+        if name in baseline:
+            # min is the least noisy estimate of the cost of the code
+            change = result["min"] / baseline[name]["min"] - 1
+            line += " %s %+7.1f%%" % (_format_time(baseline[name]["min"]), change * 100)
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", dest="selected", help="only the benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression (0.2: 20%%)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds of each round")
+    parser.add_argument("--rounds", type=int, default=5)
+    arguments = parser.parse_args()
+
+    baseline_results = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline, encoding="utf-8") as baseline_file:
+            baseline_results = json.load(baseline_file)["benchmarks"]
+
+    benchmark_results = run(arguments.selected, arguments.min_time, arguments.rounds)
+    found_regressions = report(benchmark_results, baseline_results, arguments.threshold)
+
+    if arguments.save:
+        # keep the baseline of the benchmarks not run (skipped, or not selected)
+        saved = dict(baseline_results, **{name: {key: round(value, 9) for key, value in result.items()}
+                                          for name, result in benchmark_results.items()})
+        with open(arguments.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump({"machine": {"python": platform.python_version(), "platform": platform.platform(),
+                                   "processor": platform.processor() or platform.machine()},
+                       "benchmarks": saved}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Baseline saved to %s" % arguments.baseline)
+    elif len(found_regressions) > 0:
+        sys.exit(1)
@@ -4,4 +4,19 @@ for file in start_GPDing_*\.sh; do
     if [ -x "$file" ]; then
         nohup ./$file > ${file/.sh/.log} 2>&1 &
     fi
-done
\ No newline at end of file
+done
+
+# Wait until each process is ready (GET /readyz), up to 60 seconds.
+for file in start_GPDing_*\.sh; do
+    if [ -x "$file" ]; then
+        port=$(grep -o 'SERVER_PORT=[0-9]*' $file | cut -d= -f2)
+        for i in $(seq 60); do
+            if curl -sf "http://127.0.0.1:${port}/readyz" > /dev/null; then
+                echo "$file ready on port $port"
+                continue 2
+            fi
+            sleep 1
+        done
+        echo "$file not ready on port $port, see ${file/.sh/.log}"
+    fi
+done
@@ -4,13 +4,17 @@ from typing import List
 from PIL import Image
 
 import logging
+import anthropic
 from anthropic import Stream, Anthropic
 from anthropic.types import MessageStreamEvent, MessageParam, MessageStartEvent, MessageDeltaEvent, \
     ContentBlockStartEvent, ContentBlockDeltaEvent, ImageBlockParam, TextBlockParam
 from anthropic.types.image_block_param import Source
 
 from components.ai_side.chatbot_client import ChatMessage, ChatBotServerType, ChatBotClient, TokenUsage, ImageBlock, \
-    DisabledMultiModalConversation
+    DisabledMultiModalConversation, CancellationToken, CancellableStream
+from components.ai_side.hedging import HedgingPolicy
+from components.ai_side.provider_pool import ProviderPool, ProviderTarget
+from components.ai_side.stream_watchdog import StreamDeadlines
 from components.tools import image_to_base64
 
 
@@ -28,11 +32,36 @@ def _calculate_tokens_of_images(messages: List[ChatMessage], enable_multimodal=F
                     image = Image.open(file_path)
                     width, height = image.size
                     tokens = math.ceil((width * height) / 750)
-                    print("Content include a image size of {}x{}: cost {} tokens".format(width, height, tokens))
+                    logging.debug("Content include a image size of %dx%d: cost %d tokens", width, height, tokens)
                     total_tokens += tokens
     return total_tokens
 
 
+# Prompt caching breakpoints, a request can have at most 4 of them.
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+MAX_CACHE_BREAKPOINTS = 4
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _mark_cacheable_prefixes(message_params: List[MessageParam], is_large_text, breakpoints: int) -> int:
+    """
+    Put cache breakpoints on the latest large text blocks (uploaded documents), the prefix up to them is cached.
+    :return: breakpoints left
+    """
+    for message_param in reversed(message_params):
+        if breakpoints <= 0:
+            return breakpoints
+        if isinstance(message_param['content'], str):
+            if not is_large_text(message_param['content']):
+                continue
+            message_param['content'] = [TextBlockParam(type="text", text=message_param['content'])]
+        for block in reversed(message_param['content']):
+            if breakpoints > 0 and block['type'] == "text" and is_large_text(block['text']):
+                block['cache_control'] = CACHE_CONTROL
+                breakpoints -= 1
+    return breakpoints
+
+
 def _build_message_param(message: ChatMessage, enable_multimodal=False) -> MessageParam:
     if isinstance(message.content, str):
         return MessageParam(content=message.content, role=message.role)
@@ -63,25 +92,37 @@ def _build_message_param(message: ChatMessage, enable_multimodal=False) -> Messa
         return MessageParam(content=contents, role=message.role)
 
 
-class IterableMessageChunk:
-    def __init__(self, events: Stream[MessageStreamEvent], token_usage: TokenUsage):
+def _set_cache_tokens(token_usage: TokenUsage, usage) -> None:
+    # Only reported when prompt caching is used, and unknown to older SDK models.
+    token_usage.cache_read_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+    token_usage.cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+
+
+class IterableMessageChunk(CancellableStream):
+    def __init__(self, events: Stream[MessageStreamEvent], token_usage: TokenUsage, chatbot_client: ChatBotClient):
+        super().__init__(token_usage)
         self.events = events
-        self.token_usage = token_usage
+        self.chatbot_client = chatbot_client
 
-    def __iter__(self):
-        return self
+    def _close(self) -> None:
+        self.events.close()
 
-    def __next__(self):
+    def _next_chunk(self):
         try:
             event = self.events.__next__()
             if isinstance(event, MessageStartEvent):
                 self.token_usage.input_tokens = event.message.usage.input_tokens
                 self.token_usage.output_tokens = event.message.usage.output_tokens
+                _set_cache_tokens(self.token_usage, event.message.usage)
             if isinstance(event, MessageDeltaEvent):
+                # the actual count, replacing the estimate
                 self.token_usage.output_tokens = event.usage.output_tokens
             if isinstance(event, ContentBlockStartEvent):
+                self.token_usage.output_tokens += self.chatbot_client.estimate_tokens(event.content_block.text)
                 return event.content_block.text
             if isinstance(event, ContentBlockDeltaEvent):
+                # estimated as it comes, so that an interrupted reply still counts what has been generated
+                self.token_usage.output_tokens += self.chatbot_client.estimate_tokens(event.delta.text)
                 return event.delta.text
             return ""
         except StopIteration:
@@ -107,6 +148,9 @@ class AnthropicChatBotClient(ChatBotClient):
                              "and all sorts of other tasks. It uses markdown for coding.")
     DEFAULT_MODEL_NAME = "claude-3-sonnet-20240229"
 
+    # Shorter prefixes are not cached by the server (1024 tokens for most models), so no breakpoint is spent on them.
+    PROMPT_CACHING_MIN_TOKENS = 1024
+
     # claude-3-opus-20240229
 
     def __init__(self,
@@ -115,41 +159,82 @@ class AnthropicChatBotClient(ChatBotClient):
                  model_name: str,
                  preset_system_prompt: str,
                  enable_streaming: bool,
-                 enable_multimodal: bool):
-        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal)
-
-        self.client = Anthropic(api_key=self.api_key, base_url=self.base_url)
+                 enable_multimodal: bool,
+                 stream_deadlines: StreamDeadlines = None,
+                 provider_pool: ProviderPool = None,
+                 hedging_policy: HedgingPolicy = None,
+                 enable_prompt_caching: bool = True):
+        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal,
+                         stream_deadlines, provider_pool, hedging_policy)
+        self.enable_prompt_caching = enable_prompt_caching
 
     @property
     def server_type(self) -> ChatBotServerType:
         return ChatBotServerType.Anthropic
 
-    def completions(self, messages: List[ChatMessage], system: str = None):
+    def _create_sdk_client(self, target: ProviderTarget) -> Anthropic:
+        timeout = (self.stream_deadlines or StreamDeadlines()).http_timeout(self.enable_streaming)
+        client = Anthropic(api_key=target.api_key, base_url=target.base_url, timeout=timeout,
+                           http_client=self._http_client(target, timeout))
+        if len(self.provider_pool) > 1:
+            # with other targets to fail over to, do not insist on a failing one
+            client = client.with_options(max_retries=0)
+        return client
+
+    def _is_retryable_error(self, e: Exception) -> bool:
+        return super()._is_retryable_error(e) or isinstance(e, (anthropic.APIConnectionError,
+                                                                anthropic.RateLimitError,
+                                                                anthropic.InternalServerError))
+
+    def _is_large_text(self, text: str) -> bool:
+        return self.estimate_tokens(text) >= self.PROMPT_CACHING_MIN_TOKENS
+
+    def _create_completions(self, target: ProviderTarget, messages: List[ChatMessage], system: str = None,
+                            cancellation_token: CancellationToken = None):
         # messages = [
         #     {
         #         "role": "user",
         #         "content": "Hello, Claude",
         #     }
         # ]
-        response = self.client.messages.create(
-            model=self.model_name,
-            max_tokens=1024,
-            temperature=0,
-            system=self.preset_system_prompt if system is None else system,
-            messages=[_build_message_param(message, self.enable_multimodal) for message in messages],
-            stream=self.enable_streaming
-        )
+        system = self.preset_system_prompt if system is None else system
+        message_params = [_build_message_param(message, self.enable_multimodal) for message in messages]
+        extra_headers = None
+        if self.enable_prompt_caching:
+            # The system prompt is the same for every request, then come the documents the user asks about.
+            # Text shorter than the minimum is not cached, a breakpoint on it would only make the request bigger.
+            breakpoints = MAX_CACHE_BREAKPOINTS
+            if system and self._is_large_text(system):
+                system = [TextBlockParam(type="text", text=system, cache_control=CACHE_CONTROL)]
+                breakpoints -= 1
+            breakpoints = _mark_cacheable_prefixes(message_params, self._is_large_text, breakpoints)
+            if breakpoints < MAX_CACHE_BREAKPOINTS:
+                extra_headers = {"anthropic-beta": PROMPT_CACHING_BETA}
+        try:
+            raw_response = self._sdk_client(target).messages.with_raw_response.create(
+                model=self.model_name,
+                max_tokens=1024,
+                temperature=0,
+                system=system,
+                messages=message_params,
+                stream=self.enable_streaming,
+                extra_headers=extra_headers
+            )
+        except anthropic.RateLimitError as e:
+            target.rate_limiter.update_from_headers(e.response.headers, e.status_code)
+            raise e
+        target.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
         image_tokens = _calculate_tokens_of_images(messages, self.enable_multimodal)
         if not self.enable_streaming:
-            return (
-                [response.content[0].text],
-                TokenUsage(input_tokens=response.usage.input_tokens,
-                           output_tokens=response.usage.output_tokens,
-                           image_tokens=image_tokens)
-            )
+            token_usage = TokenUsage(input_tokens=response.usage.input_tokens,
+                                     output_tokens=response.usage.output_tokens,
+                                     image_tokens=image_tokens)
+            _set_cache_tokens(token_usage, response.usage)
+            return [response.content[0].text], token_usage
         else:
             token_usage = TokenUsage(input_tokens=0, output_tokens=0, image_tokens=image_tokens)
-            return IterableMessageChunk(response, token_usage), token_usage
+            return self._watch(IterableMessageChunk(response, token_usage, self).bind(cancellation_token)), token_usage
 
 
 if __name__ == '__main__':
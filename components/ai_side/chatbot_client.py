@@ -1,31 +1,61 @@
+import copy
 import logging
 import os
+import queue
+import re
+import threading
+import time
 from abc import abstractmethod, ABC
 from enum import Enum
-from typing import Iterable, Literal, Union, List
+from typing import Iterable, Literal, Union, List, TYPE_CHECKING, Any
 
-from pydantic import BaseModel
+import httpx
 
-from components.tools import is_true
+from components.ai_side.hedging import HedgingPolicy
+from components.ai_side.provider_pool import ProviderPool, ProviderTarget
+from components.tools import is_true, SlottedRecord
 
+if TYPE_CHECKING:
+    from components.ai_side.stream_watchdog import StreamDeadlines
 
-class ImageBlock(BaseModel):
-    image: str
 
+class ImageBlock(SlottedRecord):
+    __slots__ = ("image",)
 
-class TextBlock(BaseModel):
-    text: str
+    def __init__(self, image: str):
+        self.image = image
 
 
-class ChatMessage(BaseModel):
-    content: Union[str, List[Union[ImageBlock, TextBlock]]]
-    role: Literal["user", "assistant"]
+class TextBlock(SlottedRecord):
+    __slots__ = ("text",)
 
+    def __init__(self, text: str):
+        self.text = text
 
-class TokenUsage(BaseModel):
-    input_tokens: int
-    output_tokens: int
-    image_tokens: int
+
+class ChatMessage(SlottedRecord):
+    __slots__ = ("content", "role")
+
+    def __init__(self, content: Union[str, List[Union[ImageBlock, TextBlock]]], role: Literal["user", "assistant"]):
+        self.content = content
+        self.role = role
+
+
+class TokenUsage(SlottedRecord):
+    # updated for every chunk of a stream
+    __slots__ = ("input_tokens", "output_tokens", "image_tokens", "cache_read_tokens", "cache_write_tokens")
+
+    def __init__(self,
+                 input_tokens: int,
+                 output_tokens: int,
+                 image_tokens: int,
+                 cache_read_tokens: int = 0,
+                 cache_write_tokens: int = 0):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.image_tokens = image_tokens
+        self.cache_read_tokens = cache_read_tokens  # input tokens read from the prompt cache
+        self.cache_write_tokens = cache_write_tokens  # input tokens written to the prompt cache
 
 
 class ContextLengthExceededException(Exception):
@@ -44,6 +74,194 @@ class UploadingTooManyImagesException(Exception):
     pass
 
 
+class ProviderUnavailableException(Exception):
+    """
+    The chatbot server is overloaded or failing (429, 5xx), another target of the pool may serve the request.
+    """
+    pass
+
+
+class CompletionCancelledException(Exception):
+    pass
+
+
+class StreamTimeoutException(Exception):
+    """
+    Raised by a stream aborted by the watchdog.
+    phase is 'first_token' when no content arrived in time, or 'idle' when the stream stalled in the middle.
+    """
+
+    def __init__(self, phase: str, elapsed: float, deadline: float, token_usage: 'TokenUsage' = None):
+        super().__init__(phase, elapsed, deadline)
+        self.phase = phase
+        self.elapsed = elapsed
+        self.deadline = deadline
+        self.token_usage = token_usage
+
+    def __str__(self):
+        return "No %s from chatbot server within %.1f s (waited %.1f s)." % (
+            "first token" if self.phase == 'first_token' else "new chunk", self.deadline, self.elapsed)
+
+
+class CancellationToken:
+    """
+    Shared between the message handler and the chatbot client of one request.
+    Cancelling it aborts the running completion and closes the upstream response.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+        self.reason = None
+
+    def cancel(self, reason: str = None) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning("Error while running cancellation callback: %s", e)
+
+    def on_cancel(self, callback) -> None:
+        """
+        Register a callback, it runs immediately if the token has already been cancelled.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise CompletionCancelledException(self.reason)
+
+
+class CancellableStream(ABC):
+    """
+    Iterable reply of a streaming completion.
+    `cancel` may be called from any thread, it closes the underlying response so that a blocked `__next__` returns.
+    """
+
+    def __init__(self, token_usage: 'TokenUsage'):
+        self.token_usage = token_usage
+        self.cancel_exception = None
+
+        # Progress timestamps (time.monotonic) read by the stream watchdog.
+        self.started_at = time.monotonic()
+        self.first_chunk_at = None
+        self.waiting_since = self.started_at  # for the chatbot server, None while the consumer holds a chunk
+        self.finished = False
+
+        self._prefetched = []
+        self._exhausted = False
+        self._done_callbacks = []
+        self._done_lock = threading.Lock()
+        self._done_error = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if len(self._prefetched) > 0:
+            return self._prefetched.pop(0)
+        return self._pull()
+
+    def _pull(self) -> str:
+        if self._exhausted:
+            raise StopIteration
+        if self.cancel_exception is not None:
+            raise self.cancel_exception
+        self.waiting_since = time.monotonic()
+        try:
+            chunk = self._next_chunk()
+        except StopIteration:
+            self._exhausted = True
+            self._finish(None)
+            raise
+        except Exception as e:
+            error = self.cancel_exception if self.cancel_exception is not None else e
+            self._finish(error)
+            if error is not e:
+                raise error from e
+            raise e
+        finally:
+            self.waiting_since = None
+        if self.first_chunk_at is None and chunk is not None and len(chunk) > 0:
+            self.first_chunk_at = time.monotonic()
+        return chunk
+
+    def prefetch(self) -> None:
+        """
+        Wait for the first non-empty chunk and keep it for the consumer.
+        Until then nothing has been emitted, so errors raised here can still be retried elsewhere.
+        """
+        while True:
+            try:
+                chunk = self._pull()
+            except StopIteration:
+                return
+            self._prefetched.append(chunk)
+            if chunk is not None and len(chunk) > 0:
+                return
+
+    def cancel(self, exception: Exception = None) -> None:
+        if self.cancel_exception is not None or self.finished:
+            return
+        self.cancel_exception = exception if exception is not None else CompletionCancelledException()
+        try:
+            self._close()
+        except Exception as e:
+            logging.warning("Error while closing cancelled stream: %s", e)
+        self._finish(self.cancel_exception)
+
+    def bind(self, cancellation_token: CancellationToken = None) -> 'CancellableStream':
+        if cancellation_token is not None:
+            cancellation_token.on_cancel(
+                lambda: self.cancel(CompletionCancelledException(cancellation_token.reason)))
+        return self
+
+    def add_done_callback(self, callback) -> None:
+        """
+        callback(error) runs once when the stream ends, error is None when it completed normally.
+        """
+        with self._done_lock:
+            if not self.finished:
+                self._done_callbacks.append(callback)
+                return
+        callback(self._done_error)
+
+    def _finish(self, error: Exception = None) -> None:
+        with self._done_lock:
+            if self.finished:
+                return
+            self.finished = True
+            self._done_error = error
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            try:
+                callback(error)
+            except Exception as e:
+                logging.warning("Error while running stream done callback: %s", e)
+
+    @abstractmethod
+    def _next_chunk(self) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _close(self) -> None:
+        raise NotImplementedError
+
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
 class ChatBotServerType(Enum):
     DashScope = "dashscope"
     OpenAI = "openai"
@@ -53,17 +271,32 @@ class ChatBotServerType(Enum):
 class ChatBotClient(ABC):
     DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant. "
 
+    # Rough cost of an image in the pre-flight estimate of a prompt.
+    ESTIMATED_IMAGE_TOKENS = 1000
+
     DEFAULT_MODEL_NAME = "Need to set environment variable: CHATBOT_SERVER_MODEL_NAME"
 
+    # Idle pooled connections are closed after this (5 s by default in httpx), the workers keep theirs warm more often.
+    KEEPALIVE_EXPIRY = 60.0
+
     def __init__(self,
                  api_key: str,
                  base_url: str = None,
                  model_name: str = None,
                  preset_system_prompt: str = None,
                  enable_streaming: bool = None,
-                 enable_multimodal: bool = None, ):
-        self.api_key = api_key
-        self.base_url = base_url
+                 enable_multimodal: bool = None,
+                 stream_deadlines: 'StreamDeadlines' = None,
+                 provider_pool: ProviderPool = None,
+                 hedging_policy: HedgingPolicy = None):
+        self.provider_pool = provider_pool if provider_pool is not None \
+            else ProviderPool([ProviderTarget(api_key, base_url)])
+        self.api_key = self.provider_pool.targets[0].api_key
+        self.base_url = self.provider_pool.targets[0].base_url
+        self.stream_deadlines = stream_deadlines
+        self.hedging_policy = hedging_policy
+        self._sdk_clients: dict[ProviderTarget, Any] = {}
+        self._http_clients: dict[ProviderTarget, httpx.Client] = {}
 
         self.model_name = self.DEFAULT_MODEL_NAME if model_name is None else model_name
         self.preset_system_prompt = self.DEFAULT_SYSTEM_PROMPT if preset_system_prompt is None else preset_system_prompt
@@ -104,10 +337,253 @@ class ChatBotClient(ABC):
     def has_multi_modal_ability(self) -> bool:
         raise NotImplementedError
 
-    @abstractmethod
+    def with_model(self, model_name: str) -> 'ChatBotClient':
+        """
+        The same client calling another model, it shares the provider pool and the connections of this one.
+        """
+        if model_name == self.model_name:
+            return self
+        client = copy.copy(self)
+        client.model_name = model_name
+        return client
+
+    def _watch(self, stream: CancellableStream) -> CancellableStream:
+        """
+        Let the watchdog abort the stream when it misses the first token or idle deadline.
+        """
+        if self.stream_deadlines is not None:
+            self.stream_deadlines.watch(stream)
+        return stream
+
+    def estimate_tokens(self, text: str) -> int:
+        """
+        Cheap local estimate, about one token per CJK character and one per four other characters.
+        """
+        if text is None or len(text) == 0:
+            return 0
+        cjk_characters = len(_CJK_PATTERN.findall(text))
+        return cjk_characters + (len(text) - cjk_characters + 3) // 4
+
+    def estimate_prompt_tokens(self, messages: List[ChatMessage], system: str = None) -> int:
+        tokens = self.estimate_tokens(system if system is not None else self.preset_system_prompt)
+        for message in messages:
+            if isinstance(message.content, str):
+                tokens += self.estimate_tokens(message.content)
+            else:
+                for content in message.content:
+                    if isinstance(content, ImageBlock):
+                        tokens += self.ESTIMATED_IMAGE_TOKENS
+                    else:
+                        tokens += self.estimate_tokens(content.text)
+        return tokens
+
+    def _sdk_client(self, target: ProviderTarget) -> Any:
+        """
+        SDK client of a target, created on first use and kept for its connection pool.
+        """
+        client = self._sdk_clients.get(target)
+        if client is None:
+            client = self._create_sdk_client(target)
+            self._sdk_clients[target] = client
+        return client
+
+    def _create_sdk_client(self, target: ProviderTarget) -> Any:
+        return None
+
+    def _http_client(self, target: ProviderTarget, timeout: httpx.Timeout) -> httpx.Client:
+        """
+        Connection pool for the SDK client of a target, idle connections kept for KEEPALIVE_EXPIRY seconds.
+        """
+        http_client = httpx.Client(timeout=timeout, follow_redirects=True,
+                                   limits=httpx.Limits(max_connections=100, max_keepalive_connections=20,
+                                                       keepalive_expiry=self.KEEPALIVE_EXPIRY))
+        self._http_clients[target] = http_client
+        return http_client
+
+    def warm_up(self) -> int:
+        """
+        Open a pooled connection to each target, or keep it open: DNS, TCP and TLS are done before the first request.
+        Failures are only logged, the request will try again anyway.
+        :return: targets reached
+        """
+        reached = 0
+        for target in self.provider_pool.targets:
+            sdk_client = self._sdk_client(target)
+            http_client = self._http_clients.get(target)
+            if http_client is None:  # the SDK has no pool of ours
+                continue
+            try:
+                http_client.head(str(sdk_client.base_url))
+                reached += 1
+            except Exception as e:
+                logging.warning("Failed to warm up the connection to %s: %s" % (target, e))
+        return reached
+
+    def close(self) -> None:
+        """
+        Close the connections of the SDK clients, the client can still be used afterwards.
+        """
+        clients = list(self._sdk_clients.values())
+        self._sdk_clients.clear()
+        self._http_clients.clear()  # closed by their SDK client
+        for client in clients:
+            if client is not None and hasattr(client, 'close'):
+                try:
+                    client.close()
+                except Exception as e:
+                    logging.warning("Failed to close chatbot server client: %s" % e)
+
+    def _is_retryable_error(self, e: Exception) -> bool:
+        """
+        Whether the error is the target's fault, so the request may be sent to another target.
+        """
+        return isinstance(e, (ProviderUnavailableException, StreamTimeoutException, ConnectionError, TimeoutError))
+
     def completions(self,
                     messages: List[ChatMessage],
-                    system: str = None) -> tuple[Iterable[str], TokenUsage]:
+                    system: str = None,
+                    cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage]:
+        """
+        Send the request to a target of the provider pool, failing over to another one
+        as long as nothing has been emitted yet.
+        :param messages:
+        :param system:
+        :param cancellation_token: cancelling it aborts a streaming reply and releases the upstream connection,
+            the returned TokenUsage then holds the usage counted so far.
+        :return: iterable reply and its token usage
+        """
+        estimated_tokens = self.estimate_prompt_tokens(messages, system)
+        if self.hedging_policy is not None:
+            self.hedging_policy.on_request()
+        tried = []
+        while True:
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+            target = self.provider_pool.acquire(exclude=tried, estimated_tokens=estimated_tokens)
+            try:
+                if self.hedging_policy is not None and self.enable_streaming:
+                    return self._hedged_attempt(target, tried, messages, system, cancellation_token, estimated_tokens)
+                return self._attempt(target, messages, system, cancellation_token, estimated_tokens,
+                                     self.provider_pool.rate_limit_max_wait)
+            except Exception as e:
+                tried.append(target)
+                if (not self._is_retryable_error(e) or len(tried) >= self.provider_pool.max_attempts
+                        or not self.provider_pool.has_alternative(tried)):
+                    raise e
+                logging.warning("Chatbot server target %s failed (%s: %s), retry on another target."
+                                % (target, type(e).__name__, e))
+
+    def _attempt(self,
+                 target: ProviderTarget,
+                 messages: List[ChatMessage],
+                 system: str,
+                 cancellation_token: CancellationToken,
+                 estimated_tokens: int,
+                 rate_limit_max_wait: float) -> tuple[Iterable[str], TokenUsage]:
+        """
+        Send the request to a target already acquired from the pool, and wait for its first token.
+        The target is released when the reply is over, or right away if the attempt fails.
+        """
+        try:
+            # Wait for budget rather than sending a request that will be rejected with 429.
+            target.rate_limiter.acquire(estimated_tokens, rate_limit_max_wait, cancellation_token)
+        except Exception as e:
+            self.provider_pool.release(target)
+            raise e
+        start_time = time.perf_counter()
+        try:
+            reply, usage = self._create_completions(target, messages, system, cancellation_token)
+            if isinstance(reply, CancellableStream):
+                reply.prefetch()
+                time_to_first_token = time.perf_counter() - start_time
+                self.provider_pool.observe_latency(target, time_to_first_token)
+                if self.hedging_policy is not None:
+                    self.hedging_policy.observe(time_to_first_token)
+                reply.add_done_callback(
+                    lambda error, u=usage: self._release(target, error, estimated_tokens, u))
+            else:
+                self.provider_pool.observe_latency(target, time.perf_counter() - start_time)
+                self._release(target, None, estimated_tokens, usage)
+            return reply, usage
+        except Exception as e:
+            target.rate_limiter.reconcile(estimated_tokens, 0)
+            self.provider_pool.release(target, self._is_retryable_error(e))
+            raise e
+
+    def _hedged_attempt(self,
+                        target: ProviderTarget,
+                        tried: List[ProviderTarget],
+                        messages: List[ChatMessage],
+                        system: str,
+                        cancellation_token: CancellationToken,
+                        estimated_tokens: int) -> tuple[Iterable[str], TokenUsage]:
+        """
+        Like `_attempt`, but when the first token is later than the hedging delay a duplicate request is sent
+        to another target, if there is one not tried yet. The first one to stream wins, the other one is cancelled.
+        A failed hedge adds its target to `tried`.
+        """
+        results = queue.Queue()
+        attempts = []
+
+        def start(attempt_target: ProviderTarget, rate_limit_max_wait: float) -> None:
+            # Each attempt has its own token, so that the loser can be cancelled alone.
+            attempt_token = CancellationToken()
+            if cancellation_token is not None:
+                cancellation_token.on_cancel(lambda: attempt_token.cancel(cancellation_token.reason))
+            attempts.append((attempt_target, attempt_token))
+
+            def run():
+                try:
+                    results.put((attempt_target, attempt_token, self._attempt(
+                        attempt_target, messages, system, attempt_token, estimated_tokens, rate_limit_max_wait), None))
+                except Exception as ex:
+                    results.put((attempt_target, attempt_token, None, ex))
+
+            threading.Thread(target=run, name="HedgedAttempt", daemon=True).start()
+
+        start(target, self.provider_pool.rate_limit_max_wait)
+        try:
+            finished = [results.get(timeout=self.hedging_policy.delay())]
+        except queue.Empty:
+            finished = []
+            # the hedge goes to another target, never duplicates the request on the slow one
+            if self.provider_pool.has_alternative(tried + [target]) and self.hedging_policy.try_spend():
+                hedge_target = self.provider_pool.acquire(exclude=tried + [target], estimated_tokens=estimated_tokens)
+                logging.info("First token from %s is late, hedge the request on %s." % (target, hedge_target))
+                # A hedge never waits for rate limit budget.
+                start(hedge_target, 0)
+
+        pending = list(attempts)
+        error = None
+        while len(pending) > 0:
+            if len(finished) == 0:
+                finished.append(results.get())
+            attempt_target, attempt_token, result, error = finished.pop(0)
+            pending = [(t, k) for t, k in pending if k is not attempt_token]
+            if result is not None:
+                for _, other_token in attempts:
+                    if other_token is not attempt_token:
+                        other_token.cancel("hedge lost")
+                if attempt_target is not target:
+                    self.hedging_policy.on_hedge_won()
+                return result
+            if attempt_target is not target:
+                tried.append(attempt_target)
+        raise error
+
+    def _release(self, target: ProviderTarget, error: Exception, estimated_tokens: int, usage: TokenUsage) -> None:
+        target.rate_limiter.reconcile(estimated_tokens, usage.input_tokens + usage.output_tokens)
+        self.provider_pool.release(target, error is not None and self._is_retryable_error(error))
+
+    @abstractmethod
+    def _create_completions(self,
+                            target: ProviderTarget,
+                            messages: List[ChatMessage],
+                            system: str = None,
+                            cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage]:
+        """
+        Send the request to the given target, a streaming reply is returned as a CancellableStream.
+        """
         raise NotImplementedError
 
 
@@ -5,8 +5,12 @@ from enum import Enum
 from components.ai_side.anthropic_chatbot_client import AnthropicChatBotClient
 from components.ai_side.chatbot_client import ChatBotClient, ChatBotServerType
 from components.ai_side.dashscope_chatbot_client import DashscopeChatBotClient
+from components.ai_side.hedging import HedgingPolicy
 from components.ai_side.openai_chatbot_client import OpenaiChatBotClient
-from components.tools import is_true
+from components.ai_side.provider_pool import ProviderPool
+from components.ai_side.recording import RecordingChatBotClient, Recordings, ReplayChatBotClient
+from components.ai_side.stream_watchdog import StreamDeadlines
+from components.tools import is_true, get_float_env
 
 
 class ChatBotServerEnv(Enum):
@@ -16,32 +20,72 @@ class ChatBotServerEnv(Enum):
     PRESET_SYSTEM_PROMPT = "CHATBOT_SERVER_SYSTEM_PROMPT"
     ENABLE_STREAMING = "CHATBOT_SERVER_STREAMING_ENABLE"
     ENABLE_MULTIMODAL = "CHATBOT_SERVER_MULTIMODAL_ENABLE"
+    CONNECT_TIMEOUT = "CHATBOT_SERVER_CONNECT_TIMEOUT"
+    FIRST_TOKEN_TIMEOUT = "CHATBOT_SERVER_FIRST_TOKEN_TIMEOUT"
+    IDLE_TIMEOUT = "CHATBOT_SERVER_IDLE_TIMEOUT"
+    MAX_ATTEMPTS = "CHATBOT_SERVER_MAX_ATTEMPTS"
+    RPM_LIMIT = "CHATBOT_SERVER_RPM_LIMIT"
+    TPM_LIMIT = "CHATBOT_SERVER_TPM_LIMIT"
+    RATE_LIMIT_MAX_WAIT = "CHATBOT_SERVER_RATE_LIMIT_MAX_WAIT"
+    ENABLE_HEDGING = "CHATBOT_SERVER_HEDGING_ENABLE"
+    HEDGING_PERCENTILE = "CHATBOT_SERVER_HEDGING_PERCENTILE"
+    HEDGING_BUDGET_RATIO = "CHATBOT_SERVER_HEDGING_BUDGET_RATIO"
+    HEDGING_MIN_DELAY = "CHATBOT_SERVER_HEDGING_MIN_DELAY"
+    HEDGING_MAX_DELAY = "CHATBOT_SERVER_HEDGING_MAX_DELAY"
+    ENABLE_PROMPT_CACHING = "CHATBOT_SERVER_PROMPT_CACHING_ENABLE"
+    RECORD_PATH = "CHATBOT_SERVER_RECORD_PATH"
+    REPLAY_PATH = "CHATBOT_SERVER_REPLAY_PATH"
+    REPLAY_SPEED = "CHATBOT_SERVER_REPLAY_SPEED"
 
 
 class ChatBotClientBuilder:
 
     def build(self) -> ChatBotClient:
+        if self.recordings is not None:
+            return ReplayChatBotClient(self.recordings,
+                                       self.replay_speed,
+                                       self.model_name,
+                                       self.preset_system_prompt,
+                                       self.enable_streaming,
+                                       self.enable_multimodal,
+                                       self.chatbot_server_type)
+        client = self._build()
+        if self.record_path is not None:
+            return RecordingChatBotClient(client, self.record_path)
+        return client
+
+    def _build(self) -> ChatBotClient:
         if self.chatbot_server_type == ChatBotServerType.Anthropic:
             return AnthropicChatBotClient(self.api_key,
                                           self.base_url,
                                           self.model_name,
                                           self.preset_system_prompt,
                                           self.enable_streaming,
-                                          self.enable_multimodal)
+                                          self.enable_multimodal,
+                                          self.stream_deadlines,
+                                          self.provider_pool,
+                                          self.hedging_policy,
+                                          enable_prompt_caching=self.enable_prompt_caching)
         elif self.chatbot_server_type == ChatBotServerType.OpenAI:
             return OpenaiChatBotClient(self.api_key,
                                        self.base_url,
                                        self.model_name,
                                        self.preset_system_prompt,
                                        self.enable_streaming,
-                                       self.enable_multimodal)
+                                       self.enable_multimodal,
+                                       self.stream_deadlines,
+                                       self.provider_pool,
+                                       self.hedging_policy)
         else:
             return DashscopeChatBotClient(self.api_key,
                                           self.base_url,
                                           self.model_name,
                                           self.preset_system_prompt,
                                           self.enable_streaming,
-                                          self.enable_multimodal)
+                                          self.enable_multimodal,
+                                          self.stream_deadlines,
+                                          self.provider_pool,
+                                          self.hedging_policy)
 
     def __init__(self,
                  chatbot_server_type: ChatBotServerType,
@@ -50,17 +94,36 @@ class ChatBotClientBuilder:
                  model_name: str = None,
                  preset_system_prompt: str = None,
                  enable_streaming: bool = None,
-                 enable_multimodal: bool = None):
+                 enable_multimodal: bool = None,
+                 stream_deadlines: StreamDeadlines = None):
 
         self.chatbot_server_type = chatbot_server_type
 
+        # Replay recorded replies instead of calling the chatbot server, no api key is needed then.
+        self.recordings = None
+        self.replay_speed = get_float_env(ChatBotServerEnv.REPLAY_SPEED.value, 1.0)
+        if os.getenv(ChatBotServerEnv.REPLAY_PATH.value) is not None:
+            self.recordings = Recordings.load(os.environ[ChatBotServerEnv.REPLAY_PATH.value])
+            logging.info("Chatbot Server replays %d recorded replies (speed %s)."
+                         % (len(self.recordings.records), self.replay_speed))
+
         self.api_key = api_key if api_key is not None else os.environ.get(ChatBotServerEnv.API_KEY.value)
-        if self.api_key is None:
+        if self.api_key is None and self.recordings is None:
             raise SystemError(f"Need to set environment variable: {ChatBotServerEnv.API_KEY.value}.")
 
         self.base_url = base_url if base_url is not None else os.environ.get(ChatBotServerEnv.BASE_URL.value)
-        if self.base_url is not None:
-            logging.info("Chatbot Server use base url: %s" % self.base_url)
+
+        # Both CHATBOT_SERVER_API_KEY and CHATBOT_SERVER_BASE_URL can be comma separated lists,
+        # all workers share one pool balancing requests over the (key, base url) targets.
+        max_attempts = os.getenv(ChatBotServerEnv.MAX_ATTEMPTS.value)
+        self.provider_pool = ProviderPool.from_config(
+            self.api_key, self.base_url,
+            max_attempts=int(max_attempts) if max_attempts is not None else None,
+            requests_per_minute=get_float_env(ChatBotServerEnv.RPM_LIMIT.value),
+            tokens_per_minute=get_float_env(ChatBotServerEnv.TPM_LIMIT.value),
+            rate_limit_max_wait=get_float_env(ChatBotServerEnv.RATE_LIMIT_MAX_WAIT.value))
+        for target in self.provider_pool.targets:
+            logging.info("Chatbot Server target: %s (%s)" % (target, target.rate_limiter))
 
         self.model_name = model_name if model_name is not None else os.environ.get(ChatBotServerEnv.MODEL_NAME.value)
         if self.model_name is not None:
@@ -83,6 +146,33 @@ class ChatBotClientBuilder:
             self.preset_system_prompt = os.environ.get(ChatBotServerEnv.PRESET_SYSTEM_PROMPT.value)
             logging.info("Chatbot Server use a preset system prompt: %s ..." % self.preset_system_prompt[:20])
 
+        self.stream_deadlines = stream_deadlines
+        if self.stream_deadlines is None:
+            self.stream_deadlines = StreamDeadlines(
+                connect_timeout=get_float_env(ChatBotServerEnv.CONNECT_TIMEOUT.value),
+                first_token_timeout=get_float_env(ChatBotServerEnv.FIRST_TOKEN_TIMEOUT.value),
+                idle_timeout=get_float_env(ChatBotServerEnv.IDLE_TIMEOUT.value))
+        logging.info("Chatbot Server deadlines: %s" % self.stream_deadlines)
+
+        # Opt-in: a stream whose first token is late gets a duplicate request on another target.
+        self.hedging_policy = None
+        if is_true(os.getenv(ChatBotServerEnv.ENABLE_HEDGING.value)):
+            self.hedging_policy = HedgingPolicy(
+                percentile=get_float_env(ChatBotServerEnv.HEDGING_PERCENTILE.value, 95.0),
+                budget_ratio=get_float_env(ChatBotServerEnv.HEDGING_BUDGET_RATIO.value, 0.1),
+                min_delay=get_float_env(ChatBotServerEnv.HEDGING_MIN_DELAY.value, 0.5),
+                max_delay=get_float_env(ChatBotServerEnv.HEDGING_MAX_DELAY.value, 10.0))
+            logging.info("Chatbot Server hedged requests enabled: %s" % self.hedging_policy)
+
+        # Anthropic prompt caching of the system prompt and large documents (enabled unless set to false).
+        self.enable_prompt_caching = (os.getenv(ChatBotServerEnv.ENABLE_PROMPT_CACHING.value) is None
+                                      or is_true(os.getenv(ChatBotServerEnv.ENABLE_PROMPT_CACHING.value)))
+
+        # Append the chunks of every reply, with their arrival times, to a file that can be replayed later.
+        self.record_path = os.getenv(ChatBotServerEnv.RECORD_PATH.value)
+        if self.record_path is not None and self.recordings is None:
+            logging.info("Chatbot Server replies recorded to %s" % self.record_path)
+
 
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
@@ -8,7 +8,10 @@ import dashscope
 from dashscope.api_entities.dashscope_response import MultiModalConversationResponse
 
 from components.ai_side.chatbot_client import ChatBotClient, ChatMessage, TokenUsage, ChatBotServerType, ImageBlock, \
-    DisabledMultiModalConversation
+    DisabledMultiModalConversation, CancellationToken, ProviderUnavailableException
+from components.ai_side.hedging import HedgingPolicy
+from components.ai_side.provider_pool import ProviderPool, ProviderTarget
+from components.ai_side.stream_watchdog import StreamDeadlines
 
 
 class DashscopeChatBotClient(ChatBotClient):
@@ -35,14 +38,22 @@ class DashscopeChatBotClient(ChatBotClient):
                  model_name: str = None,
                  preset_system_prompt: str = None,
                  enable_streaming: bool = None,
-                 enable_multimodal: bool = None):
-        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal)
+                 enable_multimodal: bool = None,
+                 stream_deadlines: StreamDeadlines = None,
+                 provider_pool: ProviderPool = None,
+                 hedging_policy: HedgingPolicy = None):
+        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal,
+                         stream_deadlines, provider_pool, hedging_policy)
 
         if self.base_url is not None:
             logging.warning("The Dashscope ChatBot Client is currently unable "
                             "to accommodate the customization of the base URL.")
 
-    def completions(self, messages: List[ChatMessage], system: str = None) -> tuple[Iterable[str], TokenUsage]:
+    def _create_completions(self, target: ProviderTarget, messages: List[ChatMessage], system: str = None,
+                            cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage]:
+        # Dashscope replies at once, a cancelled request is only checked before it is sent.
+        if cancellation_token is not None:
+            cancellation_token.raise_if_cancelled()
         chat_messages = [{
             "role": "system",
             "content": [
@@ -71,7 +82,7 @@ class DashscopeChatBotClient(ChatBotClient):
                     "content": contents
                 })
 
-        response: MultiModalConversationResponse = dashscope.MultiModalConversation.call(api_key=self.api_key,
+        response: MultiModalConversationResponse = dashscope.MultiModalConversation.call(api_key=target.api_key,
                                                                                          model=self.chat_model_name,
                                                                                          messages=chat_messages)
 
@@ -85,6 +96,8 @@ class DashscopeChatBotClient(ChatBotClient):
                            output_tokens=response.usage.output_tokens,
                            image_tokens=response.usage.image_tokens if 'image_tokens' in response.usage else 0)
             )
+        elif response.status_code == HTTPStatus.TOO_MANY_REQUESTS or response.status_code >= 500:
+            raise ProviderUnavailableException("Error while call dashscope :" + json.dumps(response, ensure_ascii=False))
         else:
             raise RuntimeError("Error while call dashscope :" + json.dumps(response, ensure_ascii=False))
 
@@ -0,0 +1,67 @@
+import math
+import threading
+from collections import deque
+
+
+class HedgingPolicy:
+    """
+    Decides when a duplicate (hedge) request is sent for a stream whose first token is late, shared by all workers.
+    The delay is a percentile of the recently observed time to first token, so only the slow tail gets hedged.
+    The budget caps the extra spend: every request earns `budget_ratio` of a hedge, a hedge costs one.
+    """
+
+    MIN_SAMPLES = 20
+    MAX_BUDGET = 10.0
+
+    def __init__(self,
+                 percentile: float = 95.0,
+                 budget_ratio: float = 0.1,
+                 min_delay: float = 0.5,
+                 max_delay: float = 10.0,
+                 initial_delay: float = 3.0,
+                 window: int = 200):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._budget = 1.0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, time_to_first_token: float) -> None:
+        with self._lock:
+            self._samples.append(time_to_first_token)
+
+    def delay(self) -> float:
+        with self._lock:
+            if len(self._samples) < self.MIN_SAMPLES:
+                delay = self.initial_delay
+            else:
+                ordered = sorted(self._samples)
+                index = min(len(ordered) - 1, max(0, math.ceil(len(ordered) * self.percentile / 100.0) - 1))
+                delay = ordered[index]
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def on_request(self) -> None:
+        with self._lock:
+            self._budget = min(self.MAX_BUDGET, self._budget + self.budget_ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._budget < 1.0:
+                return False
+            self._budget -= 1.0
+            self.hedges += 1
+            return True
+
+    def on_hedge_won(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+    def __str__(self):
+        return "p%g of time to first token in [%.1f, %.1f] s, budget %.0f%% of requests" % (
+            self.percentile, self.min_delay, self.max_delay, self.budget_ratio * 100)
@@ -0,0 +1,116 @@
+import logging
+import os
+import re
+from enum import Enum
+from typing import List, Optional
+
+from components.ai_side.chatbot_client import ChatBotClient, ChatMessage, ImageBlock
+from components.tools import get_float_env
+
+
+class ModelRouterEnv(Enum):
+    FAST_MODEL = "MODEL_ROUTER_FAST_MODEL"
+    MAX_FAST_TOKENS = "MODEL_ROUTER_MAX_FAST_TOKENS"
+    HARD_KEYWORDS = "MODEL_ROUTER_HARD_KEYWORDS"
+    FAST_KEYWORDS = "MODEL_ROUTER_FAST_KEYWORDS"
+
+
+def _keywords(value: str) -> List[str]:
+    return [keyword.strip().lower() for keyword in value.split(',') if keyword.strip()]
+
+
+def _contains(text: str, keyword: str) -> bool:
+    # Latin keywords are whole words ("hi" is not in "this"), others anywhere.
+    if keyword.isascii():
+        return re.search(r"\b" + re.escape(keyword) + r"\b", text) is not None
+    return keyword in text
+
+
+class RoutingDecision:
+    def __init__(self, tier: str, model_name: str, prompt_tokens: int, reasons: List[str]):
+        self.tier = tier
+        self.model_name = model_name
+        self.prompt_tokens = prompt_tokens
+        self.reasons = reasons
+
+    def __str__(self):
+        return "%s model %s (prompt tokens ~%d, %s)" % (self.tier, self.model_name, self.prompt_tokens,
+                                                        ", ".join(self.reasons))
+
+
+class ModelRouter:
+    """
+    Sends easy requests to a fast model and hard ones to the flagship (CHATBOT_SERVER_CHAT_MODEL),
+    from cheap local features of the request:
+    images, code, uploaded files and hard keywords need the flagship, short prompts go fast,
+    and so do short questions with a fast keyword (thanks ...) whatever the length of the conversation.
+    """
+
+    FAST = "fast"
+    FLAGSHIP = "flagship"
+
+    DEFAULT_MAX_FAST_TOKENS = 200
+    DEFAULT_HARD_KEYWORDS = "代码,程序,报错,算法,证明,推导,分析,优化,code,debug,error,algorithm,prove,analyze,optimize"
+    DEFAULT_FAST_KEYWORDS = "谢谢,你好,好的,thanks,thank you,hello,hi"
+
+    def __init__(self,
+                 fast_model: str,
+                 max_fast_tokens: int = DEFAULT_MAX_FAST_TOKENS,
+                 hard_keywords: str = DEFAULT_HARD_KEYWORDS,
+                 fast_keywords: str = DEFAULT_FAST_KEYWORDS):
+        """
+        :param max_fast_tokens: longer prompts (conversation history included) go to the flagship
+        :param hard_keywords: comma separated, case insensitive
+        :param fast_keywords: comma separated, case insensitive
+        """
+        self.fast_model = fast_model
+        self.max_fast_tokens = max_fast_tokens
+        self.hard_keywords = _keywords(hard_keywords)
+        self.fast_keywords = _keywords(fast_keywords)
+
+    @staticmethod
+    def from_env() -> Optional['ModelRouter']:
+        fast_model = os.getenv(ModelRouterEnv.FAST_MODEL.value)
+        if fast_model is None:
+            return None
+        router = ModelRouter(
+            fast_model,
+            max_fast_tokens=int(get_float_env(ModelRouterEnv.MAX_FAST_TOKENS.value,
+                                              ModelRouter.DEFAULT_MAX_FAST_TOKENS)),
+            hard_keywords=os.getenv(ModelRouterEnv.HARD_KEYWORDS.value, ModelRouter.DEFAULT_HARD_KEYWORDS),
+            fast_keywords=os.getenv(ModelRouterEnv.FAST_KEYWORDS.value, ModelRouter.DEFAULT_FAST_KEYWORDS))
+        logging.info("Model routing enabled: fast model %s up to %d prompt tokens."
+                     % (router.fast_model, router.max_fast_tokens))
+        return router
+
+    def route(self, chatbot_client: ChatBotClient, messages: List[ChatMessage], question: str,
+              uploaded_file: bool = False) -> RoutingDecision:
+        """
+        :param chatbot_client: calls the flagship model
+        :param messages: the whole prompt
+        :param question: text of the new message
+        :param uploaded_file: the question is the content of an uploaded file
+        """
+        prompt_tokens = chatbot_client.estimate_prompt_tokens(messages, system="")
+        text = question.lower()
+
+        reasons = []
+        if any(isinstance(block, ImageBlock) for message in messages if not isinstance(message.content, str)
+               for block in message.content):
+            reasons.append("image")
+        if "```" in question:
+            reasons.append("code")
+        if uploaded_file:
+            reasons.append("file")
+        reasons.extend("keyword:" + keyword for keyword in self.hard_keywords if _contains(text, keyword))
+        if len(reasons) > 0:
+            return RoutingDecision(self.FLAGSHIP, chatbot_client.chat_model_name, prompt_tokens, reasons)
+
+        if chatbot_client.estimate_tokens(question) <= self.max_fast_tokens:
+            reasons = ["keyword:" + keyword for keyword in self.fast_keywords if _contains(text, keyword)]
+            if len(reasons) > 0:
+                return RoutingDecision(self.FAST, self.fast_model, prompt_tokens, reasons)
+        if prompt_tokens > self.max_fast_tokens:
+            return RoutingDecision(self.FLAGSHIP, chatbot_client.chat_model_name, prompt_tokens,
+                                   ["tokens>%d" % self.max_fast_tokens])
+        return RoutingDecision(self.FAST, self.fast_model, prompt_tokens, ["short"])
@@ -8,7 +8,10 @@ from openai.types.chat import ChatCompletionMessageParam, ChatCompletionSystemMe
     ChatCompletionUserMessageParam, ChatCompletionAssistantMessageParam, ChatCompletionChunk
 
 from components.ai_side.chatbot_client import ChatMessage, ChatBotServerType, ChatBotClient, TokenUsage, \
-    ContextLengthExceededException, UnsupportedMultiModalMessageError
+    ContextLengthExceededException, UnsupportedMultiModalMessageError, CancellationToken, CancellableStream
+from components.ai_side.hedging import HedgingPolicy
+from components.ai_side.provider_pool import ProviderPool, ProviderTarget
+from components.ai_side.stream_watchdog import StreamDeadlines
 
 
 def _build_messages(messages: List[ChatMessage], system: str = None) -> Iterable[ChatCompletionMessageParam]:
@@ -39,7 +42,6 @@ class OpenaiChatBotClient(ChatBotClient):
         return False
 
     DEFAULT_SYSTEM_PROMPT = ("You are a helpful assistant. "
-                             "You and the user's conversation is only one round."
                              "Answer in Chinese unless specified otherwise.")
 
     DEFAULT_MODEL_NAME = "gpt-3.5-turbo"
@@ -51,10 +53,12 @@ class OpenaiChatBotClient(ChatBotClient):
                  preset_system_prompt: str,
                  enable_streaming: bool,
                  enable_multimodal: bool,
+                 stream_deadlines: StreamDeadlines = None,
+                 provider_pool: ProviderPool = None,
+                 hedging_policy: HedgingPolicy = None,
                  tiktoken_encoding_tokens_model='gpt-4'):
-        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal)
-
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        super().__init__(api_key, base_url, model_name, preset_system_prompt, enable_streaming, enable_multimodal,
+                         stream_deadlines, provider_pool, hedging_policy)
 
         # cl100k_base       |	gpt-4, gpt-3.5-turbo, text-embedding-ada-002
         # p50k_base	        | Codex models, text-davinci-002, text-davinci-003
@@ -66,7 +70,22 @@ class OpenaiChatBotClient(ChatBotClient):
     def server_type(self) -> ChatBotServerType:
         return ChatBotServerType.OpenAI
 
-    def completions(self, messages: List[ChatMessage], system: str = None):
+    def _create_sdk_client(self, target: ProviderTarget) -> OpenAI:
+        timeout = (self.stream_deadlines or StreamDeadlines()).http_timeout(self.enable_streaming)
+        client = OpenAI(api_key=target.api_key, base_url=target.base_url, timeout=timeout,
+                        http_client=self._http_client(target, timeout))
+        if len(self.provider_pool) > 1:
+            # with other targets to fail over to, do not insist on a failing one
+            client = client.with_options(max_retries=0)
+        return client
+
+    def _is_retryable_error(self, e: Exception) -> bool:
+        return super()._is_retryable_error(e) or isinstance(e, (openai.APIConnectionError,
+                                                                openai.RateLimitError,
+                                                                openai.InternalServerError))
+
+    def _create_completions(self, target: ProviderTarget, messages: List[ChatMessage], system: str = None,
+                            cancellation_token: CancellationToken = None):
         # messages = [
         #     {
         #         "role": "user",
@@ -75,11 +94,13 @@ class OpenaiChatBotClient(ChatBotClient):
         # ]
         openai_messages = _build_messages(messages, system if system is not None else self.preset_system_prompt)
         try:
-            response = self.client.chat.completions.create(
+            raw_response = self._sdk_client(target).chat.completions.with_raw_response.create(
                 model=self.model_name,
                 messages=openai_messages,
                 stream=self.enable_streaming
             )
+            target.rate_limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
             if not self.enable_streaming:
                 return (
                     [response.choices[0].message.content],
@@ -92,13 +113,20 @@ class OpenaiChatBotClient(ChatBotClient):
                     input_tokens=self._num_tokens_from_messages(openai_messages),
                     output_tokens=0, image_tokens=0
                 )
-                return IterableMessageChunk(response, token_usage, self), token_usage
+                stream = IterableMessageChunk(response, token_usage, self).bind(cancellation_token)
+                return self._watch(stream), token_usage
+        except openai.RateLimitError as e:
+            target.rate_limiter.update_from_headers(e.response.headers, e.status_code)
+            raise e
         except openai.BadRequestError as e:
             if e.code == 'context_length_exceeded':
                 raise ContextLengthExceededException(e.args)
             else:
                 raise e
 
+    def estimate_tokens(self, text: str) -> int:
+        return self.num_tokens_from_string(text)
+
     def num_tokens_from_string(self, string) -> int:
         """Return the number of tokens used by a string."""
         if string is None:
@@ -143,17 +171,17 @@ class OpenaiChatBotClient(ChatBotClient):
         return num_tokens
 
 
-class IterableMessageChunk:
+class IterableMessageChunk(CancellableStream):
     def __init__(self, chunks: Stream[ChatCompletionChunk], token_usage: TokenUsage,
                  chatbot_client: OpenaiChatBotClient):
+        super().__init__(token_usage)
         self.chunks = chunks
-        self.token_usage = token_usage
         self.chatbot_client = chatbot_client
 
-    def __iter__(self):
-        return self
+    def _close(self) -> None:
+        self.chunks.close()
 
-    def __next__(self):
+    def _next_chunk(self):
         try:
             chunk = self.chunks.__next__()
             chunk_content = chunk.choices[0].delta.content
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import List
+
+from components.ai_side.rate_limiter import RateLimiter
+
+
+def _mask_api_key(api_key: str) -> str:
+    if api_key is None:
+        return "None"
+    return api_key[:6] + "..." + api_key[-4:] if len(api_key) > 12 else "***"
+
+
+class ProviderTarget:
+    """
+    One (api key, base url) pair of a provider, with the passive health statistics collected from real traffic.
+    """
+
+    def __init__(self, api_key: str, base_url: str = None, rate_limiter: RateLimiter = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        # Targets sharing an api key share its rate limiter.
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+
+        self.outstanding = 0  # requests sent and not finished yet
+        self.latency_ewma: float = None  # time to first token (or to the whole reply when not streaming)
+        self.outcomes = deque()  # (time.monotonic(), failed) within ProviderPool.ERROR_RATE_WINDOW
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return "%s@%s" % (_mask_api_key(self.api_key), self.base_url if self.base_url is not None else "default")
+
+    def error_rate(self) -> float:
+        if len(self.outcomes) == 0:
+            return 0.0
+        return sum(1 for _, failed in self.outcomes if failed) / len(self.outcomes)
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def __str__(self):
+        return self.name
+
+
+class ProviderPool:
+    """
+    Balances requests over the targets of a provider, shared by all workers.
+    The target with the least outstanding requests is chosen (ties broken by latency).
+    A target failing repeatedly, or with a high error rate, is ejected for a while, growing exponentially.
+    """
+
+    LATENCY_EWMA_ALPHA = 0.2
+    ERROR_RATE_WINDOW = 60.0
+    ERROR_RATE_MIN_REQUESTS = 5
+    EJECT_ERROR_RATE = 0.5
+    EJECT_CONSECUTIVE_FAILURES = 3
+    EJECT_BASE_SECONDS = 10.0
+    EJECT_MAX_SECONDS = 300.0
+    DEFAULT_MAX_ATTEMPTS = 3
+    DEFAULT_RATE_LIMIT_MAX_WAIT = 10.0
+
+    def __init__(self, targets: List[ProviderTarget], max_attempts: int = None, rate_limit_max_wait: float = None):
+        if len(targets) == 0:
+            raise ValueError("A provider pool needs at least one target.")
+        self.targets = targets
+        self.max_attempts = max_attempts if max_attempts is not None else self.DEFAULT_MAX_ATTEMPTS
+        # How long a worker waits for rate limit budget before giving up the request.
+        self.rate_limit_max_wait = rate_limit_max_wait if rate_limit_max_wait is not None \
+            else self.DEFAULT_RATE_LIMIT_MAX_WAIT
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(api_keys: str,
+                    base_urls: str = None,
+                    max_attempts: int = None,
+                    requests_per_minute: float = None,
+                    tokens_per_minute: float = None,
+                    rate_limit_max_wait: float = None) -> 'ProviderPool':
+        """
+        Build a pool from comma separated keys and base urls.
+        The same number of keys and urls are paired one by one, a single key or url is shared by all the others.
+        requests_per_minute and tokens_per_minute are the client side limits of each key.
+        """
+        keys = [key.strip() for key in api_keys.split(',') if key.strip()] if api_keys is not None else [None]
+        urls = [url.strip() for url in base_urls.split(',') if url.strip()] if base_urls is not None else [None]
+        if len(keys) == len(urls):
+            pairs = list(zip(keys, urls))
+        elif len(urls) == 1:
+            pairs = [(key, urls[0]) for key in keys]
+        elif len(keys) == 1:
+            pairs = [(keys[0], url) for url in urls]
+        else:
+            pairs = [(key, url) for key in keys for url in urls]
+        rate_limiters = {key: RateLimiter(requests_per_minute, tokens_per_minute) for key, _ in pairs}
+        return ProviderPool([ProviderTarget(key, url, rate_limiters[key]) for key, url in pairs],
+                            max_attempts, rate_limit_max_wait)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def acquire(self, exclude: List[ProviderTarget] = None, estimated_tokens: int = 0) -> ProviderTarget:
+        """
+        Choose a target for a new request and count it as outstanding.
+        Targets with rate limit budget for the request come first.
+        When every candidate is ejected, the one coming back first is used rather than failing the request.
+        """
+        exclude = exclude if exclude is not None else []
+        with self._lock:
+            now = time.monotonic()
+            candidates = [target for target in self.targets if target not in exclude]
+            if len(candidates) == 0:
+                candidates = list(self.targets)
+            healthy = [target for target in candidates if not target.is_ejected(now)]
+            if len(healthy) > 0:
+                target = min(healthy, key=lambda t: (t.rate_limiter.wait_time(estimated_tokens),
+                                                     t.outstanding,
+                                                     t.latency_ewma if t.latency_ewma is not None else 0.0))
+            else:
+                target = min(candidates, key=lambda t: t.ejected_until)
+            target.outstanding += 1
+            return target
+
+    def has_alternative(self, exclude: List[ProviderTarget]) -> bool:
+        return any(target not in exclude for target in self.targets)
+
+    def observe_latency(self, target: ProviderTarget, seconds: float) -> None:
+        with self._lock:
+            if target.latency_ewma is None:
+                target.latency_ewma = seconds
+            else:
+                target.latency_ewma += self.LATENCY_EWMA_ALPHA * (seconds - target.latency_ewma)
+
+    def release(self, target: ProviderTarget, failed: bool = False) -> None:
+        """
+        Finish a request acquired before, failed means the target itself is to blame (connection, 429, 5xx, stall).
+        """
+        with self._lock:
+            now = time.monotonic()
+            target.outstanding = max(0, target.outstanding - 1)
+            target.outcomes.append((now, failed))
+            while len(target.outcomes) > 0 and target.outcomes[0][0] < now - self.ERROR_RATE_WINDOW:
+                target.outcomes.popleft()
+
+            if not failed:
+                target.consecutive_failures = 0
+                if not target.is_ejected(now):
+                    target.ejections = 0
+                return
+
+            target.consecutive_failures += 1
+            if target.is_ejected(now) or len(self.targets) == 1:
+                return
+            if (target.consecutive_failures >= self.EJECT_CONSECUTIVE_FAILURES
+                    or (len(target.outcomes) >= self.ERROR_RATE_MIN_REQUESTS
+                        and target.error_rate() >= self.EJECT_ERROR_RATE)):
+                duration = min(self.EJECT_BASE_SECONDS * (2 ** target.ejections), self.EJECT_MAX_SECONDS)
+                target.ejected_until = now + duration
+                target.ejections += 1
+                logging.warning("Chatbot server target %s ejected for %.0f s "
+                                "(consecutive failures: %d, error rate: %.2f)."
+                                % (target, duration, target.consecutive_failures, target.error_rate()))
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "target": target.name,
+                "outstanding": target.outstanding,
+                "latency_ewma": target.latency_ewma,
+                "error_rate": target.error_rate(),
+                "ejected": target.is_ejected(now),
+            } for target in self.targets]
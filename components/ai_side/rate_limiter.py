@@ -0,0 +1,190 @@
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Mapping
+
+
+class RateLimitedException(Exception):
+    pass
+
+
+def _parse_reset_seconds(value: str) -> float:
+    """
+    Parse a rate limit reset header into seconds from now.
+    OpenAI uses durations like "1s", "6m0s" or "20ms", Anthropic uses RFC 3339 timestamps.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    durations = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if len(durations) > 0 and ''.join(number + unit for number, unit in durations) == value:
+        units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+        return sum(float(number) * units[unit] for number, unit in durations)
+    try:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(0.0, reset_at.timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+def _header_float(headers: Mapping[str, str], *names: str) -> float:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return None
+
+
+class TokenBucket:
+    """
+    Refills continuously up to its capacity. The level may go negative when actual usage exceeds the estimate,
+    later requests then wait until the debt is paid back.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # A request larger than the whole bucket only waits for a full bucket.
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= amount
+
+    def limit_level(self, level: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.level, level)
+
+    def resize(self, capacity: float, now: float) -> None:
+        self._refill(now)
+        self.capacity = capacity
+        self.refill_per_second = capacity / 60.0
+        self.level = min(self.level, capacity)
+
+
+class RateLimiter:
+    """
+    Client side requests-per-minute and tokens-per-minute budget of one API key, shared by all workers.
+    The token budget is taken from a pre-flight estimate of the prompt and reconciled with the actual usage.
+    Rate limit headers of the responses correct the buckets, so the local view follows the server's one.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0) \
+            if requests_per_minute is not None else None
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0) \
+            if tokens_per_minute is not None else None
+        self.blocked_until = 0.0
+
+    def wait_time(self, estimated_tokens: int) -> float:
+        with self._lock:
+            return self._wait_time(estimated_tokens, time.monotonic())
+
+    def _wait_time(self, estimated_tokens: int, now: float) -> float:
+        wait = max(0.0, self.blocked_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(estimated_tokens, now))
+        return wait
+
+    def acquire(self, estimated_tokens: int, max_wait: float, cancellation_token=None) -> None:
+        """
+        Wait for enough budget, then take it.
+        :raise RateLimitedException: when the budget will not be available within max_wait seconds
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(estimated_tokens, now)
+                if wait <= 0:
+                    if self.requests is not None:
+                        self.requests.consume(1, now)
+                    if self.tokens is not None:
+                        self.tokens.consume(estimated_tokens, now)
+                    return
+            if now + wait > deadline:
+                raise RateLimitedException("Rate limit budget is not available within %.1f s "
+                                           "(need to wait %.1f s)." % (max_wait, wait))
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+            time.sleep(min(wait, 0.5))
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        if self.tokens is None:
+            return
+        with self._lock:
+            self.tokens.consume(actual_tokens - estimated_tokens, time.monotonic())
+
+    def update_from_headers(self, headers: Mapping[str, str], status_code: int = None) -> None:
+        """
+        Follow the rate limit headers of OpenAI (x-ratelimit-*) and Anthropic (anthropic-ratelimit-*),
+        a 429 blocks the key until retry-after.
+        """
+        if headers is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+
+            requests_limit = _header_float(headers, 'x-ratelimit-limit-requests',
+                                           'anthropic-ratelimit-requests-limit')
+            requests_remaining = _header_float(headers, 'x-ratelimit-remaining-requests',
+                                               'anthropic-ratelimit-requests-remaining')
+            tokens_limit = _header_float(headers, 'x-ratelimit-limit-tokens', 'anthropic-ratelimit-tokens-limit')
+            tokens_remaining = _header_float(headers, 'x-ratelimit-remaining-tokens',
+                                             'anthropic-ratelimit-tokens-remaining')
+
+            if requests_limit is not None:
+                if self.requests is None:
+                    self.requests = TokenBucket(requests_limit, requests_limit / 60.0)
+                elif self.requests.capacity != requests_limit:
+                    self.requests.resize(requests_limit, now)
+            if requests_remaining is not None and self.requests is not None:
+                self.requests.limit_level(requests_remaining, now)
+
+            if tokens_limit is not None:
+                if self.tokens is None:
+                    self.tokens = TokenBucket(tokens_limit, tokens_limit / 60.0)
+                elif self.tokens.capacity != tokens_limit:
+                    self.tokens.resize(tokens_limit, now)
+            if tokens_remaining is not None and self.tokens is not None:
+                self.tokens.limit_level(tokens_remaining, now)
+
+            if status_code == 429:
+                retry_after = _parse_reset_seconds(headers.get('retry-after'))
+                if retry_after is None:
+                    retry_after = max([seconds for seconds in (
+                        _parse_reset_seconds(headers.get('x-ratelimit-reset-requests')),
+                        _parse_reset_seconds(headers.get('x-ratelimit-reset-tokens')),
+                        _parse_reset_seconds(headers.get('anthropic-ratelimit-requests-reset')),
+                        _parse_reset_seconds(headers.get('anthropic-ratelimit-tokens-reset')),
+                    ) if seconds is not None], default=1.0)
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                logging.warning("Rate limited by chatbot server, key blocked for %.1f s." % retry_after)
+
+    def __str__(self):
+        return "rpm: %s, tpm: %s" % (self.requests.capacity if self.requests is not None else None,
+                                     self.tokens.capacity if self.tokens is not None else None)
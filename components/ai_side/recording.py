@@ -0,0 +1,317 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Iterable, List, Optional, Dict, Any
+
+from components.ai_side.chatbot_client import ChatBotClient, ChatBotServerType, ChatMessage, TokenUsage, \
+    CancellableStream, CancellationToken, CompletionCancelledException
+from components.ai_side.provider_pool import ProviderTarget
+from components.response_cache import response_cache_key
+
+# One JSON line per request:
+# {"at": 1700000000.0, "provider": "openai", "model": "gpt-4", "streaming": true, "key": "<response_cache_key>",
+#  "gaps": [812.4, 31.0, ...], "chunks": ["Hel", "lo", ...], "tail": 2.1, "usage": {...}, "error": null}
+# gaps are the milliseconds before each chunk: the first one since the request was sent, then since the previous chunk.
+# tail is the milliseconds from the last chunk to the end of the reply.
+
+
+class RecordedErrorException(Exception):
+    """
+    Replay of a request that failed when it was recorded.
+    """
+    pass
+
+
+class _RecordWriter:
+    """
+    Appends the records of every worker to one file, a line at a time.
+    """
+
+    _writers: Dict[str, '_RecordWriter'] = {}
+    _writers_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def of(path: str) -> '_RecordWriter':
+        with _RecordWriter._writers_lock:
+            writer = _RecordWriter._writers.get(path)
+            if writer is None:
+                writer = _RecordWriter(path)
+                _RecordWriter._writers[path] = writer
+            return writer
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+def _milliseconds(seconds: float) -> float:
+    return round(max(0.0, seconds) * 1000, 1)
+
+
+def _read_ahead(stream: CancellableStream) -> Iterable[tuple[Optional[str], float]]:
+    """
+    Read the stream in a thread, yielding each chunk with its arrival time (time.monotonic), then (None, end time).
+    """
+    arrivals = queue.Queue()
+
+    def read():
+        try:
+            for chunk in stream:
+                arrivals.put((chunk, time.monotonic(), None))
+            arrivals.put((None, time.monotonic(), None))
+        except Exception as e:
+            arrivals.put((None, time.monotonic(), e))
+
+    threading.Thread(target=read, name="RecordingReader", daemon=True).start()
+    while True:
+        chunk, arrived_at, error = arrivals.get()
+        if error is not None:
+            raise error
+        yield chunk, arrived_at
+        if chunk is None:
+            return
+
+
+class RecordingChatBotClient:
+    """
+    Wraps a chatbot client and records the chunks of each reply with their arrival times,
+    everything else is delegated to the wrapped client.
+    """
+
+    def __init__(self, client: ChatBotClient, path: str):
+        self.client = client
+        self.path = path
+        self._writer = _RecordWriter.of(path)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def with_model(self, model_name: str) -> 'RecordingChatBotClient':
+        client = self.client.with_model(model_name)
+        return self if client is self.client else RecordingChatBotClient(client, self.path)
+
+    def completions(self,
+                    messages: List[ChatMessage],
+                    system: str = None,
+                    cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage]:
+        record = {"at": round(time.time(), 3), "provider": self.client.server_type.value,
+                  "model": self.client.chat_model_name, "streaming": bool(self.client.enable_streaming),
+                  "key": self._key(messages, system), "gaps": [], "chunks": [], "tail": 0.0, "usage": None,
+                  "error": None}
+        sent_at = time.monotonic()
+        try:
+            reply, usage = self.client.completions(messages, system, cancellation_token)
+        except Exception as e:
+            record["tail"] = _milliseconds(time.monotonic() - sent_at)
+            record["error"] = "%s: %s" % (type(e).__name__, e)
+            self._writer.write(record)
+            raise e
+        return self._record(reply, usage, record, sent_at, time.monotonic()), usage
+
+    def _key(self, messages: List[ChatMessage], system: str) -> Optional[str]:
+        try:
+            return response_cache_key(self.client.chat_model_name,
+                                      system if system is not None else self.client.preset_system_prompt, messages)
+        except Exception as e:
+            logging.warning("Failed to compute the key of a recorded request: %s" % e)
+            return None
+
+    def _record(self, reply: Iterable[str], usage: TokenUsage, record: Dict[str, Any], sent_at: float,
+                returned_at: float) -> Iterable[str]:
+        # A stream is read as it arrives, so the gaps are the ones of the chatbot server and not the time this bot
+        # spends sending each chunk. The chunks of any other reply all arrived when it was returned.
+        arrivals = _read_ahead(reply) if isinstance(reply, CancellableStream) \
+            else itertools.chain(((chunk, returned_at) for chunk in reply), [(None, returned_at)])
+        previous_at = ended_at = sent_at
+        try:
+            for chunk, arrived_at in arrivals:
+                if chunk is None:
+                    ended_at = arrived_at
+                    break
+                record["gaps"].append(_milliseconds(arrived_at - previous_at))
+                record["chunks"].append(chunk)
+                previous_at = ended_at = arrived_at
+                yield chunk
+        except GeneratorExit:
+            record["error"] = "abandoned"
+            if isinstance(reply, CancellableStream):
+                reply.cancel()
+            raise
+        except Exception as e:
+            record["error"] = "%s: %s" % (type(e).__name__, e)
+            ended_at = time.monotonic()
+            raise e
+        finally:
+            record["tail"] = _milliseconds(ended_at - previous_at) if len(record["chunks"]) > 0 \
+                else _milliseconds(returned_at - sent_at)
+            record["usage"] = usage.dict()
+            try:
+                self._writer.write(record)
+            except Exception as e:
+                logging.error("Failed to record a reply: %s" % e)
+
+    def __str__(self):
+        return "%s recorded to %s" % (self.client, self.path)
+
+
+class Recordings:
+    """
+    Records loaded from files, complete ones only: cancelled or abandoned replies are skipped.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.records = [record for record in records if record.get("error") is None
+                        or not (record["error"] == "abandoned"
+                                or record["error"].startswith(CompletionCancelledException.__name__))]
+        if len(self.records) == 0:
+            raise SystemError("No complete reply in the recordings.")
+        self._by_key: Dict[str, List[Dict[str, Any]]] = {}
+        for record in self.records:
+            if record.get("key") is not None:
+                self._by_key.setdefault(record["key"], []).append(record)
+        self._cursor = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(paths: str) -> 'Recordings':
+        """
+        :param paths: comma separated record files
+        """
+        records = []
+        for path in [path.strip() for path in paths.split(",") if path.strip()]:
+            with open(path, encoding="utf-8") as file:
+                records.extend(json.loads(line) for line in file if len(line.strip()) > 0)
+        return Recordings(records)
+
+    def pick(self, key: str) -> Dict[str, Any]:
+        """
+        A record of the same request if any (in turn when there are several), otherwise the next record in order.
+        """
+        with self._lock:
+            candidates = self._by_key.get(key)
+            if candidates is None:
+                candidates = self.records
+            return candidates[next(self._cursor) % len(candidates)]
+
+
+class _ReplayStream(CancellableStream):
+    def __init__(self, record: Dict[str, Any], usage: TokenUsage, sent_at: float, speed: float, client: ChatBotClient):
+        super().__init__(usage)
+        self._record = record
+        self._sent_at = sent_at
+        self._speed = speed
+        self._client = client
+        self._offset = 0.0  # milliseconds since the request was sent
+        self._index = 0
+        self._closed = threading.Event()
+
+    def _wait(self, milliseconds: float) -> None:
+        self._offset += milliseconds
+        if self._speed > 0:
+            # On the recorded schedule, a slow consumer finds the chunks already there like with a real server.
+            self._closed.wait(max(0.0, self._sent_at + self._offset / 1000 / self._speed - time.monotonic()))
+        if self._closed.is_set():
+            raise CompletionCancelledException()
+
+    def _next_chunk(self) -> str:
+        if self._index < len(self._record["chunks"]):
+            self._wait(self._record["gaps"][self._index])
+            chunk = self._record["chunks"][self._index]
+            self._index += 1
+            self.token_usage.output_tokens += self._client.estimate_tokens(chunk)
+            return chunk
+        self._wait(self._record["tail"])
+        _set_usage(self.token_usage, self._record)
+        if self._record.get("error") is not None:
+            raise RecordedErrorException(self._record["error"])
+        raise StopIteration
+
+    def _close(self) -> None:
+        self._closed.set()
+
+
+def _set_usage(usage: TokenUsage, record: Dict[str, Any]) -> None:
+    if record.get("usage") is not None:
+        for name, value in record["usage"].items():
+            setattr(usage, name, value)
+
+
+class ReplayChatBotClient(ChatBotClient):
+    """
+    Replies with recorded chunks, at the recorded pace divided by `speed` (0: no waiting at all).
+    """
+
+    def __init__(self,
+                 recordings: Recordings,
+                 speed: float = 1.0,
+                 model_name: str = None,
+                 preset_system_prompt: str = None,
+                 enable_streaming: bool = None,
+                 enable_multimodal: bool = None,
+                 chatbot_server_type: ChatBotServerType = None):
+        self.recordings = recordings
+        self.speed = speed
+        self._server_type = chatbot_server_type if chatbot_server_type is not None \
+            else ChatBotServerType(recordings.records[0]["provider"])
+        super().__init__("replay",
+                         model_name=model_name if model_name is not None else recordings.records[0]["model"],
+                         preset_system_prompt=preset_system_prompt,
+                         enable_streaming=enable_streaming,
+                         enable_multimodal=enable_multimodal)
+
+    @property
+    def server_type(self) -> ChatBotServerType:
+        return self._server_type
+
+    @property
+    def supports_streaming_response(self) -> bool:
+        return True
+
+    @property
+    def has_multi_modal_ability(self) -> bool:
+        return True
+
+    def _create_completions(self,
+                            target: ProviderTarget,
+                            messages: List[ChatMessage],
+                            system: str = None,
+                            cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage]:
+        sent_at = time.monotonic()
+        record = self.recordings.pick(
+            response_cache_key(self.model_name, system if system is not None else self.preset_system_prompt, messages))
+        usage = TokenUsage(input_tokens=0, output_tokens=0, image_tokens=0)
+        if record.get("usage") is not None:
+            usage.input_tokens = record["usage"].get("input_tokens", 0)
+            usage.image_tokens = record["usage"].get("image_tokens", 0)
+            usage.cache_read_tokens = record["usage"].get("cache_read_tokens", 0)
+            usage.cache_write_tokens = record["usage"].get("cache_write_tokens", 0)
+
+        if record["streaming"] and self.enable_streaming:
+            return _ReplayStream(record, usage, sent_at, self.speed, self).bind(cancellation_token), usage
+
+        # The whole reply at once, when its last chunk arrived.
+        stream = _ReplayStream(record, usage, sent_at, self.speed, self).bind(cancellation_token)
+        reply = "".join(stream)
+        return [reply], usage
+
+    def __str__(self):
+        return "replay of %d recorded replies (speed %s)" % (len(self.recordings.records), self.speed)
+
+
+if __name__ == '__main__':
+    recordings_path = os.getenv("CHATBOT_SERVER_REPLAY_PATH", "./recordings.jsonl")
+    client = ReplayChatBotClient(Recordings.load(recordings_path), speed=0)
+    iterable_reply, token_usage = client.completions([ChatMessage(content="Hello", role="user")])
+    print("".join(iterable_reply), token_usage)
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+import httpx
+
+from components.ai_side.chatbot_client import CancellableStream, StreamTimeoutException
+
+
+class StreamDeadlines:
+    """
+    Deadlines of a chatbot server request, in seconds. None disables the corresponding deadline.
+    connect_timeout     | establishing the connection to the chatbot server
+    first_token_timeout | from sending the request to the first non-empty chunk
+    idle_timeout        | waiting for the next chunk once the stream has started (not while the consumer is busy)
+    """
+
+    # Same defaults as the openai and anthropic SDKs.
+    DEFAULT_CONNECT_TIMEOUT = 5.0
+    DEFAULT_READ_TIMEOUT = 600.0
+
+    def __init__(self,
+                 connect_timeout: float = None,
+                 first_token_timeout: float = None,
+                 idle_timeout: float = None):
+        self.connect_timeout = connect_timeout
+        self.first_token_timeout = first_token_timeout
+        self.idle_timeout = idle_timeout
+
+    def http_timeout(self, streaming: bool) -> httpx.Timeout:
+        """
+        Socket level timeouts for the SDK clients, they also bound the wait for the stream to start.
+        A non-streaming reply arrives only when the generation is complete, so its read timeout is left alone.
+        """
+        read_timeout = self.DEFAULT_READ_TIMEOUT
+        if streaming:
+            deadlines = [d for d in (self.first_token_timeout, self.idle_timeout) if d is not None]
+            if len(deadlines) > 0:
+                read_timeout = max(deadlines)
+        connect_timeout = self.connect_timeout if self.connect_timeout is not None else self.DEFAULT_CONNECT_TIMEOUT
+        return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    def watch(self, stream: CancellableStream) -> None:
+        if self.first_token_timeout is None and self.idle_timeout is None:
+            return
+        _WATCHDOG.watch(stream, self)
+
+    def __str__(self):
+        return "connect: %s s, first token: %s s, idle: %s s" % (
+            self.connect_timeout, self.first_token_timeout, self.idle_timeout)
+
+
+class StreamWatchdog:
+    """
+    A single daemon thread checking the progress of all running streams.
+    A stream missing its deadline is cancelled: its response is closed and the consumer gets StreamTimeoutException.
+    """
+
+    CHECK_INTERVAL = 0.25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams: dict[int, tuple[CancellableStream, StreamDeadlines]] = {}
+        self._thread = None
+
+    def watch(self, stream: CancellableStream, deadlines: StreamDeadlines) -> None:
+        with self._lock:
+            self._streams[id(stream)] = (stream, deadlines)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="StreamWatchdog", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            with self._lock:
+                watched = list(self._streams.items())
+            for key, (stream, deadlines) in watched:
+                if stream.finished or stream.cancel_exception is not None:
+                    with self._lock:
+                        self._streams.pop(key, None)
+                    continue
+                timeout = self._check(stream, deadlines, time.monotonic())
+                if timeout is not None:
+                    logging.warning("Stream watchdog aborts chatbot server stream: %s" % timeout)
+                    stream.cancel(timeout)
+                    with self._lock:
+                        self._streams.pop(key, None)
+
+    @staticmethod
+    def _check(stream: CancellableStream, deadlines: StreamDeadlines, now: float) -> StreamTimeoutException:
+        if stream.first_chunk_at is None:
+            elapsed = now - stream.started_at
+            if deadlines.first_token_timeout is not None and elapsed > deadlines.first_token_timeout:
+                return StreamTimeoutException('first_token', elapsed, deadlines.first_token_timeout,
+                                              stream.token_usage)
+            return None
+        waiting_since = stream.waiting_since
+        if waiting_since is None:
+            # the consumer is busy with a chunk (sending it), the chatbot server is not waited for
+            return None
+        idle = now - waiting_since
+        if deadlines.idle_timeout is not None and idle > deadlines.idle_timeout:
+            return StreamTimeoutException('idle', idle, deadlines.idle_timeout, stream.token_usage)
+        return None
+
+
+_WATCHDOG = StreamWatchdog()
@@ -0,0 +1,234 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from enum import Enum
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel
+
+from components.ai_side.chatbot_client import ChatMessage
+from components.tools import is_true, get_float_env
+
+
+class ConversationMemoryEnv(Enum):
+    ENABLE = "CONVERSATION_MEMORY_ENABLE"
+    BACKEND = "CONVERSATION_MEMORY_BACKEND"
+    SQLITE_PATH = "CONVERSATION_MEMORY_SQLITE_PATH"
+    MAX_TOKENS = "CONVERSATION_MEMORY_MAX_TOKENS"
+    TTL = "CONVERSATION_MEMORY_TTL"
+
+
+class ConversationTurn(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+    tokens: int  # counted once when the turn is stored
+    created_at: float
+
+
+def conversation_key(robot_code: str, conversation_id: str, userid: str) -> str:
+    """
+    Each user has a history of their own, in group chats too.
+    """
+    return "%s/%s/%s" % (robot_code, conversation_id, userid)
+
+
+class ConversationMemory(ABC):
+    """
+    Recent turns of each conversation, trimmed to a token budget and forgotten after being idle for a while.
+    """
+
+    DEFAULT_MAX_TOKENS = 4000
+    DEFAULT_TTL = 1800.0
+
+    def __init__(self, max_tokens: int = None, ttl: float = None):
+        self.max_tokens = max_tokens if max_tokens is not None else self.DEFAULT_MAX_TOKENS
+        self.ttl = ttl if ttl is not None else self.DEFAULT_TTL
+
+    @staticmethod
+    def from_env() -> Optional['ConversationMemory']:
+        if not is_true(os.getenv(ConversationMemoryEnv.ENABLE.value)):
+            return None
+        max_tokens = get_float_env(ConversationMemoryEnv.MAX_TOKENS.value)
+        max_tokens = int(max_tokens) if max_tokens is not None else None
+        ttl = get_float_env(ConversationMemoryEnv.TTL.value)
+        backend = os.getenv(ConversationMemoryEnv.BACKEND.value, "memory").strip().lower()
+        if backend == "sqlite":
+            path = os.getenv(ConversationMemoryEnv.SQLITE_PATH.value, SqliteConversationMemory.DEFAULT_PATH)
+            memory = SqliteConversationMemory(path, max_tokens, ttl)
+        elif backend == "memory":
+            memory = InMemoryConversationMemory(max_tokens, ttl)
+        else:
+            raise ValueError("Unsupported conversation memory backend: %s" % backend)
+        logging.info("Conversation memory enabled: %s" % memory)
+        return memory
+
+    @abstractmethod
+    def load(self, key: str) -> List[ConversationTurn]:
+        """
+        :return: turns of the conversation from the oldest, empty if it expired
+        """
+        pass
+
+    @abstractmethod
+    def append(self, key: str, turns: List[ConversationTurn]) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self, key: str) -> None:
+        pass
+
+    def history(self, key: str, budget: int = None) -> List[ChatMessage]:
+        """
+        Recent turns fitting in the budget, as messages to send before the new one.
+        """
+        budget = budget if budget is not None else self.max_tokens
+        turns = self._fit(self.load(key), budget)
+        return [ChatMessage(role=turn.role, content=turn.content) for turn in turns]
+
+    @staticmethod
+    def _fit(turns: List[ConversationTurn], budget: int) -> List[ConversationTurn]:
+        total = 0
+        start = len(turns)
+        while start > 0 and total + turns[start - 1].tokens <= budget:
+            start -= 1
+            total += turns[start].tokens
+        # The history has to start with a question.
+        while start < len(turns) and turns[start].role != "user":
+            start += 1
+        return turns[start:]
+
+
+class _Conversation:
+    def __init__(self):
+        self.turns: deque[ConversationTurn] = deque()
+        self.tokens = 0  # rolling sum of the turns' tokens
+        self.updated_at = time.monotonic()
+
+
+class InMemoryConversationMemory(ConversationMemory):
+    PURGE_INTERVAL = 60.0
+
+    def __init__(self, max_tokens: int = None, ttl: float = None):
+        super().__init__(max_tokens, ttl)
+        self._lock = threading.Lock()
+        self._conversations: dict[str, _Conversation] = {}
+        self._purged_at = time.monotonic()
+
+    def load(self, key: str) -> List[ConversationTurn]:
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return []
+            if time.monotonic() - conversation.updated_at > self.ttl:
+                del self._conversations[key]
+                return []
+            return list(conversation.turns)
+
+    def append(self, key: str, turns: List[ConversationTurn]) -> None:
+        with self._lock:
+            now = time.monotonic()
+            conversation = self._conversations.get(key)
+            if conversation is None or now - conversation.updated_at > self.ttl:
+                conversation = _Conversation()
+                self._conversations[key] = conversation
+            for turn in turns:
+                conversation.turns.append(turn)
+                conversation.tokens += turn.tokens
+            while conversation.tokens > self.max_tokens and len(conversation.turns) > 0:
+                conversation.tokens -= conversation.turns.popleft().tokens
+            conversation.updated_at = now
+
+            if now - self._purged_at > self.PURGE_INTERVAL:
+                self._purged_at = now
+                for expired in [k for k, c in self._conversations.items() if now - c.updated_at > self.ttl]:
+                    del self._conversations[expired]
+
+    def clear(self, key: str) -> None:
+        with self._lock:
+            self._conversations.pop(key, None)
+
+    def __str__(self):
+        return "in memory, max tokens: %d, ttl: %.0f s" % (self.max_tokens, self.ttl)
+
+
+class SqliteConversationMemory(ConversationMemory):
+    """
+    Survives restarts and can be shared by processes on the same host.
+    """
+
+    DEFAULT_PATH = "./conversation_memory.db"
+
+    def __init__(self, path: str = None, max_tokens: int = None, ttl: float = None):
+        super().__init__(max_tokens, ttl)
+        self.path = path if path is not None else self.DEFAULT_PATH
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS conversation_turns ("
+                                 "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                 "conversation_key TEXT NOT NULL, "
+                                 "role TEXT NOT NULL, "
+                                 "content TEXT NOT NULL, "
+                                 "tokens INTEGER NOT NULL, "
+                                 "created_at REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS conversation_turns_key "
+                                 "ON conversation_turns (conversation_key, seq)")
+        with self._lock:
+            self._connection.execute("DELETE FROM conversation_turns WHERE conversation_key IN ("
+                                     "SELECT conversation_key FROM conversation_turns "
+                                     "GROUP BY conversation_key HAVING MAX(created_at) < ?)",
+                                     (time.time() - self.ttl,))
+
+    def load(self, key: str) -> List[ConversationTurn]:
+        with self._lock:
+            rows = self._connection.execute("SELECT role, content, tokens, created_at FROM conversation_turns "
+                                            "WHERE conversation_key = ? ORDER BY seq", (key,)).fetchall()
+        turns = [ConversationTurn(role=role, content=content, tokens=tokens, created_at=created_at)
+                 for role, content, tokens, created_at in rows]
+        if len(turns) > 0 and time.time() - turns[-1].created_at > self.ttl:
+            self.clear(key)
+            return []
+        return turns
+
+    def append(self, key: str, turns: List[ConversationTurn]) -> None:
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                last = connection.execute("SELECT MAX(created_at) FROM conversation_turns "
+                                          "WHERE conversation_key = ?", (key,)).fetchone()[0]
+                if last is not None and time.time() - last > self.ttl:
+                    connection.execute("DELETE FROM conversation_turns WHERE conversation_key = ?", (key,))
+                connection.executemany("INSERT INTO conversation_turns "
+                                       "(conversation_key, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                                       [(key, turn.role, turn.content, turn.tokens, turn.created_at)
+                                        for turn in turns])
+                # Keep the newest turns within the budget, using the stored counts.
+                total = 0
+                keep_from = None
+                for seq, tokens in connection.execute("SELECT seq, tokens FROM conversation_turns "
+                                                      "WHERE conversation_key = ? ORDER BY seq DESC", (key,)):
+                    if total + tokens > self.max_tokens:
+                        break
+                    total += tokens
+                    keep_from = seq
+                if keep_from is None:
+                    connection.execute("DELETE FROM conversation_turns WHERE conversation_key = ?", (key,))
+                else:
+                    connection.execute("DELETE FROM conversation_turns WHERE conversation_key = ? AND seq < ?",
+                                       (key, keep_from))
+                connection.execute("COMMIT")
+            except Exception as e:
+                connection.execute("ROLLBACK")
+                raise e
+
+    def clear(self, key: str) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM conversation_turns WHERE conversation_key = ?", (key,))
+
+    def __str__(self):
+        return "sqlite (%s), max tokens: %d, ttl: %.0f s" % (self.path, self.max_tokens, self.ttl)
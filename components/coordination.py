@@ -0,0 +1,556 @@
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from enum import Enum
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+from components.ai_side.chatbot_client import CancellationToken
+from components.tools import SlottedRecord
+
+
+class CoordinationEnv(Enum):
+    BACKEND = "COORDINATION_BACKEND"
+    SQLITE_PATH = "COORDINATION_SQLITE_PATH"
+    REDIS_URL = "COORDINATION_REDIS_URL"
+
+
+class QueuedRequest(SlottedRecord):
+    __slots__ = ("unique_identifier", "parameters", "cancellation", "request_id", "enqueued_at", "journaled",
+                 "trace_id")
+
+    def __init__(self,
+                 unique_identifier: str,
+                 parameters: dict[str, Any],
+                 cancellation: CancellationToken = None,
+                 request_id: str = None,
+                 enqueued_at: float = None,
+                 journaled: Future = None,
+                 trace_id: str = None):
+        self.unique_identifier = unique_identifier
+        self.parameters = parameters
+        self.cancellation = cancellation
+        self.request_id = request_id
+        self.enqueued_at = enqueued_at  # time.time() when accepted
+        self.journaled = journaled  # done once the request is durable in the journal
+        self.trace_id = trace_id  # links the spans of the request
+
+
+class CoordinationError(Exception):
+    pass
+
+
+def _dump_request(request: QueuedRequest) -> str:
+    return json.dumps({"unique_identifier": request.unique_identifier,
+                       "request_id": request.request_id,
+                       "enqueued_at": request.enqueued_at,
+                       "trace_id": request.trace_id,
+                       "parameters": request.parameters}, ensure_ascii=False)
+
+
+def _load_request(payload) -> Optional[QueuedRequest]:
+    if payload is None:
+        return None
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    return QueuedRequest(**json.loads(payload), cancellation=CancellationToken())
+
+
+class Coordination(ABC):
+    """
+    State shared by the processes serving the same robots: the queue of requests, the request in flight of each
+    conversation (a newer one supersedes it), the cancellations and the messages already seen.
+    A shared backend gives every process its own copy of a request, cancellations are then seen by polling.
+    """
+
+    # How long the request in flight of a conversation is kept without being refreshed,
+    # so a crashed process does not hold conversations forever.
+    LEASE_SECONDS = 120.0
+
+    @property
+    def shared(self) -> bool:
+        return True
+
+    @staticmethod
+    def from_env() -> 'Coordination':
+        backend = os.getenv(CoordinationEnv.BACKEND.value, "memory").strip().lower()
+        if backend == "memory":
+            return InProcessCoordination()
+        elif backend == "sqlite":
+            coordination = SqliteCoordination(os.getenv(CoordinationEnv.SQLITE_PATH.value,
+                                                        SqliteCoordination.DEFAULT_PATH))
+        elif backend == "redis":
+            coordination = RedisCoordination(os.getenv(CoordinationEnv.REDIS_URL.value,
+                                                       RedisCoordination.DEFAULT_URL))
+        else:
+            raise ValueError("Unsupported coordination backend: %s" % backend)
+        logging.info("Coordination backend: %s" % coordination)
+        return coordination
+
+    @abstractmethod
+    def put(self, request: QueuedRequest) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, timeout: float) -> Optional[QueuedRequest]:
+        """
+        :return: the oldest queued request, None if there is none within the timeout
+        """
+        pass
+
+    @abstractmethod
+    def size(self) -> int:
+        pass
+
+    @abstractmethod
+    def acquire_in_flight(self, request: QueuedRequest, replace: bool = True) -> Optional[QueuedRequest]:
+        """
+        Make the request the one in flight of its conversation.
+        :return: the request in flight before, when not replacing it the new request is not made in flight
+        """
+        pass
+
+    @abstractmethod
+    def in_flight(self, unique_identifier: str) -> Optional[QueuedRequest]:
+        pass
+
+    @abstractmethod
+    def release_in_flight(self, request: QueuedRequest) -> None:
+        """
+        Finish the request in flight, unless a newer one has replaced it.
+        """
+        pass
+
+    @abstractmethod
+    def refresh_in_flight(self, request: QueuedRequest) -> bool:
+        """
+        Extend the lease of the request in flight.
+        :return: False when it is not in flight anymore
+        """
+        pass
+
+    @abstractmethod
+    def cancel(self, request: QueuedRequest, reason: str) -> None:
+        pass
+
+    @abstractmethod
+    def cancellation_reason(self, request: QueuedRequest) -> Optional[str]:
+        """
+        :return: why the request was cancelled (by any process), None if it was not
+        """
+        pass
+
+    @abstractmethod
+    def first_seen(self, key: str, ttl: float) -> bool:
+        """
+        :return: True only for the first call with the key within ttl seconds, in any process
+        """
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InProcessCoordination(Coordination):
+    """
+    The default, for a single process: requests are passed around as they are.
+    """
+
+    PURGE_INTERVAL = 60.0
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, QueuedRequest] = {}
+        self._seen: dict[str, float] = {}
+        self._purged_at = time.monotonic()
+
+    @property
+    def shared(self) -> bool:
+        return False
+
+    def put(self, request: QueuedRequest) -> None:
+        self._queue.put(request)
+
+    def get(self, timeout: float) -> Optional[QueuedRequest]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def size(self) -> int:
+        return self._queue.qsize()
+
+    def acquire_in_flight(self, request: QueuedRequest, replace: bool = True) -> Optional[QueuedRequest]:
+        with self._lock:
+            previous = self._in_flight.get(request.unique_identifier)
+            if previous is None or replace:
+                self._in_flight[request.unique_identifier] = request
+            return previous
+
+    def in_flight(self, unique_identifier: str) -> Optional[QueuedRequest]:
+        return self._in_flight.get(unique_identifier)
+
+    def release_in_flight(self, request: QueuedRequest) -> None:
+        with self._lock:
+            if self._in_flight.get(request.unique_identifier) is request:
+                del self._in_flight[request.unique_identifier]
+
+    def refresh_in_flight(self, request: QueuedRequest) -> bool:
+        return self._in_flight.get(request.unique_identifier) is request
+
+    def cancel(self, request: QueuedRequest, reason: str) -> None:
+        request.cancellation.cancel(reason)
+
+    def cancellation_reason(self, request: QueuedRequest) -> Optional[str]:
+        return request.cancellation.reason if request.cancellation.cancelled else None
+
+    def first_seen(self, key: str, ttl: float) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._purged_at > self.PURGE_INTERVAL:
+                self._purged_at = now
+                self._seen = {k: expires_at for k, expires_at in self._seen.items() if expires_at > now}
+            expires_at = self._seen.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._seen[key] = now + ttl
+            return True
+
+
+class SqliteCoordination(Coordination):
+    """
+    For processes on the same host, through a SQLite database (file locks).
+    """
+
+    DEFAULT_PATH = "./coordination.db"
+    POLL_INTERVAL = 0.05
+    PURGE_INTERVAL = 60.0
+
+    def __init__(self, path: str = None):
+        self.path = path if path is not None else self.DEFAULT_PATH
+        self._local = threading.local()
+        self._purged_at = 0.0
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS coordination_queue ("
+                           "seq INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS coordination_in_flight ("
+                           "unique_identifier TEXT PRIMARY KEY, request_id TEXT NOT NULL, "
+                           "payload TEXT NOT NULL, expires_at REAL NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS coordination_flags ("
+                           "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, transactions are explicit.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection)
+            connection.execute("COMMIT")
+            return result
+        except Exception as e:
+            connection.execute("ROLLBACK")
+            raise e
+
+    def put(self, request: QueuedRequest) -> None:
+        self._connection().execute("INSERT INTO coordination_queue (payload) VALUES (?)", (_dump_request(request),))
+
+    def get(self, timeout: float) -> Optional[QueuedRequest]:
+        def pop(connection):
+            row = connection.execute("SELECT seq, payload FROM coordination_queue ORDER BY seq LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM coordination_queue WHERE seq = ?", (row[0],))
+            return row
+
+        deadline = time.monotonic() + timeout
+        while True:
+            # look without locking first, most polls find nothing
+            if self._connection().execute("SELECT 1 FROM coordination_queue LIMIT 1").fetchone() is not None:
+                row = self._transaction(pop)
+                if row is not None:
+                    return _load_request(row[1])
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def size(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM coordination_queue").fetchone()[0]
+
+    def acquire_in_flight(self, request: QueuedRequest, replace: bool = True) -> Optional[QueuedRequest]:
+        def acquire(connection):
+            now = time.time()
+            row = connection.execute("SELECT payload FROM coordination_in_flight "
+                                     "WHERE unique_identifier = ? AND expires_at > ?",
+                                     (request.unique_identifier, now)).fetchone()
+            if row is None or replace:
+                connection.execute("INSERT OR REPLACE INTO coordination_in_flight "
+                                   "(unique_identifier, request_id, payload, expires_at) VALUES (?, ?, ?, ?)",
+                                   (request.unique_identifier, request.request_id, _dump_request(request),
+                                    now + self.LEASE_SECONDS))
+            return _load_request(row[0]) if row is not None else None
+
+        return self._transaction(acquire)
+
+    def in_flight(self, unique_identifier: str) -> Optional[QueuedRequest]:
+        row = self._connection().execute("SELECT payload FROM coordination_in_flight "
+                                         "WHERE unique_identifier = ? AND expires_at > ?",
+                                         (unique_identifier, time.time())).fetchone()
+        return _load_request(row[0]) if row is not None else None
+
+    def release_in_flight(self, request: QueuedRequest) -> None:
+        self._connection().execute("DELETE FROM coordination_in_flight WHERE unique_identifier = ? AND request_id = ?",
+                                   (request.unique_identifier, request.request_id))
+
+    def refresh_in_flight(self, request: QueuedRequest) -> bool:
+        cursor = self._connection().execute("UPDATE coordination_in_flight SET expires_at = ? "
+                                            "WHERE unique_identifier = ? AND request_id = ?",
+                                            (time.time() + self.LEASE_SECONDS, request.unique_identifier,
+                                             request.request_id))
+        return cursor.rowcount > 0
+
+    def cancel(self, request: QueuedRequest, reason: str) -> None:
+        self._connection().execute("INSERT OR REPLACE INTO coordination_flags (key, value, expires_at) "
+                                   "VALUES (?, ?, ?)",
+                                   ("cancel:" + request.request_id, reason or "", time.time() + self.LEASE_SECONDS))
+
+    def cancellation_reason(self, request: QueuedRequest) -> Optional[str]:
+        row = self._connection().execute("SELECT value FROM coordination_flags WHERE key = ? AND expires_at > ?",
+                                         ("cancel:" + request.request_id, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def first_seen(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        connection = self._connection()
+        if now - self._purged_at > self.PURGE_INTERVAL:
+            self._purged_at = now
+            connection.execute("DELETE FROM coordination_flags WHERE expires_at <= ?", (now,))
+            connection.execute("DELETE FROM coordination_in_flight WHERE expires_at <= ?", (now,))
+        cursor = connection.execute("INSERT INTO coordination_flags (key, value, expires_at) VALUES (?, '', ?) "
+                                    "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at "
+                                    "WHERE coordination_flags.expires_at <= ?",
+                                    ("seen:" + key, now + ttl, now))
+        return cursor.rowcount > 0
+
+    def __str__(self):
+        return "sqlite (%s)" % os.path.abspath(self.path)
+
+
+class _StaleConnectionError(ConnectionError):
+    """
+    The connection was found closed before the command was written, sending it again is safe.
+    """
+    pass
+
+
+class _RedisConnection:
+    """
+    Just enough of the Redis protocol (RESP) for the coordination.
+    """
+
+    def __init__(self, host: str, port: int, password: str = None, db: int = 0, timeout: float = 10.0):
+        self.timeout = timeout
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.socket.makefile('rb')
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def execute(self, *args, timeout: float = None):
+        return self.pipeline([args], timeout)[0]
+
+    def pipeline(self, commands, timeout: float = None) -> list:
+        payload = bytearray()
+        for args in commands:
+            payload += b"*%d\r\n" % len(args)
+            for arg in args:
+                arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+                payload += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        # A connection closed by the server (idle timeout, restart) is readable before anything is written to it.
+        if select.select([self.socket], [], [], 0)[0]:
+            raise _StaleConnectionError("Connection closed by the Redis server while idle.")
+        # blocking commands wait longer than the socket timeout
+        self.socket.settimeout(self.timeout + timeout if timeout is not None else self.timeout)
+        self.socket.sendall(payload)
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, CoordinationError):
+                raise reply
+        return replies
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the Redis server.")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value.decode('utf-8')
+        if kind == b"-":
+            return CoordinationError(value.decode('utf-8'))
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            length = int(value)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(value)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise CoordinationError("Unexpected reply from the Redis server: %r" % line)
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class RedisCoordination(Coordination):
+    """
+    For processes on any host, through Redis (or anything speaking its protocol).
+    """
+
+    DEFAULT_URL = "redis://127.0.0.1:6379/0"
+    KEY_PREFIX = "chatgpding:"
+
+    def __init__(self, url: str = None):
+        self.url = url if url is not None else self.DEFAULT_URL
+        parsed = urlparse(self.url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/')) if parsed.path.strip('/') else 0
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._execute("PING")
+
+    def _connection(self) -> _RedisConnection:
+        # One connection per thread, as workers block on the queue.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = _RedisConnection(self.host, self.port, self.password, self.db)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+
+    def _reconnect_on_error(self, work):
+        try:
+            return work(self._connection())
+        except _StaleConnectionError:
+            # once, nothing was written to the idle connection the server closed
+            self._drop_connection()
+            return work(self._connection())
+        except (ConnectionError, OSError):
+            # The command may have run (RPUSH twice, or a request popped by BLPOP and lost), so it is not sent again.
+            # Nor is the connection used again, the next command would read this one's late reply.
+            self._drop_connection()
+            raise
+
+    def _execute(self, *args, timeout: float = None):
+        return self._reconnect_on_error(lambda connection: connection.execute(*args, timeout=timeout))
+
+    def _key(self, *parts: str) -> str:
+        return self.KEY_PREFIX + ":".join(parts)
+
+    def put(self, request: QueuedRequest) -> None:
+        self._execute("RPUSH", self._key("queue"), _dump_request(request))
+
+    def get(self, timeout: float) -> Optional[QueuedRequest]:
+        reply = self._execute("BLPOP", self._key("queue"), max(1, int(round(timeout))), timeout=timeout)
+        return _load_request(reply[1]) if reply is not None else None
+
+    def size(self) -> int:
+        return self._execute("LLEN", self._key("queue"))
+
+    def acquire_in_flight(self, request: QueuedRequest, replace: bool = True) -> Optional[QueuedRequest]:
+        key = self._key("in_flight", request.unique_identifier)
+        payload = _dump_request(request)
+        lease = int(self.LEASE_SECONDS * 1000)
+        if replace:
+            # one command, a lease is never left without expiry (SET ... GET needs Redis 6.2)
+            return _load_request(self._execute("SET", key, payload, "PX", lease, "GET"))
+        while True:
+            if self._execute("SET", key, payload, "NX", "PX", lease) is not None:
+                return None
+            previous = self._execute("GET", key)
+            if previous is not None:
+                return _load_request(previous)
+            # released in between, try again
+
+    def in_flight(self, unique_identifier: str) -> Optional[QueuedRequest]:
+        return _load_request(self._execute("GET", self._key("in_flight", unique_identifier)))
+
+    def release_in_flight(self, request: QueuedRequest) -> None:
+        key = self._key("in_flight", request.unique_identifier)
+
+        def release(connection: _RedisConnection):
+            # compare and delete, the transaction fails if the key changes after WATCH
+            connection.execute("WATCH", key)
+            current = _load_request(connection.execute("GET", key))
+            if current is None or current.request_id != request.request_id:
+                connection.execute("UNWATCH")
+                return
+            connection.pipeline([("MULTI",), ("DEL", key), ("EXEC",)])
+
+        self._reconnect_on_error(release)
+
+    def refresh_in_flight(self, request: QueuedRequest) -> bool:
+        key = self._key("in_flight", request.unique_identifier)
+        current = _load_request(self._execute("GET", key))
+        if current is None or current.request_id != request.request_id:
+            return False
+        # Racing with a replacement only extends the lease of the newer request, which is harmless.
+        self._execute("EXPIRE", key, int(self.LEASE_SECONDS))
+        return True
+
+    def cancel(self, request: QueuedRequest, reason: str) -> None:
+        self._execute("SET", self._key("cancel", request.request_id), reason or "", "EX", int(self.LEASE_SECONDS))
+
+    def cancellation_reason(self, request: QueuedRequest) -> Optional[str]:
+        reason = self._execute("GET", self._key("cancel", request.request_id))
+        return reason.decode('utf-8') if reason is not None else None
+
+    def first_seen(self, key: str, ttl: float) -> bool:
+        return self._execute("SET", self._key("seen", key), "1", "NX", "EX", max(1, int(ttl))) is not None
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def __str__(self):
+        return "redis (%s:%d/%d)" % (self.host, self.port, self.db)
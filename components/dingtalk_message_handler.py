@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import re
@@ -7,13 +8,23 @@ from typing import List
 
 import chardet
 
+from components import metrics
 from components.ai_side.chatbot_client import ChatBotClient, ChatMessage, ContextLengthExceededException, \
     UnsupportedMultiModalMessageError, ImageBlock, TextBlock, UploadingTooManyImagesException, \
-    DisabledMultiModalConversation, TokenUsage
+    DisabledMultiModalConversation, TokenUsage, CompletionCancelledException, StreamTimeoutException
 from components.ai_side.chatbot_client_builder import ChatBotClientBuilder
+from components.ai_side.model_router import ModelRouter
+from components.ai_side.rate_limiter import RateLimitedException
+from components.conversation_memory import ConversationMemory, ConversationTurn, conversation_key
+from components.coordination import Coordination
+from components.im_side.dingtalk_card import DingtalkCardEnv, StreamingCard
 from components.im_side.dingtalk_client import DingtalkClient
 from components.message_handler import MessageHandler, QueuedRequest, ConcurrentRequestException
-from components.tools import download_file, truncate_string
+from components.request_journal import RequestJournal
+from components.response_cache import ResponseCache
+from components.structured_logging import log_content, log_context, bind_log_context
+from components.tools import download_file, truncate_string, get_float_env
+from components.tracing import Tracer, new_trace_id
 
 
 def _create_busy_message(content: str):
@@ -28,7 +39,8 @@ def _create_busy_message(content: str):
 
 
 def _create_unknown_msgtype_message(message):
-    print("[{}] sent a message of type '{}'.  -> {}".format(message['senderNick'], message['msgtype'], message))
+    logging.info("[%s] sent a message of type '%s'.  -> %s"
+                 % (message['senderNick'], message['msgtype'], log_content(json.dumps(message, ensure_ascii=False))))
     return {
         "msgtype": "markdown",
         "markdown": {
@@ -48,8 +60,37 @@ def _create_do_not_rely_other_message():
     }
 
 
-def _create_message_bottom(usage: TokenUsage, chat_model_name: str, file_names: List[str] = None):
+def _create_stopped_message(stopped: bool):
+    return {
+        "msgtype": "markdown",
+        "markdown": {
+            "title": "[OK]好的...",
+            "text": "<font color=silver>好的，不说了 [闭嘴]" if stopped else "<font color=silver>我没在说话呀 [疑问]"
+        }
+    }
+
+
+def _create_reset_message():
+    return {
+        "msgtype": "markdown",
+        "markdown": {
+            "title": "[OK]好的...",
+            "text": "<font color=silver>好的，之前聊的我都忘了，换个话题吧 [可爱]"
+        }
+    }
+
+
+def _create_message_bottom(usage: TokenUsage, chat_model_name: str, file_names: List[str] = None,
+                           interrupted: bool = False, cache_hit: bool = False):
     token_info = f" ▦ {usage.image_tokens} - ↑ {usage.input_tokens}  ↓ {usage.output_tokens} "
+    if usage.cache_read_tokens > 0 or usage.cache_write_tokens > 0:
+        # Prompt cache: tokens read from / written to it, on top of the uncached input tokens.
+        token_info += f"- ↺ {usage.cache_read_tokens}  ✎ {usage.cache_write_tokens} "
+    if interrupted:
+        token_info = " ⊘" + token_info
+    if cache_hit:
+        # The reply was served from the response cache or shared with an identical request.
+        token_info = " ⚡" + token_info
     model_info = f"{chat_model_name}"
     # When the model name is shorter, achieve a centering effect.
     if len(model_info) < len(token_info):  #
@@ -187,6 +228,34 @@ def _organize_iterable_response(iterable_reply):
     yield accumulated_content, True
 
 
+class _TimedIterator:
+    """
+    Iterate, recording the time spent waiting for the items, when the first content came and when it ended.
+    """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.elapsed = 0.0
+        self.first_item_time: float = None
+        self.end_time: float = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_time = time.perf_counter()
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self.end_time = time.perf_counter()
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start_time
+        if self.first_item_time is None and item is not None and len(item) > 0:
+            self.first_item_time = time.perf_counter()
+        return item
+
+
 # Matching image name, image name is the first 8 characters of MD5 encoding and in uppercase.
 MD5_FILENAME_PATTERN = r"([0-9A-F]{8}\.png|[0-9A-F]{8}\.jpg)"
 
@@ -196,9 +265,22 @@ class DingtalkMessageHandler(MessageHandler):
                  chatbot_client_builder: ChatBotClientBuilder,
                  dingtalk_client: DingtalkClient,
                  download_dir: str = None,
-                 worker_threads: int = None):
-        super().__init__(chatbot_client_builder, worker_threads=worker_threads)
+                 worker_threads: int = None,
+                 response_cache: ResponseCache = None,
+                 conversation_memory: ConversationMemory = None,
+                 journal: RequestJournal = None,
+                 coordination: Coordination = None,
+                 tracer: Tracer = None,
+                 card_template_id: str = None,
+                 card_update_interval: float = None,
+                 model_router: ModelRouter = None):
+        super().__init__(chatbot_client_builder, worker_threads=worker_threads, journal=journal,
+                         coordination=coordination, tracer=tracer)
         self.dingtalk_client = dingtalk_client
+        self.response_cache = response_cache if response_cache is not None else ResponseCache.from_env()
+        self.conversation_memory = conversation_memory if conversation_memory is not None \
+            else ConversationMemory.from_env()
+        self.model_router = model_router if model_router is not None else ModelRouter.from_env()
 
         self.download_dir = download_dir if download_dir is not None else os.getenv("DOWNLOAD_DIR")
         if self.download_dir is None:
@@ -207,8 +289,32 @@ class DingtalkMessageHandler(MessageHandler):
         logging.info(f"All files from DingTalk messages will be downloaded to directory: "
                      f"{os.path.abspath(self.download_dir)}")
 
-    def check_signature(self, timestamp, sign) -> str:
-        return self.dingtalk_client.check_signature(timestamp, sign)
+        # Answers streamed into one interactive card updated in place (group chats too), instead of text messages.
+        self.card_template_id = card_template_id if card_template_id is not None \
+            else os.getenv(DingtalkCardEnv.TEMPLATE_ID.value)
+        self.card_update_interval = card_update_interval if card_update_interval is not None \
+            else get_float_env(DingtalkCardEnv.UPDATE_INTERVAL.value, StreamingCard.DEFAULT_UPDATE_INTERVAL)
+        if self.card_template_id is not None:
+            logging.info("Answers are streamed into interactive cards (template %s, updated every %.1f s)."
+                         % (self.card_template_id, self.card_update_interval))
+
+    def check_signature(self, timestamp, sign, robot_code=None) -> str:
+        return self.dingtalk_client.check_signature(timestamp, sign, robot_code)
+
+    def check_signature_headers(self, timestamp, sign) -> None:
+        self.dingtalk_client.check_signature_headers(timestamp, sign)
+
+    def can_replay(self, parameters: dict) -> bool:
+        # The answer can only be sent while the session webhook is valid.
+        expired_time = parameters.get("session_webhook_expired_time")
+        return expired_time is not None and expired_time > time.time() * 1000
+
+    async def warm_up(self, chatbot_client: ChatBotClient) -> None:
+        await super().warm_up(chatbot_client)
+        await self.dingtalk_client.warm_up()
+
+    async def close_worker_connections(self) -> None:
+        await self.dingtalk_client.close()
 
     async def process_request(self, request: QueuedRequest, chatbot_client: ChatBotClient) -> None:
         """
@@ -221,80 +327,181 @@ class DingtalkMessageHandler(MessageHandler):
         send_to = request.parameters["send_to"]
         content = request.parameters["content"]
         is_group_chat = request.parameters["is_group_chat"]
+        memory_key = request.parameters.get("conversation_key")
+        bind_log_context(conversation_id=request.parameters.get("conversation_id"))
 
-        # check content
-        # If the file content contains image names and the images exist, use a multimodal model to answer.
-        images = re.findall(MD5_FILENAME_PATTERN, content)
-
-        if len(images) > 10:
-            raise UploadingTooManyImagesException("You can include multiple images in a single request, "
-                                                  "but up to 10 images allowed.")
-
-        # prepare contents
-        multimodal_contents = []
-        if re.search(MD5_FILENAME_PATTERN, content):
-            segments = re.split(MD5_FILENAME_PATTERN, content)
-            for segment in segments:
-                if len(segment.strip()) == 0:
-                    continue
-                if re.search(MD5_FILENAME_PATTERN, segment):
-                    dir_name = os.path.abspath(self.download_dir)
-                    file_path = os.path.join(dir_name, segment)
-                    if os.path.exists(file_path):
-                        multimodal_contents.append(ImageBlock(image=file_path))
-                        continue
-                    else:
-                        images.remove(segment)
-                multimodal_contents.append(TextBlock(text=segment))
-
-        # prepare chat messages
-        if len(images) > 0:
-            # multimodal messages
-            chat_messages = [ChatMessage(role='user', content=multimodal_contents)]
-        else:
-            # text only
-            chat_messages = [ChatMessage(role='user', content=content)]
+        labels = dict(app_key=request.parameters.get("app_key"), provider=chatbot_client.server_type.value,
+                      model=chatbot_client.chat_model_name)
+        images = []
 
-        # send to chatbot server and get reply
+        started_at = time.time()
         start_time = time.perf_counter()
+        upstream = None
+        segments = None
+        card = None
+        usage = None
+        cache_hit = False
+        outcome = "error"
+        need_resend = ""
+        answer = ""
         try:
-            iterable_reply, usage = chatbot_client.completions(chat_messages)
+            # superseded or stopped while waiting in queue
+            request.cancellation.raise_if_cancelled()
+
+            # check content
+            # If the file content contains image names and the images exist, use a multimodal model to answer.
+            images = re.findall(MD5_FILENAME_PATTERN, content)
+
+            if len(images) > 10:
+                raise UploadingTooManyImagesException("You can include multiple images in a single request, "
+                                                      "but up to 10 images allowed.")
+
+            # prepare contents
+            multimodal_contents = []
+            if re.search(MD5_FILENAME_PATTERN, content):
+                parts = re.split(MD5_FILENAME_PATTERN, content)
+                for part in parts:
+                    if len(part.strip()) == 0:
+                        continue
+                    if re.search(MD5_FILENAME_PATTERN, part):
+                        dir_name = os.path.abspath(self.download_dir)
+                        file_path = os.path.join(dir_name, part)
+                        if os.path.exists(file_path):
+                            multimodal_contents.append(ImageBlock(image=file_path))
+                            continue
+                        else:
+                            images.remove(part)
+                    multimodal_contents.append(TextBlock(text=part))
+
+            # prepare chat messages
+            if len(images) > 0:
+                # multimodal messages
+                chat_messages = [ChatMessage(role='user', content=multimodal_contents)]
+            else:
+                # text only
+                chat_messages = [ChatMessage(role='user', content=content)]
+            question = content
+
+            # previous turns of the conversation
+            if self.conversation_memory is not None and memory_key is not None:
+                budget = self.conversation_memory.max_tokens - chatbot_client.estimate_prompt_tokens(chat_messages)
+                chat_messages = self.conversation_memory.history(memory_key, max(0, budget)) + chat_messages
+
+            # easy requests to the fast model, hard ones to the flagship
+            if self.model_router is not None:
+                decision = self.model_router.route(chatbot_client, chat_messages, question,
+                                                   uploaded_file=request.parameters.get("msgtype") == 'file')
+                logging.info("Request routed to %s: %s" % (decision, truncate_string(question)))
+                chatbot_client = chatbot_client.with_model(decision.model_name)
+                labels["model"] = chatbot_client.chat_model_name
+
+            # send to chatbot server and get reply
+            started_at = time.time()
+            start_time = time.perf_counter()
+            if self.response_cache is not None:
+                iterable_reply, usage, cache_hit = self.response_cache.completions(
+                    chatbot_client, chat_messages, cancellation_token=request.cancellation)
+            else:
+                iterable_reply, usage = chatbot_client.completions(chat_messages,
+                                                                   cancellation_token=request.cancellation)
             end_time = time.perf_counter()
             logging.info("Message received from chatbot server start at {:.3f} s by {}"
                          .format((end_time - start_time), chatbot_client))
 
-            reply_once = (is_group_chat or (not chatbot_client.enable_streaming)
-                          or (not chatbot_client.supports_streaming_response))
-
-            need_resend = ""
-            # organize iterable response
-            for content, is_end in _organize_iterable_response(iterable_reply):
-                if is_end:
-                    content += _create_message_bottom(usage, chatbot_client.chat_model_name, images)
-
-                need_resend = (need_resend + content).strip()
-
-                if not reply_once:
+            upstream = _TimedIterator(iterable_reply)
+            if self.card_template_id is not None:
+                card = await self._create_card(request)
+
+            if card is not None:
+                # The card shows the whole answer so far, no need to split it.
+                for chunk in upstream:
+                    request.cancellation.raise_if_cancelled()
+                    answer += chunk
+                    await card.update(answer)
+                with self.span("send_card", length=len(answer), updates=card.updates):
+                    await card.finish(answer.strip() + _create_message_bottom(usage, chatbot_client.chat_model_name,
+                                                                              images, cache_hit=cache_hit))
+                logging.info("Answer sent in card %s with %d update(s)." % (card.out_track_id, card.updates))
+            else:
+                segments = _TimedIterator(_organize_iterable_response(upstream))
+
+                reply_once = (is_group_chat or (not chatbot_client.enable_streaming)
+                              or (not chatbot_client.supports_streaming_response))
+
+                # organize iterable response
+                for content, is_end in segments:
+                    # Non-streaming replies can not be aborted upstream, but are no longer sent once cancelled.
+                    request.cancellation.raise_if_cancelled()
+                    answer += content
+                    if is_end:
+                        content += _create_message_bottom(usage, chatbot_client.chat_model_name, images,
+                                                          cache_hit=cache_hit)
+
+                    need_resend = (need_resend + content).strip()
+
+                    if not reply_once:
+                        success = await self.send_message_to_dingtalk(session_webhook,
+                                                                      send_to,
+                                                                      need_resend,
+                                                                      chatbot_client.chat_model_name)
+                        need_resend = "" if success else (need_resend + "\n\n")
+
+                if len(need_resend) > 0:
                     success = await self.send_message_to_dingtalk(session_webhook,
                                                                   send_to,
                                                                   need_resend,
                                                                   chatbot_client.chat_model_name)
-                    need_resend = "" if success else (need_resend + "\n\n")
-
-            if len(need_resend) > 0:
-                success = await self.send_message_to_dingtalk(session_webhook,
-                                                              send_to,
-                                                              need_resend,
-                                                              chatbot_client.chat_model_name)
-                if not success:
-                    raise Exception("Message send failed : " + need_resend)
-
-            logging.info("Request chatbot server duration: {:.3f} s. Estimated completion Tokens: {}.".format(
-                (end_time - start_time), usage))
+                    if not success:
+                        raise Exception("Message send failed : " + need_resend)
+
+            logging.info("Request chatbot server duration: {:.3f} s. Estimated completion Tokens: {}.{}".format(
+                (end_time - start_time), usage, " (cache hit)" if cache_hit else ""))
+            outcome = "cache_hit" if cache_hit else "ok"
+
+            # Only complete rounds are remembered, an interrupted answer is forgotten with its question.
+            if self.conversation_memory is not None and memory_key is not None:
+                now = time.time()
+                self.conversation_memory.append(memory_key, [
+                    ConversationTurn(role='user', content=question,
+                                     tokens=chatbot_client.estimate_tokens(question), created_at=now),
+                    ConversationTurn(role='assistant', content=answer.strip(),
+                                     tokens=chatbot_client.estimate_tokens(answer), created_at=now)
+                ])
+
+        except (CompletionCancelledException, StreamTimeoutException) as e:
+            end_time = time.perf_counter()
+            outcome = "timeout" if isinstance(e, StreamTimeoutException) else "cancelled"
+            if isinstance(e, StreamTimeoutException):
+                logging.warning("Request chatbot server timeout: phase={} elapsed={:.3f}s deadline={:.3f}s "
+                                "duration={:.3f}s usage={} by {}".format(e.phase, e.elapsed, e.deadline,
+                                                                         (end_time - start_time), usage,
+                                                                         chatbot_client))
+            else:
+                logging.info("Request chatbot server cancelled ({}) after {:.3f} s. Estimated completion Tokens: {}."
+                             .format(e.args[0] if len(e.args) > 0 else None, (end_time - start_time), usage))
+            if card is not None:
+                # Report what has been generated before the cancellation.
+                await self._finish_card(card, answer.strip() + _create_message_bottom(
+                    usage, chatbot_client.chat_model_name, images, interrupted=True, cache_hit=cache_hit))
+            elif usage is not None and (usage.output_tokens > 0 or len(need_resend) > 0):
+                # Report what has been generated before the cancellation.
+                need_resend += _create_message_bottom(usage, chatbot_client.chat_model_name, images,
+                                                      interrupted=True, cache_hit=cache_hit)
+                await self.send_message_to_dingtalk(session_webhook,
+                                                    send_to,
+                                                    need_resend,
+                                                    chatbot_client.chat_model_name)
+            if isinstance(e, StreamTimeoutException):
+                await self.dingtalk_client.send_markdown(
+                    "超时 orz",
+                    "<font color=silver>那边半天没动静了…… 先停下吧，等会再试试 [流汗] <br />(%s)" % e,
+                    session_webhook)
 
         except Exception as e:
             end_time = time.perf_counter()
             logging.error("Error Request chatbot server duration: {:.3f} s.".format((end_time - start_time)))
+            if card is not None:
+                await self._finish_card(card, answer.strip(), error=True)
 
             if isinstance(e, ContextLengthExceededException):
                 await self.dingtalk_client.send_markdown(
@@ -311,6 +518,11 @@ class DingtalkMessageHandler(MessageHandler):
                     "好多 orz",
                     "<font color=silver>你发图片…… 发太多了啊 [投降] <br />(%s)" % e.args,
                     session_webhook)
+            elif isinstance(e, RateLimitedException):
+                await self.dingtalk_client.send_markdown(
+                    "排队 orz",
+                    "<font color=silver>问的人太多啦，额度用光了…… 过一分钟再试试吧 [流汗]",
+                    session_webhook)
             elif isinstance(e, DisabledMultiModalConversation):
                 await self.dingtalk_client.send_markdown(
                     "可是 orz",
@@ -323,15 +535,76 @@ class DingtalkMessageHandler(MessageHandler):
                     "<font color=silver>完，出错啦！暂时没法用咯…… 等会再试试吧 [傻笑] <br />(%s)" % str(e.args),
                     session_webhook)
 
-    async def send_message_to_dingtalk(self, session_webhook, send_to, content, chat_model_name) -> bool:
-        print("[{}]->[{}]: {}".format(chat_model_name, send_to,
-                                      content.rstrip().replace("\n", "\n  | ")))
+        finally:
+            if upstream is not None and upstream.end_time is None:
+                # Failed midway: the upstream request, the target it holds in the pool and the shared reply
+                # of the response cache are released with the cancellation of the request.
+                request.cancellation.cancel(self.ABORTED_REASON)
+            self._observe_reply(upstream, segments, started_at, start_time, labels, cache_hit)
+            metrics.REQUESTS.labels(outcome=outcome, **labels).inc()
+            if usage is not None and not cache_hit:
+                metrics.observe_token_usage(usage, **labels)
+
+    async def _create_card(self, request: QueuedRequest):
+        """
+        :return: the card of the answer, None to answer with text messages when it can not be created
+        """
+        card = StreamingCard(self.dingtalk_client, request.parameters.get("app_key"), self.card_template_id,
+                             self.card_update_interval)
+        with self.span("send_card", create=True) as span:
+            try:
+                await card.create(request.parameters["robot_code"], request.parameters.get("conversation_id"),
+                                  request.parameters["userid"], request.parameters["is_group_chat"])
+            except Exception as e:
+                logging.error("Failed to create card, answer with text messages: %s" % e)
+                if span is not None:
+                    span.error = type(e).__name__
+                return None
+        return card
+
+    async def _finish_card(self, card: StreamingCard, content: str, error: bool = False) -> None:
         try:
-            await self.dingtalk_client.send_text(content, session_webhook)
+            await card.finish(content, error=error)
         except Exception as e:
-            logging.error("Send answer to dingtalk Failed,"
-                          "The current message failed to send and is waiting to be resent.", e.args)
-            return False
+            logging.error("Failed to finish card %s: %s" % (card.out_track_id, e))
+
+    def _observe_reply(self, upstream: _TimedIterator, segments: _TimedIterator, started_at: float,
+                       start_time: float, labels: dict, cache_hit: bool) -> None:
+        """
+        Time to first content and generation time of the chatbot server, and the time spent segmenting its reply.
+        :param started_at: time.time() when the chatbot server was called
+        :param start_time: time.perf_counter() when the chatbot server was called
+        """
+        if upstream is None:
+            return
+        # Replies from the cache would hide the latency of the chatbot server.
+        if upstream.first_item_time is not None:
+            if not cache_hit:
+                metrics.TIME_TO_FIRST_TOKEN_SECONDS.labels(**labels).observe(upstream.first_item_time - start_time)
+            if self.tracer is not None:
+                self.tracer.record("first_token", upstream.first_item_time - start_time, start_time=started_at,
+                                   cache_hit=cache_hit)
+        if upstream.end_time is not None:
+            if not cache_hit:
+                metrics.GENERATION_SECONDS.labels(**labels).observe(upstream.end_time - start_time)
+            if self.tracer is not None:
+                self.tracer.record("generation", upstream.end_time - start_time, start_time=started_at,
+                                   cache_hit=cache_hit)
+        if self.tracer is not None and segments is not None:
+            # spread over the reply, between the chunks
+            self.tracer.record("segment", segments.elapsed - upstream.elapsed, start_time=started_at)
+
+    async def send_message_to_dingtalk(self, session_webhook, send_to, content, chat_model_name) -> bool:
+        logging.info("[%s]->[%s]: %s" % (chat_model_name, send_to, log_content(content.rstrip())))
+        with self.span("send_text", length=len(content)) as span:
+            try:
+                await self.dingtalk_client.send_text(content, session_webhook)
+            except Exception as e:
+                logging.error("Send answer to dingtalk Failed,"
+                              "The current message failed to send and is waiting to be resent.", e.args)
+                if span is not None:
+                    span.error = type(e).__name__
+                return False
         return True
 
     async def handle_message_from_dingtalk(self, app_key: str, message: dict) -> dict:
@@ -342,6 +615,19 @@ class DingtalkMessageHandler(MessageHandler):
         :param message:
         :return message:
         """
+        with self.span("callback", app_key=app_key, msgtype=message.get('msgtype')) as span:
+            # the same trace id in the logs of the callback and of the request, traced or not
+            trace_id = span.trace_id if span is not None else new_trace_id()
+            with log_context(trace_id=trace_id, msg_id=message.get('msgId'),
+                             conversation_id=message.get('conversationId')):
+                return await self._handle_message_from_dingtalk(app_key, message, trace_id)
+
+    async def _handle_message_from_dingtalk(self, app_key: str, message: dict, trace_id: str = None) -> dict:
+        # DingTalk delivers a message again when it is not acknowledged in time, maybe to another process.
+        if self.is_duplicate(message.get('msgId')):
+            logging.info("Ignore message delivered again: %s" % message.get('msgId'))
+            return _create_empty_message()
+
         is_group_chat = (message['conversationType'] == '2')
         sender_nick = message['senderNick'] if not is_group_chat else ("[" + message['senderNick'] + "]")
 
@@ -359,8 +645,8 @@ class DingtalkMessageHandler(MessageHandler):
 
         # check message type
         if message['msgtype'] == 'audio':
-            print("[{}] sent a message of type 'audio'.  -> {}".format(
-                message['senderNick'], message['content']['recognition']))
+            logging.info("[%s] sent a message of type 'audio'.  -> %s"
+                         % (message['senderNick'], log_content(message['content']['recognition'])))
             # process as normal text message
             message['text'] = {
                 "content": message['content']['recognition']
@@ -368,9 +654,12 @@ class DingtalkMessageHandler(MessageHandler):
 
         elif message['msgtype'] == 'picture':
             download_code = message['content']['downloadCode']
-            print("[{}] sent a message of type 'picture'.  -> {}".format(message['senderNick'], download_code))
-            image_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
-            file_path = download_file(image_url, self.download_dir)
+            logging.info("[%s] sent a message of type 'picture'.  -> %s" % (message['senderNick'], download_code))
+            with metrics.MEDIA_DOWNLOAD_SECONDS.labels(app_key=app_key, msgtype='picture').time():
+                with self.span("get_file_download_url"):
+                    image_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
+                with self.span("download_file"):
+                    file_path = download_file(image_url, self.download_dir)
             # process as normal text message
             message['text'] = {
                 "content": os.path.basename(file_path) + " ?"
@@ -383,8 +672,11 @@ class DingtalkMessageHandler(MessageHandler):
             for element in rich_text:
                 if 'type' in element and element['type'] == 'picture':
                     download_code = element['downloadCode']
-                    image_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
-                    file_path = download_file(image_url, self.download_dir)
+                    with metrics.MEDIA_DOWNLOAD_SECONDS.labels(app_key=app_key, msgtype='richText').time():
+                        with self.span("get_file_download_url"):
+                            image_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
+                        with self.span("download_file"):
+                            file_path = download_file(image_url, self.download_dir)
                     segments.append(os.path.basename(file_path))
                 elif 'text' in element and len(str(element['text']).strip()) > 0:
                     has_text = True
@@ -401,8 +693,11 @@ class DingtalkMessageHandler(MessageHandler):
             if ext != '.txt':
                 return _create_unknown_msgtype_message(message)
             download_code = message['content']['downloadCode']
-            file_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
-            file_path = download_file(file_url, self.download_dir, ext)
+            with metrics.MEDIA_DOWNLOAD_SECONDS.labels(app_key=app_key, msgtype='file').time():
+                with self.span("get_file_download_url"):
+                    file_url = await self.dingtalk_client.get_file_download_url(app_key, download_code)
+                with self.span("download_file"):
+                    file_path = download_file(file_url, self.download_dir, ext)
             # guess encoding
             with open(file_path, 'rb') as f:
                 content = f.read()
@@ -423,21 +718,41 @@ class DingtalkMessageHandler(MessageHandler):
         session_webhook = message['sessionWebhook']
         sender_content = str(message['text']['content'])
 
+        # Stop answering the question being processed.
+        if self.is_stop_command(sender_content):
+            logging.info("[%s](停止): %s" % (sender_nick, log_content(sender_content.strip())))
+            cancelled = self.cancel_request(session_webhook, "stop command")
+            return _create_stopped_message(cancelled is not None)
+
+        # Forget the previous turns of the conversation.
+        memory_key = conversation_key(robot_code, message.get('conversationId'), userid)
+        if self.is_reset_command(sender_content):
+            logging.info("[%s](重置): %s" % (sender_nick, log_content(sender_content.strip())))
+            if self.conversation_memory is not None:
+                self.conversation_memory.clear(memory_key)
+            return _create_reset_message()
+
         # Add to queue for processing.
         request = {
+            'app_key': app_key,
             'session_webhook': session_webhook,
+            'session_webhook_expired_time': message.get('sessionWebhookExpiredTime'),
             'send_to': sender_nick,
             'userid': userid,
             'robot_code': robot_code,
+            'conversation_id': message.get('conversationId'),
+            'conversation_key': memory_key,
             'content': sender_content,
+            'msgtype': message['msgtype'],
             'is_group_chat': is_group_chat
         }
 
         try:
-            self.add_new_request_to_queue(session_webhook, request)
-            print("[{}]: {}".format(sender_nick, sender_content.rstrip().replace("\n", "\n  | ")))
+            new_request = self.add_new_request_to_queue(session_webhook, request, trace_id=trace_id)
+            await self.wait_until_journaled(new_request)
+            logging.info("[%s]: %s" % (sender_nick, log_content(sender_content.rstrip())))
         except ConcurrentRequestException as e:
-            print("[{}](忽略): {}".format(sender_nick, sender_content.rstrip().replace("\n", "\n  | ")))
+            logging.info("[%s](忽略): %s" % (sender_nick, log_content(sender_content.rstrip())))
             processing_queued_request: QueuedRequest = e.args[1]
             return _create_busy_message(processing_queued_request.parameters["content"])
 
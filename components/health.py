@@ -0,0 +1,93 @@
+import time
+from enum import Enum
+from typing import Any, Dict
+
+from components.ai_side.provider_pool import ProviderPool
+from components.im_side.dingtalk_client import DingtalkClient
+from components.message_handler import MessageHandler
+from components.tools import get_float_env
+
+
+class HealthEnv(Enum):
+    MAX_QUEUE_PER_WORKER = "READINESS_MAX_QUEUE_PER_WORKER"
+    GRACE_PERIOD = "READINESS_GRACE_PERIOD"
+
+
+class HealthCheck:
+    """
+    State of this process for load balancers and supervisors, at GET /healthz and GET /readyz.
+    Alive while it has live workers (or is stopping). Ready to take more traffic unless it is draining,
+    has no live worker, every chatbot server target is ejected, or it is saturated:
+    as many workers as it may have, and MAX_QUEUE_PER_WORKER requests per worker queued.
+    Draining starts with the shutdown signal, the server keeps serving for `grace_period` seconds
+    so the load balancers see it before the connections are refused.
+    """
+
+    DEFAULT_MAX_QUEUE_PER_WORKER = 2.0
+    DEFAULT_GRACE_PERIOD = 5.0
+
+    def __init__(self,
+                 handler: MessageHandler,
+                 dingtalk_client: DingtalkClient,
+                 provider_pool: ProviderPool = None,
+                 max_queue_per_worker: float = DEFAULT_MAX_QUEUE_PER_WORKER,
+                 grace_period: float = DEFAULT_GRACE_PERIOD):
+        self.handler = handler
+        self.dingtalk_client = dingtalk_client
+        self.provider_pool = provider_pool
+        self.max_queue_per_worker = max_queue_per_worker
+        self.grace_period = grace_period
+
+    @staticmethod
+    def from_env(handler: MessageHandler, dingtalk_client: DingtalkClient,
+                 provider_pool: ProviderPool = None) -> 'HealthCheck':
+        return HealthCheck(handler, dingtalk_client, provider_pool,
+                           max_queue_per_worker=get_float_env(HealthEnv.MAX_QUEUE_PER_WORKER.value,
+                                                              HealthCheck.DEFAULT_MAX_QUEUE_PER_WORKER),
+                           grace_period=get_float_env(HealthEnv.GRACE_PERIOD.value, HealthCheck.DEFAULT_GRACE_PERIOD))
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Reads the queue depth from the coordination backend, which may be blocking I/O: run it out of the event loop.
+        """
+        handler = self.handler
+        alive_workers = handler.alive_workers
+        busy_workers = handler.busy_workers
+        queue_depth = handler.coordination.size()
+        queue_capacity = handler.max_workers * self.max_queue_per_worker
+
+        reasons = []
+        if handler.draining or handler.stopped:
+            reasons.append("draining")
+        if alive_workers == 0:
+            reasons.append("no live worker")
+        elif alive_workers >= handler.max_workers and queue_depth >= queue_capacity:
+            reasons.append("saturated")
+
+        upstream = {}
+        if self.provider_pool is not None:
+            upstream["chatbot_server"] = self.provider_pool.stats()
+            if len(self.provider_pool) > 1 and all(target["ejected"] for target in upstream["chatbot_server"]):
+                reasons.append("every chatbot server target ejected")
+        if self.dingtalk_client.route_selector is not None:
+            upstream["dingtalk_routes"] = self.dingtalk_client.route_selector.stats()
+
+        now = time.perf_counter()  # the clock of the access token expiries
+        access_tokens = {}
+        for app_key in self.dingtalk_client.app_keys.split(','):
+            expires_at = self.dingtalk_client.access_token_expires.get(app_key.strip())
+            access_tokens[app_key.strip()] = {
+                "valid": expires_at is not None and now < expires_at,
+                "expires_in": round(expires_at - now) if expires_at is not None else None,
+            }
+
+        return {
+            "alive": alive_workers > 0 or handler.stopped,
+            "ready": len(reasons) == 0,
+            "reasons": reasons,
+            "draining": handler.draining,
+            "workers": {"alive": alive_workers, "busy": busy_workers, "max": handler.max_workers},
+            "queue": {"depth": queue_depth, "capacity": queue_capacity, "shared": handler.coordination.shared},
+            "upstream": upstream,
+            "access_tokens": access_tokens,
+        }
@@ -0,0 +1,73 @@
+import logging
+import time
+import uuid
+from enum import Enum
+
+from components.im_side.dingtalk_client import DingtalkClient
+
+
+class DingtalkCardEnv(Enum):
+    TEMPLATE_ID = "DINGTALK_CARD_TEMPLATE_ID"
+    UPDATE_INTERVAL = "DINGTALK_CARD_UPDATE_INTERVAL"
+
+
+class StreamingCard:
+    """
+    One answer shown in one interactive card, its content replaced as the answer grows.
+    Updates are throttled to one per `update_interval` seconds, the final one is always sent.
+    The card template needs a markdown variable named `content`, updatable by streaming.
+    """
+
+    CONTENT_KEY = "content"
+    DEFAULT_UPDATE_INTERVAL = 0.5
+
+    def __init__(self,
+                 dingtalk_client: DingtalkClient,
+                 app_key: str,
+                 card_template_id: str,
+                 update_interval: float = DEFAULT_UPDATE_INTERVAL):
+        self.dingtalk_client = dingtalk_client
+        self.app_key = app_key
+        self.card_template_id = card_template_id
+        self.update_interval = update_interval
+        self.out_track_id = uuid.uuid4().hex
+        self.updates = 0
+        self.finished = False
+
+        self._sent_content = ""
+        self._sent_at: float = None
+
+    async def create(self, robot_code: str, conversation_id: str, user_id: str, is_group_chat: bool) -> None:
+        await self.dingtalk_client.create_card(self.app_key, self.card_template_id, self.out_track_id,
+                                               {self.CONTENT_KEY: ""}, robot_code, conversation_id, user_id,
+                                               is_group_chat)
+        self._sent_at = time.monotonic()
+
+    async def update(self, content: str) -> None:
+        """
+        Show the content so far, unless the card has been updated less than `update_interval` ago.
+        A failed update is skipped, the next one replaces the whole content anyway.
+        """
+        if self.finished or content == self._sent_content \
+                or time.monotonic() - self._sent_at < self.update_interval:
+            return
+        try:
+            await self._stream(content)
+        except Exception as e:
+            logging.warning("Failed to update card %s: %s" % (self.out_track_id, e))
+
+    async def finish(self, content: str, error: bool = False) -> None:
+        """
+        Show the whole answer, the card is no longer updated afterwards.
+        """
+        if self.finished:
+            return
+        await self._stream(content, finalize=True, error=error)
+        self.finished = True
+
+    async def _stream(self, content: str, finalize: bool = False, error: bool = False) -> None:
+        self._sent_at = time.monotonic()
+        await self.dingtalk_client.stream_card(self.app_key, self.out_track_id, self.CONTENT_KEY, content,
+                                               finalize=finalize, error=error)
+        self._sent_content = content
+        self.updates += 1
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 import hmac
@@ -5,10 +6,17 @@ import json
 import logging
 import os
 import time
+import uuid
+from contextlib import asynccontextmanager
 from urllib.parse import urlunparse, urlparse
 
 import aiohttp
 
+from components import metrics
+from components.im_side.route_selector import RouteSelector
+from components.im_side.signature_verifier import SignatureVerifier, SignatureVerifierEnv
+from components.tools import get_float_env
+
 
 def _hmac_sha256_base64_encode(key, msg):
     hmac_key = bytes(key, 'utf-8')
@@ -21,27 +29,43 @@ def _hmac_sha256_base64_encode(key, msg):
 
 
 class DingtalkClient:
+    # Idle pooled connections are closed after this, the workers keep theirs warm more often.
+    KEEPALIVE_TIMEOUT = 60.0
+    DNS_CACHE_TTL = 300.0
+    WARM_UP_TIMEOUT = 5.0
+
     def __init__(
             self,
             rewrite_host=None,
             rewrite_pathname=None,
             app_keys=None,
-            secret_keys=None
+            secret_keys=None,
+            server_base_url=None
 
     ):
         self.rewrite_host = rewrite_host
         self.rewrite_pathname = rewrite_pathname
+        self.server_base_url = server_base_url
         self.app_keys = app_keys
         self.secret_keys = secret_keys
 
         self.access_token = {}
         self.access_token_expires = {}
+        # one session per event loop (the server's and each worker's), for its pooled connections
+        self._sessions = {}
 
         if rewrite_host is None:
             self.rewrite_host = os.environ.get("REWRITE_DINGTALK_HOST")
         if rewrite_pathname is None:
             self.rewrite_pathname = os.getenv("REWRITE_DINGTALK_PATHNAME")
-        if self.rewrite_host is not None:
+        if server_base_url is None:
+            self.server_base_url = os.getenv("DINGTALK_SERVER_BASE_URL")
+        if self.server_base_url is not None:
+            logging.info("Dingtalk Server (all APIs) use base url: %s" % self.server_base_url)
+        # Direct or through one of the rewrite hosts, whichever is faster at the moment, when enabled.
+        self.route_selector = RouteSelector.from_env(self.rewrite_host, self.rewrite_pathname) \
+            if self.server_base_url is None else None
+        if self.rewrite_host is not None and self.route_selector is None:
             logging.info("Dingtalk Server use base url: %s"
                          % self._rewrite_server_url("https://oapi.dingtalk.com/robot/sendBySession"))
 
@@ -57,27 +81,133 @@ class DingtalkClient:
             logging.error("Need to set environment variable: DINGTALK_APP_SECRET.")
             raise ValueError("You need to set a DingTalk App Secret")
 
+        self.signature_verifier = SignatureVerifier(
+            self.app_keys, self.secret_keys,
+            max_age=get_float_env(SignatureVerifierEnv.MAX_AGE.value, SignatureVerifier.DEFAULT_MAX_AGE),
+            replay_cache_size=int(get_float_env(SignatureVerifierEnv.REPLAY_CACHE_SIZE.value,
+                                                SignatureVerifier.DEFAULT_REPLAY_CACHE_SIZE)))
+
     def _rewrite_server_url(self, url) -> str:
+        if self.server_base_url is not None:  # every API served by the same server (a stand-in for benchmarks)
+            base_url = urlparse(self.server_base_url)
+            parsed_url = urlparse(url)
+            return str(urlunparse(parsed_url._replace(scheme=base_url.scheme, netloc=base_url.netloc,
+                                                      path=base_url.path.rstrip('/') + parsed_url.path)))
         if self.rewrite_host is None or '/v1.0/' in url:  # the `V1` interface will require whitelist verification!
             return url
         parsed_url = urlparse(url)
         return str(urlunparse(parsed_url._replace(netloc=self.rewrite_host,
                                                   path=self.rewrite_pathname + parsed_url.path)))
 
-    def check_signature(self, timestamp, signature) -> str:
+    def _session(self) -> aiohttp.ClientSession:
+        """
+        The session of the running event loop, created on first use.
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                                                                           ttl_dns_cache=self.DNS_CACHE_TTL))
+            self._sessions[loop] = session
+        return session
+
+    async def close(self) -> None:
+        """
+        Close the connections of the running event loop, to be called before the loop ends.
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def warm_up(self, access_tokens: bool = True) -> None:
+        """
+        Open a pooled connection to each DingTalk server, or keep it open, for the running event loop:
+        DNS, TCP and TLS are done before the messages are sent. Access tokens of all app keys are fetched too,
+        again once they are about to expire. Failures are only logged, sending will try again anyway.
+        """
+        probes = {}  # url -> route it goes through (None when not routed)
+        for url in ("https://oapi.dingtalk.com/", "https://api.dingtalk.com/v1.0/"):
+            if self._is_routed(url):
+                # every route, their latencies are measured at the same time
+                probes.update((route.rewrite(url), route) for route in self.route_selector.routes)
+            else:
+                parsed_url = urlparse(self._rewrite_server_url(url))
+                probes[urlunparse((parsed_url.scheme, parsed_url.netloc, "/", "", "", ""))] = None
+        for probe_url, route in probes.items():
+            start_time = time.perf_counter()
+            try:
+                async with self._session().head(probe_url,
+                                                timeout=aiohttp.ClientTimeout(total=self.WARM_UP_TIMEOUT)) as response:
+                    await response.read()
+                if route is not None:
+                    self.route_selector.observe(route, time.perf_counter() - start_time, failed=response.status >= 500)
+            except Exception as e:
+                if route is not None:
+                    self.route_selector.observe(route, time.perf_counter() - start_time, failed=True)
+                logging.warning("Failed to warm up the connection to %s: %s" % (probe_url, e))
+        if access_tokens:
+            for app_key in self.app_keys.split(','):
+                try:
+                    await self._refresh_access_token(app_key.strip())
+                except Exception as e:
+                    logging.warning("Failed to fetch the access_token of %s: %s" % (app_key, e))
+
+    async def keep_warm(self, interval: float) -> None:
+        """
+        Warm up the connections of the running event loop every `interval` seconds, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.warm_up()
+
+    def _is_routed(self, url) -> bool:
+        return self.route_selector is not None and '/v1.0/' not in url
+
+    @asynccontextmanager
+    async def _request(self, method, url, **kwargs):
+        """
+        Send the request, through the route chosen for it when routed, and yield the response.
+        The next route is tried when the connection fails, or whatever the failure for a GET:
+        a message may have been delivered otherwise, it is not sent again.
+        """
+        routes = self.route_selector.choose() if self._is_routed(url) else [None]
+        for index, route in enumerate(routes):
+            start_time = time.perf_counter()
+            try:
+                response = await self._session().request(
+                    method, self._rewrite_server_url(url) if route is None else route.rewrite(url), **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if route is None:
+                    raise e
+                self.route_selector.observe(route, time.perf_counter() - start_time, failed=True)
+                if index == len(routes) - 1 or not (method == "GET" or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise e
+                logging.warning("DingTalk route %s failed (%s), trying %s." % (route, type(e).__name__,
+                                                                                 routes[index + 1]))
+                continue
+            if route is not None:
+                self.route_selector.observe(route, time.perf_counter() - start_time, failed=response.status >= 500)
+            try:
+                yield response
+            finally:
+                response.release()
+            return
+
+    def check_signature(self, timestamp, signature, robot_code=None) -> str:
         """
         check_signature
         :param timestamp:
         :param signature:
+        :param robot_code: of the message, its secret is tried first
         :return: app_key
         """
-        for index, secret_key in enumerate(self.secret_keys.split(',')):
-            contents = timestamp + "\n" + secret_key
-            signed = _hmac_sha256_base64_encode(secret_key, contents)
-            if signed == signature:
-                return self.app_keys.split(',')[index]
-        logging.error("DINGTALK_APP_SECRET not right.", self.secret_keys)
-        raise SystemError("DingTalk signature verification failed.")
+        return self.signature_verifier.verify(timestamp, signature, robot_code)
+
+    def check_signature_headers(self, timestamp, signature) -> None:
+        """
+        Window and replay checks of the signature, before the message is parsed.
+        """
+        self.signature_verifier.check_headers(timestamp, signature)
 
     async def send_markdown(self, title, text, session_webhook):
         url = session_webhook
@@ -101,6 +231,12 @@ class DingtalkClient:
             }
             await self._send_to_dingtalk_server(data, url)
 
+    async def send_message(self, data, session_webhook):
+        """
+        Send a message already formatted (text, markdown ...) through the session webhook.
+        """
+        await self._send_to_dingtalk_server(data, session_webhook)
+
     async def one_to_one_text(self, text, robotCode, userId, app_key):
         if len(text.strip()) > 0:
             url = "https://api.dingtalk.com/v1.0/robot/oToMessages/batchSend"
@@ -114,7 +250,48 @@ class DingtalkClient:
             }
             await self._send_to_dingtalk_server(data, url, app_key)
 
-    async def _send_to_dingtalk_server(self, data, url, app_key=None):
+    async def create_card(self, app_key, card_template_id, out_track_id, card_data, robot_code, conversation_id,
+                          user_id, is_group_chat):
+        """
+        Create an interactive card and deliver it to the conversation, its content is then updated with `stream_card`.
+        https://open.dingtalk.com/document/orgapp/create-and-deliver-cards
+        """
+        url = "https://api.dingtalk.com/v1.0/card/instances/createAndDeliver"
+        data = {
+            "cardTemplateId": card_template_id,
+            "outTrackId": out_track_id,
+            "cardData": {"cardParamMap": card_data},
+            "callbackType": "STREAM",
+            "userIdType": 1  # userid
+        }
+        if is_group_chat:
+            data["openSpaceId"] = "dtv1.card//IM_GROUP.%s" % conversation_id
+            data["imGroupOpenSpaceModel"] = {"supportForward": True}
+            data["imGroupOpenDeliverModel"] = {"robotCode": robot_code}
+        else:
+            data["openSpaceId"] = "dtv1.card//IM_ROBOT.%s" % user_id
+            data["imRobotOpenSpaceModel"] = {"supportForward": True}
+            data["imRobotOpenDeliverModel"] = {"spaceType": "IM_ROBOT"}
+        await self._send_to_dingtalk_server(data, url, app_key)
+
+    async def stream_card(self, app_key, out_track_id, key, content, finalize=False, error=False):
+        """
+        Replace the content of a card variable, the card shows it as it is updated.
+        https://open.dingtalk.com/document/orgapp/api-streamingupdate
+        """
+        url = "https://api.dingtalk.com/v1.0/card/streaming"
+        data = {
+            "outTrackId": out_track_id,
+            "guid": uuid.uuid4().hex,
+            "key": key,
+            "content": content,
+            "isFull": True,
+            "isFinalize": finalize,
+            "isError": error
+        }
+        await self._send_to_dingtalk_server(data, url, app_key, method="PUT")
+
+    async def _send_to_dingtalk_server(self, data, url, app_key=None, method="POST"):
 
         # By using this API to send messages proactively, you can obtain a message ID,
         # which helps to identify the message when being referenced.
@@ -125,43 +302,45 @@ class DingtalkClient:
         # Through the webhook interface, it does not require whitelist verification,
         # but if the `V1` interface is used, it will strictly require whitelist verification!
 
-        url = self._rewrite_server_url(url)
-
         headers = {'Content-Type': 'application/json'}
 
         if app_key is not None:
             headers['x-acs-dingtalk-access-token'] = await self._refresh_access_token(app_key)
 
+        api = urlparse(url).path.rsplit('/', 1)[-1]  # sendBySession for the session webhooks
         dingtalk_start_time = time.perf_counter()
         try:
-            logging.info("Sending messages to {} ...".format(url))
+            # once per segment of every answer: debug lines, sampled by LOG_DEBUG_SAMPLE_RATE
+            logging.debug("Sending messages to %s ...", url)
 
             payload = json.dumps(data)
             # https://open.dingtalk.com/document/orgapp/robot-message-types-and-data-format
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=payload, headers=headers) as response:
-                    dingtalk_end_time = time.perf_counter()
-                    logging.info(
-                        "Request duration: dingtalk {:.3f} s.".format((dingtalk_end_time - dingtalk_start_time)))
-                    response_json = await response.json()
-                    if 'errcode' in response_json and response_json['errcode'] != 0:  # old API response 'errcode'
-                        raise RuntimeError(
-                            "Error while call dingtalk :" + json.dumps(response_json, ensure_ascii=False))
-                    elif 'code' in response_json:  # new api (v1.0) has 'code' when error
-                        raise RuntimeError(
-                            "Error while call dingtalk :" + json.dumps(response_json, ensure_ascii=False))
-                    elif 'processQueryKey' in response_json:  # new api (v1.0) has 'processQueryKey' when sent
-                        logging.info('Message sent successfully - %s' % response_json['processQueryKey'])
+            async with self._request(method, url, data=payload, headers=headers) as response:
+                dingtalk_end_time = time.perf_counter()
+                logging.debug("Request duration: dingtalk %.3f s.", dingtalk_end_time - dingtalk_start_time)
+                response_json = await response.json()
+                if 'errcode' in response_json and response_json['errcode'] != 0:  # old API response 'errcode'
+                    raise RuntimeError(
+                        "Error while call dingtalk :" + json.dumps(response_json, ensure_ascii=False))
+                elif 'code' in response_json:  # new api (v1.0) has 'code' when error
+                    raise RuntimeError(
+                        "Error while call dingtalk :" + json.dumps(response_json, ensure_ascii=False))
+                elif 'processQueryKey' in response_json:  # new api (v1.0) has 'processQueryKey' when sent
+                    logging.debug('Message sent successfully - %s', response_json['processQueryKey'])
+            metrics.DINGTALK_SEND_SECONDS.labels(api=api, outcome="ok").observe(
+                time.perf_counter() - dingtalk_start_time)
         except Exception as e:
             dingtalk_end_time = time.perf_counter()
             logging.error(
                 "Error Request duration: dingtalk {:.3f} s.".format((dingtalk_end_time - dingtalk_start_time)))
+            metrics.DINGTALK_SEND_SECONDS.labels(api=api, outcome="error").observe(
+                dingtalk_end_time - dingtalk_start_time)
             raise e
 
     async def _refresh_access_token(self, app_key) -> str:
         if app_key not in self.access_token_expires or time.perf_counter() > self.access_token_expires[app_key]:
-            api_url = self._rewrite_server_url("https://oapi.dingtalk.com/gettoken")
+            api_url = "https://oapi.dingtalk.com/gettoken"
 
             logging.info("Refresh access_token {} ...".format(app_key))
             params = {
@@ -174,17 +353,16 @@ class DingtalkClient:
             dingtalk_access_token_start_time = time.perf_counter()
 
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(api_url, params=params) as response:
-                        dingtalk_access_token_end_time = time.perf_counter()
-                        logging.info("Request duration: refresh access_token {:.3f} s.".format(
-                            (dingtalk_access_token_end_time - dingtalk_access_token_start_time)))
-                        response_json = await response.json()
-                        if response_json['errcode'] != 0:
-                            raise RuntimeError("Error while refresh access_token :" + json.dumps(response_json,
-                                                                                                 ensure_ascii=False))
-                        self.access_token_expires[app_key] = time.perf_counter() + response_json['expires_in'] * 0.8
-                        self.access_token[app_key] = response_json['access_token']
+                async with self._request("GET", api_url, params=params) as response:
+                    dingtalk_access_token_end_time = time.perf_counter()
+                    logging.info("Request duration: refresh access_token {:.3f} s.".format(
+                        (dingtalk_access_token_end_time - dingtalk_access_token_start_time)))
+                    response_json = await response.json()
+                    if response_json['errcode'] != 0:
+                        raise RuntimeError("Error while refresh access_token :" + json.dumps(response_json,
+                                                                                             ensure_ascii=False))
+                    self.access_token_expires[app_key] = time.perf_counter() + response_json['expires_in'] * 0.8
+                    self.access_token[app_key] = response_json['access_token']
             except Exception as e:
                 dingtalk_access_token_end_time = time.perf_counter()
                 logging.error("Error Request duration:  refresh access_token {:.3f} s.".format(
@@ -194,7 +372,7 @@ class DingtalkClient:
 
     async def get_file_download_url(self, app_key, download_code):
         access_token = await self._refresh_access_token(app_key)
-        api_url = self._rewrite_server_url("https://api.dingtalk.com/v1.0/robot/messageFiles/download")
+        api_url = "https://api.dingtalk.com/v1.0/robot/messageFiles/download"
         payload = json.dumps({
             "downloadCode": download_code,
             "robotCode": app_key
@@ -206,17 +384,16 @@ class DingtalkClient:
         dingtalk_api_start_time = time.perf_counter()
         try:
             logging.debug("Require  download url of [{}]{} ...".format(app_key, download_code))
-            async with aiohttp.ClientSession() as session:
-                async with session.post(api_url, data=payload, headers=headers) as response:
-                    dingtalk_api_end_time = time.perf_counter()
-                    logging.info("Request duration: require download url {:.3f} s.".format(
-                        (dingtalk_api_end_time - dingtalk_api_start_time)))
-                    response_json = await response.json()
-                    if 'downloadUrl' not in response_json:
-                        raise RuntimeError("Error while require download url :" + json.dumps(response_json,
-                                                                                             ensure_ascii=False))
-                    logging.debug("Required download url is [{}]{}".format(app_key, response_json['downloadUrl']))
-                    return response_json['downloadUrl']
+            async with self._request("POST", api_url, data=payload, headers=headers) as response:
+                dingtalk_api_end_time = time.perf_counter()
+                logging.info("Request duration: require download url {:.3f} s.".format(
+                    (dingtalk_api_end_time - dingtalk_api_start_time)))
+                response_json = await response.json()
+                if 'downloadUrl' not in response_json:
+                    raise RuntimeError("Error while require download url :" + json.dumps(response_json,
+                                                                                         ensure_ascii=False))
+                logging.debug("Required download url is [{}]{}".format(app_key, response_json['downloadUrl']))
+                return response_json['downloadUrl']
         except Exception as e:
             dingtalk_api_end_time = time.perf_counter()
             logging.error("Error Request duration: require download url {:.3f} s.".format(
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from enum import Enum
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import quote
+
+import aiohttp
+
+from components.im_side.dingtalk_client import DingtalkClient
+from components.tools import is_true, get_float_env
+
+
+class DingtalkStreamEnv(Enum):
+    ENABLE = "DINGTALK_STREAM_ENABLE"
+    HEARTBEAT_INTERVAL = "DINGTALK_STREAM_HEARTBEAT_INTERVAL"
+    MAX_BACKOFF = "DINGTALK_STREAM_MAX_BACKOFF"
+
+
+# https://open.dingtalk.com/document/direct-connect/stream-mode-protocol-access-description
+OPEN_CONNECTION_URL = "https://api.dingtalk.com/v1.0/gateway/connections/open"
+BOT_MESSAGE_TOPIC = "/v1.0/im/bot/messages/get"
+
+
+def _ack(headers: dict, data, code: int = 200, message: str = "OK") -> str:
+    return json.dumps({"code": code, "headers": {"contentType": "application/json",
+                                                 "messageId": headers.get("messageId")},
+                       "message": message, "data": data if isinstance(data, str) else json.dumps(data)})
+
+
+class DingtalkStreamClient:
+    """
+    Receives the robot messages through a DingTalk Stream mode WebSocket per app key, instead of the HTTP callback:
+    no public endpoint and no signature to check, messages come over a connection kept open.
+    Each message is passed to `on_message(app_key, message)` and acknowledged once it returns,
+    a reply other than empty is sent to the session webhook.
+    """
+
+    DEFAULT_HEARTBEAT_INTERVAL = 10.0  # seconds between pings, the connection is dropped when a pong is missed
+    INITIAL_BACKOFF = 1.0
+    DEFAULT_MAX_BACKOFF = 60.0
+    USER_AGENT = "chatGPDing/dingtalk-stream"
+
+    def __init__(self,
+                 dingtalk_client: DingtalkClient,
+                 on_message: Callable[[str, dict], Awaitable[dict]],
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF):
+        self.dingtalk_client = dingtalk_client
+        self.on_message = on_message
+        self.heartbeat_interval = heartbeat_interval
+        self.max_backoff = max_backoff
+        self.connections = 0  # connections opened, reconnections included
+
+        self._tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def from_env(dingtalk_client: DingtalkClient,
+                 on_message: Callable[[str, dict], Awaitable[dict]]) -> Optional['DingtalkStreamClient']:
+        if not is_true(os.getenv(DingtalkStreamEnv.ENABLE.value)):
+            return None
+        client = DingtalkStreamClient(
+            dingtalk_client, on_message,
+            heartbeat_interval=get_float_env(DingtalkStreamEnv.HEARTBEAT_INTERVAL.value,
+                                             DingtalkStreamClient.DEFAULT_HEARTBEAT_INTERVAL),
+            max_backoff=get_float_env(DingtalkStreamEnv.MAX_BACKOFF.value, DingtalkStreamClient.DEFAULT_MAX_BACKOFF))
+        logging.info("Dingtalk Stream mode enabled (heartbeat %.0f s)." % client.heartbeat_interval)
+        return client
+
+    def start(self) -> None:
+        """
+        Connect every app key, from the running event loop.
+        """
+        app_keys = self.dingtalk_client.app_keys.split(',')
+        secret_keys = self.dingtalk_client.secret_keys.split(',')
+        for app_key, secret_key in zip(app_keys, secret_keys):
+            self._tasks.append(asyncio.get_running_loop().create_task(self._keep_connected(app_key, secret_key)))
+
+    async def stop(self) -> None:
+        """
+        Close the connections, once the messages being handled are acknowledged.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _open_connection(self, session: aiohttp.ClientSession, app_key: str, secret_key: str) -> str:
+        """
+        :return: url of the WebSocket, with its one time ticket
+        """
+        url = self.dingtalk_client._rewrite_server_url(OPEN_CONNECTION_URL)
+        payload = {
+            "clientId": app_key,
+            "clientSecret": secret_key,
+            "subscriptions": [{"type": "CALLBACK", "topic": BOT_MESSAGE_TOPIC}],
+            "ua": self.USER_AGENT
+        }
+        async with session.post(url, json=payload) as response:
+            response_json = await response.json()
+            if 'endpoint' not in response_json or 'ticket' not in response_json:
+                raise RuntimeError("Error while open stream connection :" + json.dumps(response_json,
+                                                                                     ensure_ascii=False))
+            return response_json['endpoint'] + "?ticket=" + quote(response_json['ticket'])
+
+    async def _keep_connected(self, app_key: str, secret_key: str) -> None:
+        backoff = self.INITIAL_BACKOFF
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    endpoint = await self._open_connection(session, app_key, secret_key)
+                    async with session.ws_connect(endpoint, heartbeat=self.heartbeat_interval) as websocket:
+                        self.connections += 1
+                        logging.info("Dingtalk Stream connected: %s" % app_key)
+                        backoff = self.INITIAL_BACKOFF
+                        await self._receive(app_key, websocket)
+                    logging.warning("Dingtalk Stream disconnected: %s" % app_key)
+                except Exception as e:
+                    logging.error("Dingtalk Stream connection of %s failed: %s: %s" % (app_key, type(e).__name__, e))
+                # Full jitter, so that the connections of all the processes do not come back at once.
+                await asyncio.sleep(random.uniform(backoff / 2, backoff))
+                backoff = min(self.max_backoff, backoff * 2)
+
+    async def _receive(self, app_key: str, websocket: aiohttp.ClientWebSocketResponse) -> None:
+        send_lock = asyncio.Lock()
+        pending = set()  # messages being handled
+
+        async def send(text: str) -> None:
+            async with send_lock:
+                await websocket.send_str(text)
+
+        try:
+            await self._dispatch(app_key, websocket, send, pending)
+        finally:
+            # Acknowledge the messages being handled before the connection is closed (on shutdown too).
+            if len(pending) > 0:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _dispatch(self, app_key: str, websocket: aiohttp.ClientWebSocketResponse,
+                        send: Callable[[str], Awaitable[None]], pending: set) -> None:
+        async for frame in websocket:
+            if frame.type != aiohttp.WSMsgType.TEXT:
+                break  # closed, or error
+            frame_json = json.loads(frame.data)
+            headers = frame_json.get('headers', {})
+            topic = headers.get('topic')
+            if frame_json.get('type') == 'SYSTEM':
+                if topic == 'ping':
+                    await send(_ack(headers, frame_json.get('data', "")))
+                elif topic == 'disconnect':
+                    # The server closes the connection soon, open another one (it still takes the pending acks).
+                    logging.info("Dingtalk Stream asked to reconnect: %s" % app_key)
+                    break
+            elif frame_json.get('type') == 'CALLBACK' and topic == BOT_MESSAGE_TOPIC:
+                # Handled apart, a slow message (downloading a picture) does not hold the others.
+                task = asyncio.create_task(self._handle(app_key, headers, json.loads(frame_json['data']), send))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            else:
+                await send(_ack(headers, {"status": "SUCCESS", "message": "ignored"}))
+
+    async def _handle(self, app_key: str, headers: dict, message: dict,
+                      send: Callable[[str], Awaitable[None]]) -> None:
+        try:
+            reply = await self.on_message(app_key, message)
+            # An HTTP callback returns its reply in the response, a Stream mode one goes through the webhook.
+            if reply is not None and reply.get('msgtype') != 'empty':
+                await self.dingtalk_client.send_message(reply, message['sessionWebhook'])
+            ack = _ack(headers, {"response": None})
+        except Exception as e:
+            logging.error("Error while handling stream message %s: %s: %s"
+                          % (headers.get('messageId'), type(e).__name__, e))
+            ack = _ack(headers, {"response": None}, code=500, message=str(e))
+        try:
+            await send(ack)
+        except Exception as e:
+            # Not acknowledged, DingTalk delivers the message again and it is ignored as a duplicate.
+            logging.warning("Failed to acknowledge stream message %s: %s" % (headers.get('messageId'), e))
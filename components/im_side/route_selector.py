@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import List, Optional
+from urllib.parse import urlparse, urlunparse
+
+from components.tools import is_true, get_float_env
+
+
+class DingtalkRouteEnv(Enum):
+    ENABLE = "DINGTALK_ROUTE_SELECTION_ENABLE"
+    PROBE_INTERVAL = "DINGTALK_ROUTE_PROBE_INTERVAL"
+
+
+class DingtalkRoute:
+    """
+    A way to the DingTalk server: direct, or through a rewrite host (a reverse proxy) under a path prefix,
+    with the statistics of the calls it carried.
+    """
+
+    def __init__(self, host: str = None, pathname: str = None):
+        """
+        :param host: None for direct
+        """
+        self.host = host
+        self.pathname = pathname if pathname is not None else ""
+
+        self.latency_ewma: float = None  # seconds to the response headers
+        self.outcomes = deque()  # (time.monotonic(), failed) within RouteSelector.ERROR_RATE_WINDOW
+        self.used_at = 0.0  # time.monotonic() of the last call or probe
+        self.consecutive_failures = 0
+        self.avoided_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return "direct" if self.host is None else self.host + self.pathname
+
+    def rewrite(self, url: str) -> str:
+        if self.host is None:
+            return url
+        parsed_url = urlparse(url)
+        return str(urlunparse(parsed_url._replace(netloc=self.host, path=self.pathname + parsed_url.path)))
+
+    def error_rate(self) -> float:
+        if len(self.outcomes) == 0:
+            return 0.0
+        return sum(1 for _, failed in self.outcomes if failed) / len(self.outcomes)
+
+    def is_avoided(self, now: float) -> bool:
+        return now < self.avoided_until
+
+    def __str__(self):
+        return self.name
+
+
+class RouteSelector:
+    """
+    Chooses the route of each call to the DingTalk server (oapi.dingtalk.com, the `/v1.0/` APIs are never rewritten):
+    the fastest one by the moving average of its latencies, among the routes not failing.
+    A failing route is avoided for a while, growing exponentially, and the call falls back to the next one.
+    A route not used for `probe_interval` seconds carries the next call, so a route getting faster is noticed.
+    Shared by all the event loops.
+    """
+
+    LATENCY_EWMA_ALPHA = 0.2
+    ERROR_RATE_WINDOW = 60.0
+    AVOID_BASE_SECONDS = 10.0
+    AVOID_MAX_SECONDS = 300.0
+    DEFAULT_PROBE_INTERVAL = 60.0
+
+    def __init__(self, routes: List[DingtalkRoute], probe_interval: float = DEFAULT_PROBE_INTERVAL):
+        if len(routes) == 0:
+            raise ValueError("A route selector needs at least one route.")
+        self.routes = routes
+        self.probe_interval = probe_interval
+        self._best: DingtalkRoute = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env(rewrite_hosts: str, rewrite_pathnames: str) -> Optional['RouteSelector']:
+        """
+        Direct, and each of the comma separated rewrite hosts, paired one by one with the pathnames
+        (a single pathname is shared by all the hosts).
+        """
+        if not is_true(os.getenv(DingtalkRouteEnv.ENABLE.value)):
+            return None
+        hosts = [host.strip() for host in (rewrite_hosts or "").split(',') if host.strip()]
+        pathnames = [pathname.strip() for pathname in (rewrite_pathnames or "").split(',')]
+        routes = [DingtalkRoute()]
+        for index, host in enumerate(hosts):
+            routes.append(DingtalkRoute(host, pathnames[index] if index < len(pathnames) else pathnames[-1]))
+        selector = RouteSelector(routes, get_float_env(DingtalkRouteEnv.PROBE_INTERVAL.value,
+                                                       RouteSelector.DEFAULT_PROBE_INTERVAL))
+        logging.info("DingTalk route selection between: %s" % ", ".join(route.name for route in routes))
+        return selector
+
+    def choose(self) -> List[DingtalkRoute]:
+        """
+        :return: the route of a new call, followed by the ones to fall back to
+        """
+        with self._lock:
+            now = time.monotonic()
+            available = [route for route in self.routes if not route.is_avoided(now)]
+            avoided = sorted((route for route in self.routes if route.is_avoided(now)),
+                             key=lambda r: r.avoided_until)
+            available.sort(key=lambda r: r.latency_ewma if r.latency_ewma is not None else 0.0)
+            stale = [route for route in available if now - route.used_at >= self.probe_interval]
+            if len(stale) > 0:
+                # taken by this call, the other calls meanwhile keep the best route
+                stale[0].used_at = now
+                available.remove(stale[0])
+                available.insert(0, stale[0])
+            return available + avoided
+
+    def observe(self, route: DingtalkRoute, seconds: float, failed: bool = False) -> None:
+        """
+        A call (or probe) carried by the route, failed means the route is to blame (connection, timeout, 5xx).
+        """
+        with self._lock:
+            now = time.monotonic()
+            route.used_at = now
+            route.outcomes.append((now, failed))
+            while len(route.outcomes) > 0 and route.outcomes[0][0] < now - self.ERROR_RATE_WINDOW:
+                route.outcomes.popleft()
+
+            if not failed:
+                route.consecutive_failures = 0
+                if route.latency_ewma is None:
+                    route.latency_ewma = seconds
+                else:
+                    route.latency_ewma += self.LATENCY_EWMA_ALPHA * (seconds - route.latency_ewma)
+            else:
+                route.consecutive_failures += 1
+                if len(self.routes) > 1 and not route.is_avoided(now):
+                    duration = min(self.AVOID_BASE_SECONDS * (2 ** (route.consecutive_failures - 1)),
+                                   self.AVOID_MAX_SECONDS)
+                    route.avoided_until = now + duration
+                    logging.warning("DingTalk route %s avoided for %.0f s (consecutive failures: %d, "
+                                    "error rate: %.2f)." % (route, duration, route.consecutive_failures,
+                                                            route.error_rate()))
+
+            available = [r for r in self.routes if not r.is_avoided(now) and r.latency_ewma is not None]
+            best = min(available, key=lambda r: r.latency_ewma) if len(available) > 0 else None
+            if best is not None and best is not self._best:
+                self._best = best
+                logging.info("DingTalk calls go through route %s (%.0f ms)." % (best, best.latency_ewma * 1000))
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "route": route.name,
+                "latency_ewma": route.latency_ewma,
+                "error_rate": route.error_rate(),
+                "avoided": route.is_avoided(now),
+            } for route in self.routes]
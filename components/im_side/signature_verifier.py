@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+
+
+class SignatureVerifierEnv(Enum):
+    MAX_AGE = "DINGTALK_SIGNATURE_MAX_AGE"
+    REPLAY_CACHE_SIZE = "DINGTALK_SIGNATURE_REPLAY_CACHE_SIZE"
+
+
+class SignatureVerifier:
+    """
+    Verifies the signature of the DingTalk callbacks: base64(HMAC-SHA256(secret, timestamp + "\\n" + secret)).
+    Keys are parsed and the HMAC keys prepared once. Timestamps outside the window are rejected before any HMAC,
+    and a (timestamp, sign) pair already accepted is rejected as a replay.
+    Given the robot code of the message, only its secret is tried, whatever the number of app keys: a signature not
+    made with it is rejected. The other secrets are tried when the robot code is missing or unknown.
+    """
+
+    DEFAULT_MAX_AGE = 3600.0  # seconds, as DingTalk recommends
+    DEFAULT_REPLAY_CACHE_SIZE = 10000
+
+    def __init__(self,
+                 app_keys: str,
+                 secret_keys: str,
+                 max_age: float = DEFAULT_MAX_AGE,
+                 replay_cache_size: int = DEFAULT_REPLAY_CACHE_SIZE):
+        """
+        :param app_keys: comma separated, paired one by one with the secrets
+        :param max_age: accepted difference in seconds between the timestamp and now, either way
+        :param replay_cache_size: accepted signatures remembered, 0 to disable the replay check
+        """
+        self.max_age = max_age
+        self.replay_cache_size = replay_cache_size
+
+        # app key -> (secret, HMAC prepared with it), in the order of the configuration
+        self._secrets = OrderedDict()
+        for app_key, secret_key in zip(app_keys.split(','), secret_keys.split(',')):
+            self._secrets[app_key.strip()] = (secret_key.strip(),
+                                              hmac.new(secret_key.strip().encode('utf-8'), digestmod=hashlib.sha256))
+        self._seen = OrderedDict()  # (timestamp, sign) -> timestamp in seconds, oldest first
+        self._lock = threading.Lock()
+
+    def _sign(self, app_key: str, timestamp: str) -> str:
+        secret_key, prepared = self._secrets[app_key]
+        mac = prepared.copy()
+        mac.update((timestamp + "\n" + secret_key).encode('utf-8'))
+        return base64.b64encode(mac.digest()).decode('utf-8')
+
+    def check_headers(self, timestamp: str, signature: str) -> float:
+        """
+        The checks needing no secret, cheap enough to run before the body of the callback is read.
+        :return: timestamp in seconds
+        """
+        if timestamp is None or signature is None:
+            raise SystemError("DingTalk signature verification failed: missing timestamp or sign.")
+        try:
+            seconds = int(timestamp) / 1000
+        except ValueError:
+            raise SystemError("DingTalk signature verification failed: invalid timestamp.")
+        if abs(time.time() - seconds) > self.max_age:
+            raise SystemError("DingTalk signature verification failed: timestamp out of the window.")
+        if self.replay_cache_size > 0 and (timestamp, signature) in self._seen:
+            raise SystemError("DingTalk signature verification failed: replayed.")
+        return seconds
+
+    def verify(self, timestamp: str, signature: str, app_key_hint: str = None) -> str:
+        """
+        :param app_key_hint: robot code of the message, when it is a configured app key only its secret is tried
+        :return: app_key
+        """
+        seconds = self.check_headers(timestamp, signature)
+
+        app_key = None
+        if app_key_hint in self._secrets:
+            if hmac.compare_digest(self._sign(app_key_hint, timestamp), signature):
+                app_key = app_key_hint
+        else:
+            for candidate in self._secrets:
+                if hmac.compare_digest(self._sign(candidate, timestamp), signature):
+                    app_key = candidate
+                    break
+        if app_key is None:
+            logging.error("DINGTALK_APP_SECRET not right.")
+            raise SystemError("DingTalk signature verification failed.")
+
+        if self.replay_cache_size > 0:
+            self._remember(timestamp, signature, seconds)
+        return app_key
+
+    def _remember(self, timestamp: str, signature: str, seconds: float) -> None:
+        with self._lock:
+            if (timestamp, signature) in self._seen:  # accepted meanwhile by another request
+                raise SystemError("DingTalk signature verification failed: replayed.")
+            self._seen[(timestamp, signature)] = seconds
+            # Signatures out of the window are rejected anyway, the oldest ones go first when full.
+            oldest_allowed = time.time() - self.max_age
+            while len(self._seen) > 0:
+                oldest = next(iter(self._seen.values()))
+                if oldest >= oldest_allowed and len(self._seen) <= self.replay_cache_size:
+                    break
+                self._seen.popitem(last=False)
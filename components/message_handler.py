@@ -4,41 +4,91 @@ import logging
 import os
 import threading
 import time
+import uuid
+from contextlib import nullcontext
 from enum import Enum
-from queue import Queue
 from typing import Any
 
-from pydantic import BaseModel
-
-from components.ai_side.chatbot_client import ChatBotClient
+from components import metrics
+from components.ai_side.chatbot_client import ChatBotClient, CancellationToken
 from components.ai_side.chatbot_client_builder import ChatBotClientBuilder
-from components.tools import is_true
+from components.coordination import Coordination, QueuedRequest
+from components.request_journal import RequestJournal, RequestState
+from components.structured_logging import log_context
+from components.tracing import Tracer, new_trace_id
+from components.tools import is_true, get_float_env
+from components.worker_autoscaler import WorkerAutoscaler
 
 
 class MessageHandlerEnv(Enum):
     WORKER_THREADS = "MESSAGE_HANDLER_WORKER_THREADS"
+    MIN_WORKER_THREADS = "MESSAGE_HANDLER_MIN_WORKER_THREADS"
+    MAX_WORKER_THREADS = "MESSAGE_HANDLER_MAX_WORKER_THREADS"
     ENABLE_GROUP_MESSAGES_HANDLING = "GROUP_MESSAGES_HANDLING_ENABLE"
+    ENABLE_CANCEL_ON_NEW_MESSAGE = "MESSAGE_HANDLER_CANCEL_ON_NEW_MESSAGE_ENABLE"
+    STOP_COMMANDS = "MESSAGE_HANDLER_STOP_COMMANDS"
+    RESET_COMMANDS = "MESSAGE_HANDLER_RESET_COMMANDS"
+    DRAIN_TIMEOUT = "MESSAGE_HANDLER_DRAIN_TIMEOUT"
+    KEEP_WARM_INTERVAL = "MESSAGE_HANDLER_KEEP_WARM_INTERVAL"
 
 
-class QueuedRequest(BaseModel):
-    unique_identifier: str
-    parameters: dict[str, Any]
+def _format(value: float) -> str:
+    return "%.2f" % value if value is not None else "-"
 
 
 class ConcurrentRequestException(Exception):
     pass
 
 
+class _Worker:
+    def __init__(self, num: int):
+        self.num = num
+        self.thread: threading.Thread = None
+        self.busy = False
+        self.retiring = False
+
+
 class MessageHandler:
     DEFAULT_WORKER_THREADS = 4
+    DEFAULT_STOP_COMMANDS = "stop,停,停止,别说了"
+    DEFAULT_RESET_COMMANDS = "reset,/new,重置,新话题"
+    DEFAULT_DRAIN_TIMEOUT = 30.0
+    DEFAULT_KEEP_WARM_INTERVAL = 30.0
+    SHUTDOWN_REASON = "shutdown"
+    ABORTED_REASON = "aborted"  # the reply failed midway, its upstream request is given up
+    MAX_REPLAYS = 2  # a request crashing the process every time is given up
+    QUEUE_POLL_INTERVAL = 0.5
+    CANCELLATION_POLL_INTERVAL = 0.25
+    DEDUPE_SECONDS = 600.0  # DingTalk may deliver a message again when the acknowledgement is late
+    AUTOSCALE_INTERVAL = 1.0
 
     def __init__(self,
                  chatbot_client_builder: ChatBotClientBuilder,
-                 worker_threads: int = None):
+                 worker_threads: int = None,
+                 journal: RequestJournal = None,
+                 coordination: Coordination = None,
+                 tracer: Tracer = None):
         self._chatbot_client_builder = chatbot_client_builder
-        self.queue = Queue()
         self.stopped = False
-        self.processing: dict[str, QueuedRequest] = {}  # 'Unique identifier' map to 'request being processed'
+        self.draining = False
+        self._workers: dict[int, _Worker] = {}
+        self._workers_lock = threading.Lock()
+        self._next_worker_num = 0
+
+        # Queue and requests in flight, in this process or shared by several processes.
+        self.coordination = coordination if coordination is not None else Coordination.from_env()
+        self.processing: dict[str, QueuedRequest] = {}  # 'request id' map to 'request being processed here'
+        self._leased: dict[str, QueuedRequest] = {}  # requests in flight kept alive by this process
+
+        # Accepted requests survive a restart, unfinished ones are replayed on start up.
+        self.journal = journal if journal is not None else RequestJournal.from_env()
+        # Timed spans of each request stage, to find where the time goes.
+        self.tracer = tracer if tracer is not None else Tracer.from_env()
+        self.drain_timeout = get_float_env(MessageHandlerEnv.DRAIN_TIMEOUT.value, self.DEFAULT_DRAIN_TIMEOUT)
+        # Workers open their upstream connections before their first request, and use them again when idle
+        # for this many seconds, so they are still open for the next request. 0 to disable.
+        self.keep_warm_interval = get_float_env(MessageHandlerEnv.KEEP_WARM_INTERVAL.value,
+                                                self.DEFAULT_KEEP_WARM_INTERVAL)
 
         self.worker_threads = self.DEFAULT_WORKER_THREADS
         if os.getenv(MessageHandlerEnv.WORKER_THREADS.value) is not None:
@@ -48,56 +98,358 @@ class MessageHandler:
         if self.worker_threads < 1:
             self.worker_threads = 1
 
+        # Scale the workers between min and max when either is set, worker_threads is then the initial number.
+        self.autoscaler = None
+        min_workers = os.getenv(MessageHandlerEnv.MIN_WORKER_THREADS.value)
+        max_workers = os.getenv(MessageHandlerEnv.MAX_WORKER_THREADS.value)
+        if min_workers is not None or max_workers is not None:
+            self.autoscaler = WorkerAutoscaler(int(min_workers) if min_workers is not None else 1,
+                                               int(max_workers) if max_workers is not None else self.worker_threads)
+            self.worker_threads = min(max(self.worker_threads, self.autoscaler.min_workers),
+                                      self.autoscaler.max_workers)
+            logging.info("Worker autoscaling enabled: %s" % self.autoscaler)
+
         self.handlingGroupMessages = is_true(os.getenv(MessageHandlerEnv.ENABLE_GROUP_MESSAGES_HANDLING.value))
         if self.handlingGroupMessages:
             logging.info("Group message handling enabled. Server is now listening for messages from groups.")
 
+        # A new message from the same conversation cancels the one being answered (enabled unless set to false).
+        self.cancel_on_new_message = (os.getenv(MessageHandlerEnv.ENABLE_CANCEL_ON_NEW_MESSAGE.value) is None
+                                      or is_true(os.getenv(MessageHandlerEnv.ENABLE_CANCEL_ON_NEW_MESSAGE.value)))
+        stop_commands = os.getenv(MessageHandlerEnv.STOP_COMMANDS.value, self.DEFAULT_STOP_COMMANDS)
+        self.stop_commands = set(command.strip().lower() for command in stop_commands.split(',') if command.strip())
+        reset_commands = os.getenv(MessageHandlerEnv.RESET_COMMANDS.value, self.DEFAULT_RESET_COMMANDS)
+        self.reset_commands = set(command.strip().lower() for command in reset_commands.split(',') if command.strip())
+
     def get_request_being_processed(self, unique_identifier: str) -> QueuedRequest:
-        return self.processing[unique_identifier] if unique_identifier in self.processing else None
+        return self.coordination.in_flight(unique_identifier)
+
+    def is_duplicate(self, message_id: str) -> bool:
+        """
+        Whether the message has already been accepted, by any process.
+        """
+        return message_id is not None and not self.coordination.first_seen("message:" + message_id,
+                                                                           self.DEDUPE_SECONDS)
 
-    def add_new_request_to_queue(self, unique_identifier: str, request: dict[str, Any]) -> None:
-        new_request = QueuedRequest(unique_identifier=unique_identifier, parameters=request)
+    def is_stop_command(self, content: str) -> bool:
+        return content is not None and content.strip().lower() in self.stop_commands
 
+    def is_reset_command(self, content: str) -> bool:
+        return content is not None and content.strip().lower() in self.reset_commands
+
+    def cancel_request(self, unique_identifier: str, reason: str = None) -> QueuedRequest:
+        """
+        Cancel the request being processed, the worker stops generating and becomes free.
+        :return: the cancelled request, None if nothing is being processed
+        """
         being_processed = self.get_request_being_processed(unique_identifier)
+        if being_processed is None:
+            return None
+        self._cancel(being_processed, reason)
+        return being_processed
+
+    def _cancel(self, request: QueuedRequest, reason: str) -> None:
+        logging.info("Cancel request of %s: %s" % (request.unique_identifier, reason))
+        processed_here = self.processing.get(request.request_id)
+        if processed_here is not None:
+            processed_here.cancellation.cancel(reason)
+        # other processes see it when polling
+        self.coordination.cancel(request, reason)
+
+    def span(self, name: str, trace_id: str = None, **attributes):
+        """
+        Time the block as a span of the request when tracing is enabled.
+        """
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(name, trace_id, **attributes)
+
+    def add_new_request_to_queue(self, unique_identifier: str, request: dict[str, Any],
+                                 request_id: str = None, trace_id: str = None) -> QueuedRequest:
+        new_request = QueuedRequest(unique_identifier=unique_identifier, parameters=request,
+                                    cancellation=CancellationToken(),
+                                    request_id=request_id if request_id is not None else uuid.uuid4().hex,
+                                    enqueued_at=time.time(),
+                                    trace_id=trace_id if trace_id is not None else new_trace_id())
+
+        being_processed = self.coordination.acquire_in_flight(new_request, replace=self.cancel_on_new_message)
         if being_processed is not None:
-            # Concurrency Control
-            raise ConcurrentRequestException(
-                "The request with the same unique_identifier is already being processed.",
-                being_processed, new_request
-            )
+            if not self.cancel_on_new_message:
+                # Concurrency Control
+                raise ConcurrentRequestException(
+                    "The request with the same unique_identifier is already being processed.",
+                    being_processed, new_request
+                )
+            # The new question supersedes the one being answered.
+            self._cancel(being_processed, "superseded")
+
+        if self.journal is not None and request_id is None:
+            new_request.journaled = self.journal.append(new_request.request_id, unique_identifier, request)
+        if self.coordination.shared:
+            self._leased[new_request.request_id] = new_request
+        self.coordination.put(new_request)
+        if self.autoscaler is not None:
+            self.autoscaler.observe_enqueued()
+        return new_request
+
+    @staticmethod
+    async def wait_until_journaled(request: QueuedRequest) -> None:
+        """
+        Wait for the request to be durable before acknowledging it.
+        A failing journal is logged rather than losing the request right now.
+        """
+        if request.journaled is None:
+            return
+        try:
+            await asyncio.wrap_future(request.journaled)
+        except Exception as e:
+            logging.error("Request %s is not journaled: %s" % (request.request_id, e))
+
+    def can_replay(self, parameters: dict[str, Any]) -> bool:
+        """
+        Whether a request found unfinished on start up can still be answered.
+        """
+        return True
 
-        self.queue.put(new_request)
-        self.processing[unique_identifier] = new_request
+    def _replay_journal(self) -> None:
+        replayed = 0
+        for journaled in self.journal.unfinished():
+            if self.coordination.shared:
+                # Queued requests are still in the shared queue. The others are replayed by one process only,
+                # unless the conversation is in flight (being processed, or superseded) in a process alive.
+                if (journaled.state == RequestState.QUEUED
+                        or self.coordination.in_flight(journaled.unique_identifier) is not None
+                        or not self.coordination.first_seen("replay:" + journaled.request_id,
+                                                            RequestJournal.KEEP_FINISHED_SECONDS)):
+                    continue
+            if journaled.attempts > self.MAX_REPLAYS:
+                self.journal.update(journaled.request_id, RequestState.FAILED)
+                logging.warning("Request %s given up after %d attempts." % (journaled.request_id, journaled.attempts))
+            elif not self.can_replay(journaled.parameters):
+                self.journal.update(journaled.request_id, RequestState.EXPIRED)
+            else:
+                # A newer request of the same conversation supersedes the older one, as it would have.
+                self.add_new_request_to_queue(journaled.unique_identifier, journaled.parameters,
+                                              request_id=journaled.request_id)
+                replayed += 1
+        if replayed > 0:
+            logging.info("Replayed %d unfinished request(s) from the journal." % replayed)
+
+    @property
+    def workers(self) -> int:
+        return len(self._workers)
+
+    @property
+    def busy_workers(self) -> int:
+        return sum(1 for worker in list(self._workers.values()) if worker.busy)
+
+    @property
+    def alive_workers(self) -> int:
+        # a worker whose thread died unexpectedly is still counted by `workers`
+        return sum(1 for worker in list(self._workers.values())
+                   if worker.thread is not None and worker.thread.is_alive())
+
+    @property
+    def max_workers(self) -> int:
+        return self.autoscaler.max_workers if self.autoscaler is not None else self.worker_threads
+
+    def _add_worker(self) -> None:
+        with self._workers_lock:
+            worker = _Worker(self._next_worker_num)
+            self._next_worker_num += 1
+            worker.thread = threading.Thread(target=asyncio.run,
+                                             args=(self._process_request_in_queue(worker,
+                                                                                  self._chatbot_client_builder),))
+            self._workers[worker.num] = worker
+        worker.thread.start()
+
+    def _retire_worker(self) -> bool:
+        with self._workers_lock:
+            for worker in self._workers.values():
+                if not worker.busy and not worker.retiring:
+                    worker.retiring = True
+                    return True
+        return False
 
     def start_workers(self):
         for i in range(self.worker_threads):
-            worker = threading.Thread(target=asyncio.run,
-                                      args=(self._process_request_in_queue(i, self._chatbot_client_builder),))
-            worker.start()
+            self._add_worker()
+        if self.autoscaler is not None:
+            autoscaler = threading.Thread(target=self._autoscale, name="autoscaler", daemon=True)
+            autoscaler.start()
+        if self.coordination.shared:
+            coordinator = threading.Thread(target=self._coordinate, name="coordination", daemon=True)
+            coordinator.start()
+        elif self.journal is not None:
+            self._replay_journal()
+
+    def _autoscale(self) -> None:
+        while not self.stopped and not self.draining:
+            time.sleep(self.AUTOSCALE_INTERVAL)
+            try:
+                current = sum(1 for worker in list(self._workers.values()) if not worker.retiring)
+                busy = self.busy_workers
+                queue_depth = self.coordination.size()
+                desired = self.autoscaler.desired_workers(current, busy, queue_depth)
+                if desired == current:
+                    continue
+                logging.info("Scale workers from %d to %d (busy: %d, queued: %d, arrival rate: %s/s, "
+                             "processing time: %s s, queue wait: %s s)."
+                             % (current, desired, busy, queue_depth, _format(self.autoscaler.arrival_rate),
+                                _format(self.autoscaler.processing_time), _format(self.autoscaler.queue_wait)))
+                for i in range(desired - current):
+                    self._add_worker()
+                for i in range(current - desired):
+                    self._retire_worker()
+            except Exception as e:
+                logging.error("Autoscaling failed: %s" % e)
+
+    def _coordinate(self) -> None:
+        """
+        With a shared backend: sees the cancellations made by other processes, keeps the leases of the requests
+        in flight here, and replays the journal once the leases of a crashed process have expired.
+        """
+        refreshed_at = time.monotonic()
+        replay_at = time.monotonic() + Coordination.LEASE_SECONDS if self.journal is not None else None
+        while not self.stopped:
+            time.sleep(self.CANCELLATION_POLL_INTERVAL)
+            try:
+                for request in list(self.processing.values()):
+                    if not request.cancellation.cancelled:
+                        reason = self.coordination.cancellation_reason(request)
+                        if reason is not None:
+                            request.cancellation.cancel(reason)
+                if time.monotonic() - refreshed_at > Coordination.LEASE_SECONDS / 3:
+                    refreshed_at = time.monotonic()
+                    for request_id, request in list(self._leased.items()):
+                        if not self.coordination.refresh_in_flight(request):
+                            self._leased.pop(request_id, None)
+                if replay_at is not None and time.monotonic() >= replay_at:
+                    replay_at = None
+                    self._replay_journal()
+            except Exception as e:
+                logging.error("Coordination failed: %s" % e)
+
+    def _unfinished(self) -> int:
+        # A shared queue is left to the other processes.
+        return len(self.processing) + (0 if self.coordination.shared else self.coordination.size())
+
+    def start_draining(self) -> None:
+        """
+        Not ready for more requests from now on, as the shutdown is coming. The accepted ones are still answered.
+        """
+        if not self.draining:
+            self.draining = True
+            logging.info("Draining, not ready for more requests.")
+
+    def stop_workers(self, drain_timeout: float = None):
+        """
+        Finish the accepted requests within the drain timeout, the ones still unfinished then are
+        handed to the other processes (shared backend) or left in the journal for the next start.
+        Blocks until then, run it out of the event loop.
+        """
+        self.start_draining()
+        deadline = time.monotonic() + (drain_timeout if drain_timeout is not None else self.drain_timeout)
+        while self._unfinished() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self._unfinished() > 0:
+            logging.warning("Drain timeout, %d request(s) unfinished%s." % (
+                self._unfinished(), ", kept in the journal" if self.journal is not None else ""))
 
-    def stop_workers(self):
         self.stopped = True
-        for i in range(self.worker_threads):
-            self.queue.put({})
-            time.sleep(0.001)
+        for request in list(self.processing.values()):
+            request.cancellation.cancel(self.SHUTDOWN_REASON)
+        for worker in list(self._workers.values()):
+            worker.thread.join(max(0.0, deadline - time.monotonic()) + 5.0)
+        if self.journal is not None:
+            self.journal.close()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.coordination.close()
 
-    async def _process_request_in_queue(self, num, chatbot_client_builder: ChatBotClientBuilder) -> None:
+    async def _process_request_in_queue(self, worker: _Worker, chatbot_client_builder: ChatBotClientBuilder) -> None:
         chatbot_client = chatbot_client_builder.build()
-        logging.info("Started Message processing Worker: #%d %s" % (num, chatbot_client))
+        logging.info("Started Message processing Worker: #%d %s" % (worker.num, chatbot_client))
+        if self.keep_warm_interval > 0:
+            await self.warm_up(chatbot_client)
+        used_at = time.monotonic()
 
-        while not self.stopped:
-            request: QueuedRequest = self.queue.get()
-            if request == {}:
-                self.queue.task_done()
+        while not self.stopped and not worker.retiring:
+            request = self.coordination.get(self.QUEUE_POLL_INTERVAL)
+            if request is None:
+                if 0 < self.keep_warm_interval <= time.monotonic() - used_at and not self.stopped:
+                    await self.warm_up(chatbot_client)
+                    used_at = time.monotonic()
+                continue
+            if self.stopped:
+                # not started requests are left in the journal, or to the other processes
+                if self.coordination.shared:
+                    self.coordination.put(request)
                 break
+            worker.busy = True
+            start_time = time.perf_counter()
+            if request.enqueued_at is not None:
+                queue_wait = max(0.0, time.time() - request.enqueued_at)
+                metrics.QUEUE_WAIT_SECONDS.labels(app_key=request.parameters.get("app_key")).observe(queue_wait)
+                if self.autoscaler is not None:
+                    self.autoscaler.observe_dequeued(queue_wait)
+                if self.tracer is not None:
+                    self.tracer.record("queue", queue_wait, start_time=request.enqueued_at, trace_id=request.trace_id)
+            self.processing[request.request_id] = request
+            if self.coordination.shared:
+                self._leased[request.request_id] = request
+                reason = self.coordination.cancellation_reason(request)
+                if reason is not None:
+                    request.cancellation.cancel(reason)
+            if self.journal is not None and not request.cancellation.cancelled:
+                self.journal.update(request.request_id, RequestState.PROCESSING)
             # main logic
-            await self.process_request(request, chatbot_client)
+            with self.span("process", trace_id=request.trace_id, request_id=request.request_id, worker=worker.num), \
+                    log_context(trace_id=request.trace_id, request_id=request.request_id):
+                try:
+                    await self.process_request(request, chatbot_client)
+                except Exception as e:
+                    # the worker, its lease and the journal entry outlive a failed request
+                    logging.exception("Failed to process request %s: %s" % (request.request_id, e))
+
+            if request.cancellation.reason == self.SHUTDOWN_REASON:
+                # interrupted by the shutdown, answered again by another process or after the restart
+                if self.coordination.shared:
+                    self.coordination.put(request)
+            else:
+                if self.journal is not None:
+                    cancelled = request.cancellation.cancelled and request.cancellation.reason != self.ABORTED_REASON
+                    self.journal.update(request.request_id, RequestState.CANCELLED if cancelled else RequestState.DONE)
+                # finished, unless it has already been superseded by a newer request
+                self.coordination.release_in_flight(request)
+            self.processing.pop(request.request_id, None)
+            self._leased.pop(request.request_id, None)
+            if self.autoscaler is not None:
+                self.autoscaler.observe_processed(time.perf_counter() - start_time)
+            worker.busy = False
+            used_at = time.monotonic()
+
+        with self._workers_lock:
+            self._workers.pop(worker.num, None)
+        # retired or stopped, its connections are not needed anymore
+        chatbot_client.close()
+        await self.close_worker_connections()
+        logging.info("Stopped Message processing Worker: #" + str(worker.num))
 
-            # remove processed
-            del self.processing[request.unique_identifier]
+    async def warm_up(self, chatbot_client: ChatBotClient) -> None:
+        """
+        Open the upstream connections of a worker, or keep them open. Runs in the event loop of the worker.
+        """
+        try:
+            chatbot_client.warm_up()
+        except Exception as e:
+            logging.warning("Failed to warm up the chatbot server connections: %s" % e)
 
-            self.queue.task_done()
-        logging.info("Stopped Message processing Worker: #" + str(num))
+    async def close_worker_connections(self) -> None:
+        """
+        Close the connections opened in the event loop of a worker, before it ends.
+        """
+        pass
 
     @abc.abstractmethod
     async def process_request(self, request: QueuedRequest, chatbot_client: ChatBotClient) -> None:
@@ -0,0 +1,275 @@
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from components.tools import is_true
+
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class MetricsEnv(Enum):
+    ENABLE = "METRICS_ENABLE"
+
+
+def metrics_enabled() -> bool:
+    return is_true(os.getenv(MetricsEnv.ENABLE.value, "true"))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = ["%s=\"%s\"" % (name, _escape(value)) for name, value in zip(names, values)]
+    return "{%s}" % ",".join(pairs) if len(pairs) > 0 else ""
+
+
+class _Metric:
+    TYPE: str = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels):
+        """
+        The child for these label values, missing labels are left empty.
+        """
+        unknown = set(labels) - set(self.labelnames)
+        if len(unknown) > 0:
+            raise ValueError("Unknown labels %s for metric %s" % (sorted(unknown), self.name))
+        key = tuple(str(labels[name]) if labels.get(name) is not None else "" for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        """
+        :return: (name suffix, extra label names, label values, value) of each sample
+        """
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.documentation.replace("\n", " ")),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        for suffix, extra_names, values, value in self._samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(self.labelnames + extra_names, values),
+                                        _format_value(value)))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _CounterChild(self._lock)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self):
+        with self._lock:
+            return [("_total" if not self.name.endswith("_total") else "", (), key, child.value)
+                    for key, child in self._children.items()]
+
+
+class _GaugeChild:
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Callable[[], float] = None
+
+    def _new_child(self):
+        return _GaugeChild(self._lock)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        The value is read from the function at each scrape, for values kept elsewhere (queue depth...).
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [("", (), ("",) * len(self.labelnames), float(self._function()))]
+        with self._lock:
+            return [("", (), key, child.value) for key, child in self._children.items()]
+
+
+class _HistogramChild:
+    def __init__(self, lock: threading.Lock, buckets: Tuple[float, ...]):
+        self._lock = lock
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time)
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+
+    def _new_child(self):
+        return _HistogramChild(self._lock, self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, child in self._children.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, child.counts):
+                    cumulative += count
+                    samples.append(("_bucket", ("le",), key + (_format_value(bound),), cumulative))
+                samples.append(("_count", (), key, child.count))
+                samples.append(("_sum", (), key, child.sum))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Duplicated metric: " + metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Labels of the request lifecycle: the DingTalk robot (app key), the chatbot server type and its model.
+CALLBACK_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_callback_seconds", "Time to handle a message callback from DingTalk.", ("app_key",)))
+MEDIA_DOWNLOAD_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_media_download_seconds", "Time to download the pictures and files of a message.",
+    ("app_key", "msgtype")))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_queue_wait_seconds", "Time a request waited in the queue for a worker.", ("app_key",)))
+TIME_TO_FIRST_TOKEN_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_time_to_first_token_seconds", "Time from calling the chatbot server to the first content.",
+    ("app_key", "provider", "model")))
+GENERATION_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_generation_seconds", "Time from calling the chatbot server to the end of the answer.",
+    ("app_key", "provider", "model")))
+DINGTALK_SEND_SECONDS = REGISTRY.register(Histogram(
+    "chatgpding_dingtalk_send_seconds", "Latency of each message sent to DingTalk.", ("api", "outcome")))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "chatgpding_queue_depth", "Requests waiting for a worker."))
+BUSY_WORKERS = REGISTRY.register(Gauge(
+    "chatgpding_busy_workers", "Workers processing a request."))
+WORKERS = REGISTRY.register(Gauge(
+    "chatgpding_workers", "Workers started."))
+REQUESTS = REGISTRY.register(Counter(
+    "chatgpding_requests", "Requests processed by the workers, by outcome.",
+    ("app_key", "provider", "model", "outcome")))
+TOKENS = REGISTRY.register(Counter(
+    "chatgpding_tokens", "Tokens used by the chatbot server, by type (input, output, image, cache_read, cache_write).",
+    ("app_key", "provider", "model", "type")))
+
+
+def observe_token_usage(usage, app_key: str, provider: str, model: str) -> None:
+    """
+    :param usage: TokenUsage of a request
+    """
+    for token_type in ("input", "output", "image", "cache_read", "cache_write"):
+        tokens = getattr(usage, token_type + "_tokens", 0)
+        if tokens > 0:
+            TOKENS.labels(app_key=app_key, provider=provider, model=model, type=token_type).inc(tokens)
+
+
+if __name__ == '__main__':
+    QUEUE_DEPTH.set_function(lambda: 3)
+    for seconds in (0.02, 0.3, 1.7, 200):
+        QUEUE_WAIT_SECONDS.labels(app_key="ding123").observe(seconds)
+    REQUESTS.labels(app_key="ding123", provider="openai", model="gpt-4", outcome="ok").inc()
+    print(REGISTRY.render())
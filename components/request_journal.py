@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from enum import Enum
+from typing import Any, List, Optional
+
+from pydantic import BaseModel
+
+
+class RequestJournalEnv(Enum):
+    PATH = "REQUEST_JOURNAL_PATH"
+
+
+class RequestState(Enum):
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    DONE = "done"  # answered, or told about the error
+    CANCELLED = "cancelled"  # superseded or stopped by the user
+    EXPIRED = "expired"  # could not be replayed anymore
+    FAILED = "failed"  # replayed too many times
+
+
+class JournaledRequest(BaseModel):
+    request_id: str
+    unique_identifier: str
+    parameters: dict[str, Any]
+    state: RequestState
+    attempts: int
+
+
+class RequestJournal:
+    """
+    Append-only record of the accepted requests and their delivery state, in SQLite (WAL).
+    A single writer thread commits everything pending in one transaction (group commit),
+    so the cost of a durable commit is shared by the requests arriving meanwhile.
+    """
+
+    MAX_BATCH = 256
+    KEEP_FINISHED_SECONDS = 24 * 3600
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pending = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+
+        connection = self._connect()
+        connection.execute("CREATE TABLE IF NOT EXISTS request_journal ("
+                           "request_id TEXT PRIMARY KEY, "
+                           "unique_identifier TEXT NOT NULL, "
+                           "parameters TEXT NOT NULL, "
+                           "state TEXT NOT NULL, "
+                           "attempts INTEGER NOT NULL DEFAULT 0, "
+                           "accepted_at REAL NOT NULL, "
+                           "updated_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS request_journal_state ON request_journal (state, accepted_at)")
+        connection.execute("DELETE FROM request_journal WHERE state NOT IN (?, ?) AND updated_at < ?",
+                           (RequestState.QUEUED.value, RequestState.PROCESSING.value,
+                            time.time() - self.KEEP_FINISHED_SECONDS))
+        connection.commit()
+        connection.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="request-journal-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def from_env() -> Optional['RequestJournal']:
+        path = os.getenv(RequestJournalEnv.PATH.value)
+        if path is None:
+            return None
+        logging.info("Request journal: %s" % os.path.abspath(path))
+        return RequestJournal(path)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def append(self, request_id: str, unique_identifier: str, parameters: dict[str, Any]) -> Future:
+        """
+        :return: a future done once the request is durable
+        """
+        now = time.time()
+        return self._submit("INSERT OR REPLACE INTO request_journal "
+                            "(request_id, unique_identifier, parameters, state, attempts, accepted_at, updated_at) "
+                            "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                            (request_id, unique_identifier, json.dumps(parameters, ensure_ascii=False),
+                             RequestState.QUEUED.value, now, now))
+
+    def update(self, request_id: str, state: RequestState) -> Future:
+        increment = 1 if state == RequestState.PROCESSING else 0
+        return self._submit("UPDATE request_journal SET state = ?, attempts = attempts + ?, updated_at = ? "
+                            "WHERE request_id = ?", (state.value, increment, time.time(), request_id))
+
+    def _submit(self, sql: str, parameters: tuple) -> Future:
+        future = Future()
+        with self._lock:
+            if self._closed:
+                future.set_exception(RuntimeError("Request journal is closed."))
+                return future
+            self._pending.put((sql, parameters, future))
+        return future
+
+    def _write_loop(self) -> None:
+        connection = self._connect()
+        while True:
+            first = self._pending.get()
+            if first is None:
+                break
+            batch = [first]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    item = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.put(None)
+                    break
+                batch.append(item)
+            try:
+                for sql, parameters, _ in batch:
+                    connection.execute(sql, parameters)
+                connection.commit()
+                for _, _, future in batch:
+                    future.set_result(None)
+            except Exception as e:
+                connection.rollback()
+                logging.error("Request journal write failed: %s" % e)
+                for _, _, future in batch:
+                    future.set_exception(e)
+        connection.close()
+
+    def unfinished(self) -> List[JournaledRequest]:
+        """
+        Requests accepted but not finished when the process stopped, from the oldest.
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT request_id, unique_identifier, parameters, state, attempts "
+                                      "FROM request_journal WHERE state IN (?, ?) ORDER BY accepted_at",
+                                      (RequestState.QUEUED.value, RequestState.PROCESSING.value)).fetchall()
+        finally:
+            connection.close()
+        return [JournaledRequest(request_id=request_id, unique_identifier=unique_identifier,
+                                 parameters=json.loads(parameters), state=RequestState(state), attempts=attempts)
+                for request_id, unique_identifier, parameters, state, attempts in rows]
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Write everything pending, then stop the writer.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending.put(None)
+        self._writer.join(timeout)
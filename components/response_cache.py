@@ -0,0 +1,296 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Iterable, List, Optional
+
+from components.ai_side.chatbot_client import ChatBotClient, ChatMessage, TokenUsage, CancellationToken, \
+    CompletionCancelledException, ImageBlock
+from components.tools import is_true, get_float_env
+
+
+class ResponseCacheEnv(Enum):
+    ENABLE = "RESPONSE_CACHE_ENABLE"
+    TTL = "RESPONSE_CACHE_TTL"
+    MAX_BYTES = "RESPONSE_CACHE_MAX_BYTES"
+
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _file_md5(file_path: str) -> str:
+    with open(file_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def response_cache_key(model_name: str, system: str, messages: List[ChatMessage]) -> str:
+    """
+    Hash of everything that determines a reply. Whitespace is normalized, images are identified by their content.
+    """
+    normalized_messages = []
+    for message in messages:
+        if isinstance(message.content, str):
+            content = _normalize_text(message.content)
+        else:
+            content = [{"image": _file_md5(block.image)} if isinstance(block, ImageBlock)
+                       else {"text": _normalize_text(block.text)} for block in message.content]
+        normalized_messages.append({"role": message.role, "content": content})
+    payload = json.dumps({"model": model_name,
+                          "system": _normalize_text(system or ""),
+                          "messages": normalized_messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _SharedReply:
+    """
+    A reply being generated upstream, consumed by every identical request that arrived meanwhile (single-flight).
+    Chunks are kept, so that a consumer joining late replays them from the beginning.
+    Whichever consumer needs the next chunk pulls it from upstream, the others wait for it.
+    """
+
+    WAIT_INTERVAL = 0.5
+
+    def __init__(self, key: str):
+        self.key = key
+        self.condition = threading.Condition()
+        self.upstream_token = CancellationToken()
+        self.upstream = None
+        self.usage: TokenUsage = None
+        self.chunks: List[str] = []
+        self.pulling = True  # until the upstream request has been sent by the leader
+        self.done = False
+        self.error: Exception = None
+        self.consumers = 0
+
+    def attach(self) -> None:
+        with self.condition:
+            self.consumers += 1
+
+    def detach(self) -> bool:
+        """
+        :return: whether nobody is reading the unfinished reply anymore
+        """
+        with self.condition:
+            self.consumers -= 1
+            self.condition.notify_all()
+            return self.consumers <= 0 and not self.done and self.error is None
+
+    def started(self, upstream: Iterable[str], usage: TokenUsage) -> None:
+        with self.condition:
+            self.upstream = iter(upstream)
+            self.usage = usage
+            self.pulling = False
+            self.condition.notify_all()
+
+    def failed(self, error: Exception) -> None:
+        with self.condition:
+            self.error = error
+            self.pulling = False
+            self.condition.notify_all()
+
+    def next_chunk(self, position: int, cancellation_token: Optional[CancellationToken]) -> str:
+        with self.condition:
+            while True:
+                if position < len(self.chunks):
+                    return self.chunks[position]
+                if self.error is not None:
+                    raise self.error
+                if self.done:
+                    raise StopIteration
+                if cancellation_token is not None:
+                    cancellation_token.raise_if_cancelled()
+                if not self.pulling:
+                    self.pulling = True
+                    break
+                self.condition.wait(self.WAIT_INTERVAL)
+        try:
+            chunk = next(self.upstream)
+        except StopIteration:
+            with self.condition:
+                self.done = True
+                self.pulling = False
+                self.condition.notify_all()
+            raise
+        except Exception as e:
+            self.failed(e)
+            raise e
+        with self.condition:
+            self.chunks.append(chunk)
+            self.pulling = False
+            self.condition.notify_all()
+        return chunk
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete replies, with TTL and LRU eviction by size.
+    Identical requests arriving while the reply is still generated attach to it instead of sending another one.
+    """
+
+    DEFAULT_TTL = 600.0
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, ttl: float = None, max_bytes: int = None):
+        self.ttl = ttl if ttl is not None else self.DEFAULT_TTL
+        self.max_bytes = max_bytes if max_bytes is not None else self.DEFAULT_MAX_BYTES
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, List[str], TokenUsage, int]] = OrderedDict()
+        self._in_flight: dict[str, _SharedReply] = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_env() -> Optional['ResponseCache']:
+        if not is_true(os.getenv(ResponseCacheEnv.ENABLE.value)):
+            return None
+        max_bytes = get_float_env(ResponseCacheEnv.MAX_BYTES.value)
+        cache = ResponseCache(get_float_env(ResponseCacheEnv.TTL.value),
+                              int(max_bytes) if max_bytes is not None else None)
+        logging.info("Response cache enabled, ttl: %.0f s, max size: %d bytes." % (cache.ttl, cache.max_bytes))
+        return cache
+
+    def completions(self,
+                    chatbot_client: ChatBotClient,
+                    messages: List[ChatMessage],
+                    cancellation_token: CancellationToken = None) -> tuple[Iterable[str], TokenUsage, bool]:
+        """
+        Same as ChatBotClient.completions, the third value tells whether the reply did not cost a new request.
+        """
+        key = response_cache_key(chatbot_client.chat_model_name, chatbot_client.preset_system_prompt, messages)
+        with self._lock:
+            cached = self._get(key)
+            if cached is not None:
+                self.hits += 1
+                chunks, usage = cached
+                return iter(chunks), usage.copy(), True
+            shared_reply = self._in_flight.get(key)
+            leader = shared_reply is None
+            if leader:
+                self.misses += 1
+                shared_reply = _SharedReply(key)
+                self._in_flight[key] = shared_reply
+            else:
+                self.shared += 1
+            shared_reply.attach()
+        iterator = _SharedReplyIterator(self, shared_reply, cancellation_token)
+        if cancellation_token is not None:
+            cancellation_token.on_cancel(iterator.detach)
+
+        if not leader:
+            logging.info("Identical request in flight, attach to its reply: %s" % key[:16])
+            with shared_reply.condition:
+                while shared_reply.pulling and shared_reply.upstream is None and shared_reply.error is None:
+                    # woken up by the detach of a cancellation too
+                    if cancellation_token is not None:
+                        cancellation_token.raise_if_cancelled()
+                    shared_reply.condition.wait(_SharedReply.WAIT_INTERVAL)
+            if shared_reply.error is not None:
+                raise shared_reply.error
+            return iterator, shared_reply.usage, True
+
+        try:
+            upstream, usage = chatbot_client.completions(messages, cancellation_token=shared_reply.upstream_token)
+        except Exception as e:
+            shared_reply.failed(e)
+            with self._lock:
+                self._in_flight.pop(key, None)
+            raise e
+        shared_reply.started(upstream, usage)
+        return iterator, usage, False
+
+    def _get(self, key: str) -> Optional[tuple[List[str], TokenUsage]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, chunks, usage, size = entry
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            self.size_bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return chunks, usage
+
+    def _detach(self, shared_reply: _SharedReply) -> None:
+        with self._lock:
+            abandoned = shared_reply.detach()
+            if abandoned and self._in_flight.get(shared_reply.key) is shared_reply:
+                del self._in_flight[shared_reply.key]
+        if abandoned:
+            # Nobody is reading the reply anymore.
+            shared_reply.upstream_token.cancel("abandoned by all requests")
+
+    def _finished(self, shared_reply: _SharedReply) -> None:
+        with self._lock:
+            if self._in_flight.get(shared_reply.key) is not shared_reply:
+                return
+            del self._in_flight[shared_reply.key]
+            if not shared_reply.done or shared_reply.error is not None:
+                return
+            size = sum(len(chunk.encode('utf-8')) for chunk in shared_reply.chunks if chunk is not None)
+            if size > self.max_bytes:
+                return
+            self._entries[shared_reply.key] = (time.monotonic() + self.ttl, list(shared_reply.chunks),
+                                               shared_reply.usage.copy(), size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes and len(self._entries) > 0:
+                _, (_, _, _, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "shared": self.shared,
+                "misses": self.misses,
+            }
+
+
+class _SharedReplyIterator:
+    """
+    One request reading a shared reply, which is handed over to the cache once complete.
+    """
+
+    def __init__(self, cache: ResponseCache, shared_reply: _SharedReply, cancellation_token: CancellationToken = None):
+        self.cache = cache
+        self.shared_reply = shared_reply
+        self.cancellation_token = cancellation_token
+        self.position = 0
+        self._detached = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.cancellation_token is not None and self.cancellation_token.cancelled:
+            raise CompletionCancelledException(self.cancellation_token.reason)
+        try:
+            chunk = self.shared_reply.next_chunk(self.position, self.cancellation_token)
+        except StopIteration:
+            self.cache._finished(self.shared_reply)
+            raise
+        except Exception as e:
+            if self.shared_reply.error is not None:
+                self.cache._finished(self.shared_reply)
+            raise e
+        self.position += 1
+        return chunk
+
+    def detach(self) -> None:
+        with self._lock:
+            if self._detached:
+                return
+            self._detached = True
+        self.cache._detach(self.shared_reply)
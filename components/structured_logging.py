@@ -0,0 +1,175 @@
+import contextvars
+import copy
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from components.tools import get_float_env
+
+
+class LoggingEnv(Enum):
+    LEVEL = "LOG_LEVEL"
+    FORMAT = "LOG_FORMAT"  # text, json
+    CONTENT = "LOG_CONTENT"  # truncate, hash, full, none
+    CONTENT_MAX_LENGTH = "LOG_CONTENT_MAX_LENGTH"
+    DEBUG_SAMPLE_RATE = "LOG_DEBUG_SAMPLE_RATE"
+    QUEUE_SIZE = "LOG_QUEUE_SIZE"
+
+
+DEFAULT_CONTENT_MAX_LENGTH = 200
+DEFAULT_QUEUE_SIZE = 10000
+
+# Fields of the request being handled (trace_id, request_id, conversation_id ...), added to its log records.
+_log_context = contextvars.ContextVar("log_context", default={})
+
+_content_mode = "truncate"
+_content_max_length = DEFAULT_CONTENT_MAX_LENGTH
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Add the fields to the records logged in the block.
+    """
+    reset_token = _log_context.set(dict(_log_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _log_context.reset(reset_token)
+
+
+def bind_log_context(**fields) -> None:
+    """
+    Add the fields to the records logged until the enclosing `log_context` block ends.
+    """
+    _log_context.set(dict(_log_context.get(), **fields))
+
+
+def log_content(text) -> str:
+    """
+    User content (messages, answers, uploaded files) as configured by LOG_CONTENT:
+    truncated (default), replaced by a hash, left whole or left out. Line breaks are escaped.
+    """
+    if text is None:
+        return ""
+    text = str(text)
+    if _content_mode == "full":
+        return text.replace("\n", "\\n")
+    if _content_mode == "none":
+        return "<%d chars>" % len(text)
+    if _content_mode == "hash":
+        return "<sha256:%s, %d chars>" % (hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], len(text))
+    if len(text) > _content_max_length:
+        text = text[:_content_max_length] + "... <%d chars>" % len(text)
+    return text.replace("\n", "\\n")
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Runs in the thread logging: adds the context fields, and keeps a sample of the debug records.
+    """
+
+    def __init__(self, debug_sample_rate: float = 1.0):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and self.debug_sample_rate < 1.0 \
+                and random.random() >= self.debug_sample_rate:
+            return False
+        record.context = _log_context.get()
+        return True
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks the event loop: records are dropped when the writer falls behind.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message is formatted here, as its arguments may change once logged. The traceback stays apart,
+        # so that the writer's formatter puts it where it belongs (the exception field of a JSON line).
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".%03d" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "context", {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, "context", {})
+        if len(context) > 0:
+            line += "  [" + " ".join("%s=%s" % (key, value) for key, value in context.items()) + "]"
+        return line
+
+
+def setup_logging(stream=None) -> Optional[QueueListener]:
+    """
+    Log through a queue to a background thread writing to stderr, in text or JSON lines (LOG_FORMAT).
+    :return: the listener writing the records, to be stopped on shutdown
+    """
+    global _content_mode, _content_max_length
+    _content_mode = os.getenv(LoggingEnv.CONTENT.value, "truncate").lower()
+    _content_max_length = int(get_float_env(LoggingEnv.CONTENT_MAX_LENGTH.value, DEFAULT_CONTENT_MAX_LENGTH))
+
+    writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    writer.setFormatter(JsonFormatter() if os.getenv(LoggingEnv.FORMAT.value, "text").lower() == "json"
+                        else TextFormatter())
+    records = queue.Queue(maxsize=int(get_float_env(LoggingEnv.QUEUE_SIZE.value, DEFAULT_QUEUE_SIZE)))
+    handler = _DroppingQueueHandler(records)
+    handler.addFilter(_ContextFilter(get_float_env(LoggingEnv.DEBUG_SAMPLE_RATE.value, 1.0)))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv(LoggingEnv.LEVEL.value, "INFO").upper())
+
+    listener = QueueListener(records, writer, respect_handler_level=True)
+    listener.start()
+    return listener
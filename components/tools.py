@@ -1,5 +1,6 @@
 import base64
 import hashlib
+import logging
 import os
 from urllib.parse import urlparse
 
@@ -22,10 +23,10 @@ def download_file(url, dir_path, file_extension=None):
         file_path = os.path.join(dir_name, file_name)
         with open(file_path, 'wb') as file:
             file.write(response.content)
-        print(f'File has been saved as：{file_path}')
+        logging.info('File has been saved as：%s' % file_path)
         return file_path
     else:
-        print('File download error')
+        logging.error('File download error: %s' % response.status_code)
 
 
 def truncate_string(s):
@@ -43,3 +44,36 @@ def image_to_base64(image_path):
 
 def is_true(string: str) -> bool:
     return string is not None and string.lower() == 'true'
+
+
+def get_float_env(name: str, default: float = None) -> float:
+    value = os.getenv(name)
+    if value is None or len(value.strip()) == 0:
+        return default
+    return float(value)
+
+
+class SlottedRecord:
+    """
+    Base of the small internal types created for every message and updated for every chunk.
+    Attributes are declared in __slots__ and set as given: no validation nor copy, unlike pydantic models.
+    """
+
+    __slots__ = ()
+
+    def dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def copy(self):
+        return type(self)(**self.dict())
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.dict() == other.dict()
+
+    __hash__ = None  # mutable
+
+    def __str__(self):
+        return " ".join("%s=%r" % item for item in self.dict().items())
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % item for item in self.dict().items()))
@@ -0,0 +1,306 @@
+import argparse
+import contextvars
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from components.tools import is_true, get_float_env
+
+
+class TracingEnv(Enum):
+    ENABLE = "TRACING_ENABLE"
+    PATH = "TRACING_PATH"
+    MAX_BYTES = "TRACING_MAX_BYTES"
+    BACKUP_COUNT = "TRACING_BACKUP_COUNT"
+    OTLP_ENDPOINT = "TRACING_OTLP_ENDPOINT"  # e.g. http://127.0.0.1:4318/v1/traces
+
+
+# Stages of a request, in the order they happen.
+STAGES = ["callback", "get_file_download_url", "download_file", "queue", "process", "first_token", "generation",
+          "segment", "send_text", "send_card"]
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Span:
+    def __init__(self, trace_id: str, name: str, parent_id: str = None, attributes: Dict[str, Any] = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_time = time.time()
+        self.duration: float = None
+        self.attributes = attributes if attributes is not None else {}
+        self.error: str = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start_time": round(self.start_time, 6), "duration": round(self.duration, 6),
+                "attributes": self.attributes, "error": self.error}
+
+
+def _otlp_value(value) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    # https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+    start_nanos = int(span.start_time * 1e9)
+    otlp_span = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # internal
+        "startTimeUnixNano": str(start_nanos),
+        "endTimeUnixNano": str(start_nanos + int(span.duration * 1e9)),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error is not None else {}
+    }
+    if span.parent_id is not None:
+        otlp_span["parentSpanId"] = span.parent_id
+    return otlp_span
+
+
+class Tracer:
+    """
+    Records timed spans of each request, a trace id links the spans of a request.
+    Spans are written by a background thread to a JSONL file rotated by size,
+    and optionally exported (OTLP/HTTP JSON) to a local collector. Spans are dropped rather than slowing requests.
+    """
+
+    DEFAULT_PATH = "./traces.jsonl"
+    DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+    DEFAULT_BACKUP_COUNT = 3
+    MAX_PENDING_SPANS = 10000
+    EXPORT_BATCH_SIZE = 256
+    EXPORT_INTERVAL = 2.0  # seconds
+    SERVICE_NAME = "chatGPDing"
+
+    def __init__(self,
+                 path: str = DEFAULT_PATH,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 backup_count: int = DEFAULT_BACKUP_COUNT,
+                 otlp_endpoint: str = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.otlp_endpoint = otlp_endpoint
+        self.dropped = 0
+
+        self._pending = queue.Queue(maxsize=self.MAX_PENDING_SPANS)
+        self._closed = False
+        self._file = None
+        self._writer = threading.Thread(target=self._write_spans, name="tracing-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def from_env() -> Optional['Tracer']:
+        if not is_true(os.getenv(TracingEnv.ENABLE.value)):
+            return None
+        max_bytes = get_float_env(TracingEnv.MAX_BYTES.value, Tracer.DEFAULT_MAX_BYTES)
+        backup_count = get_float_env(TracingEnv.BACKUP_COUNT.value, Tracer.DEFAULT_BACKUP_COUNT)
+        tracer = Tracer(os.getenv(TracingEnv.PATH.value, Tracer.DEFAULT_PATH), int(max_bytes), int(backup_count),
+                        os.getenv(TracingEnv.OTLP_ENDPOINT.value))
+        logging.info("Tracing enabled: %s" % tracer)
+        return tracer
+
+    @contextmanager
+    def span(self, name: str, trace_id: str = None, **attributes):
+        """
+        Time the block as a span, child of the current span.
+        :param name: stage name
+        :param trace_id: starts a new trace (or joins one) when there is no current span
+        """
+        parent = _current_span.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent is not None else new_trace_id()
+        span = Span(trace_id, name, parent.span_id if parent is not None and parent.trace_id == trace_id else None,
+                    attributes)
+        reset_token = _current_span.set(span)
+        start_time = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - start_time
+            _current_span.reset(reset_token)
+            self._export(span)
+
+    def record(self, name: str, duration: float, start_time: float = None, trace_id: str = None, **attributes) -> None:
+        """
+        Record a span already timed, child of the current span.
+        :param start_time: time.time() when it started, `duration` ago by default
+        """
+        parent = _current_span.get()
+        if trace_id is None:
+            if parent is None:
+                return
+            trace_id = parent.trace_id
+        span = Span(trace_id, name, parent.span_id if parent is not None and parent.trace_id == trace_id else None,
+                    attributes)
+        span.start_time = start_time if start_time is not None else time.time() - duration
+        span.duration = max(0.0, duration)
+        self._export(span)
+
+    def _export(self, span: Span) -> None:
+        try:
+            self._pending.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_spans(self) -> None:
+        batch: List[Span] = []
+        exported_at = time.monotonic()
+        while True:
+            try:
+                span = self._pending.get(timeout=self.EXPORT_INTERVAL)
+            except queue.Empty:
+                span = None
+            if span is not None:
+                try:
+                    self._write(json.dumps(span.to_dict(), ensure_ascii=False))
+                except Exception as e:
+                    logging.error("Failed to write span: %s" % e)
+                if self.otlp_endpoint is not None:
+                    batch.append(span)
+            if self._pending.empty():
+                if self._file is not None:
+                    self._file.flush()
+                if self._closed:
+                    break
+            if len(batch) > 0 and (len(batch) >= self.EXPORT_BATCH_SIZE
+                                   or time.monotonic() - exported_at >= self.EXPORT_INTERVAL or self._closed):
+                self._export_otlp(batch)
+                batch = []
+                exported_at = time.monotonic()
+        if len(batch) > 0:
+            self._export_otlp(batch)
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, line: str) -> None:
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(line + "\n")
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        # traces.jsonl -> traces.jsonl.1 -> traces.jsonl.2 ...
+        self._file.close()
+        self._file = None
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, index)):
+                os.replace("%s.%d" % (self.path, index), "%s.%d" % (self.path, index + 1))
+        os.replace(self.path, self.path + ".1")
+
+    def _export_otlp(self, spans: List[Span]) -> None:
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [_otlp_span(span) for span in spans]}]
+        }]}
+        try:
+            response = requests.post(self.otlp_endpoint, json=payload, timeout=5)
+            if response.status_code >= 300:
+                logging.warning("Failed to export %d span(s): HTTP %d" % (len(spans), response.status_code))
+        except Exception as e:
+            logging.warning("Failed to export %d span(s): %s" % (len(spans), e))
+
+    def close(self) -> None:
+        self._closed = True
+        self._pending.put(None)  # wake up the writer
+        self._writer.join(10.0)
+
+    def __str__(self):
+        return self.path + (" and " + self.otlp_endpoint if self.otlp_endpoint is not None else "")
+
+
+def load_traces(paths: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    :return: spans of each trace id
+    """
+    traces = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if len(line.strip()) == 0:
+                    continue
+                span = json.loads(line)
+                traces.setdefault(span["trace_id"], []).append(span)
+    return traces
+
+
+def summarize(traces: Dict[str, List[Dict[str, Any]]], top: int = 10) -> str:
+    """
+    The slowest requests, with the time spent in each stage.
+    """
+    rows = []
+    for trace_id, spans in traces.items():
+        start = min(span["start_time"] for span in spans)
+        end = max(span["start_time"] + span["duration"] for span in spans)
+        stages = {}
+        for span in spans:
+            stages[span["name"]] = stages.get(span["name"], 0.0) + span["duration"]
+        errors = sorted(set(span["name"] + ":" + span["error"] for span in spans if span.get("error")))
+        rows.append((end - start, trace_id, stages, errors))
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    names = set(name for row in rows for name in row[2])
+    columns = [stage for stage in STAGES if stage in names] + sorted(names - set(STAGES))
+    lines = ["Slowest %d of %d requests (seconds):" % (min(top, len(rows)), len(rows)),
+             "%-32s %8s " % ("trace", "total") + " ".join("%*s" % (max(8, len(column)), column) for column in columns)]
+    for total, trace_id, stages, errors in rows[:top]:
+        cells = " ".join("%*s" % (max(8, len(column)), "%.3f" % stages[column] if column in stages else "-")
+                         for column in columns)
+        lines.append("%-32s %8.3f %s%s" % (trace_id, total, cells, ("  " + ", ".join(errors)) if errors else ""))
+
+    # Where the time goes, over all the requests.
+    lines.append("")
+    lines.append("%-24s %8s %8s %8s %8s" % ("stage", "count", "p50", "p95", "max"))
+    for column in columns:
+        durations = sorted(row[2][column] for row in rows if column in row[2])
+        lines.append("%-24s %8d %8.3f %8.3f %8.3f" % (column, len(durations), durations[len(durations) // 2],
+                                                      durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                                                      durations[-1]))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    # python -m components.tracing summarize [traces.jsonl ...] --top 10
+    parser = argparse.ArgumentParser(description="Summarize the slowest requests by stage.")
+    parser.add_argument("command", choices=["summarize"])
+    parser.add_argument("paths", nargs="*", help="trace files, the TRACING_PATH file and its backups by default")
+    parser.add_argument("--top", type=int, default=10)
+    arguments = parser.parse_args()
+
+    trace_paths = arguments.paths
+    if len(trace_paths) == 0:
+        default_path = os.getenv(TracingEnv.PATH.value, Tracer.DEFAULT_PATH)
+        trace_paths = [path for path in [default_path] + sorted(glob.glob(default_path + ".*")) if os.path.exists(path)]
+    print(summarize(load_traces(trace_paths), arguments.top))
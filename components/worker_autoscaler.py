@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+
+
+class WorkerAutoscaler:
+    """
+    Decides how many workers are needed, between min and max.
+    The load estimate is the arrival rate times the processing time (Little's law), with some headroom.
+    Requests waiting with no idle worker, or waiting too long, call for more workers at once.
+    Scaling up is quick, scaling down waits for the lower need to last and goes one worker at a time.
+    """
+
+    EWMA_ALPHA = 0.2
+    TARGET_UTILIZATION = 0.75
+    SCALE_UP_QUEUE_WAIT = 2.0  # seconds
+    SCALE_DOWN_UTILIZATION = 0.5
+    SCALE_UP_COOLDOWN = 5.0
+    SCALE_DOWN_COOLDOWN = 60.0
+    SCALE_DOWN_DELAY = 30.0  # how long the need must stay low before a worker is retired
+
+    def __init__(self, min_workers: int, max_workers: int):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+
+        self._lock = threading.Lock()
+        self._arrivals = 0
+        self._arrivals_since = time.monotonic()
+        self.arrival_rate: float = None  # requests per second
+        self.processing_time: float = None  # seconds per request
+        self.queue_wait: float = None  # seconds
+        self._changed_at = 0.0
+        self._low_since: float = None
+
+    def _ewma(self, average: float, value: float) -> float:
+        return value if average is None else average + self.EWMA_ALPHA * (value - average)
+
+    def observe_enqueued(self) -> None:
+        with self._lock:
+            self._arrivals += 1
+
+    def observe_dequeued(self, queue_wait: float) -> None:
+        with self._lock:
+            self.queue_wait = self._ewma(self.queue_wait, queue_wait)
+
+    def observe_processed(self, processing_time: float) -> None:
+        with self._lock:
+            self.processing_time = self._ewma(self.processing_time, processing_time)
+
+    def desired_workers(self, current: int, busy: int, queue_depth: int, now: float = None) -> int:
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            elapsed = now - self._arrivals_since
+            if elapsed > 0:
+                self.arrival_rate = self._ewma(self.arrival_rate, self._arrivals / elapsed)
+                self._arrivals = 0
+                self._arrivals_since = now
+
+            target = self.min_workers
+            if self.arrival_rate is not None and self.processing_time is not None:
+                target = max(target, math.ceil(self.arrival_rate * self.processing_time / self.TARGET_UTILIZATION))
+            if queue_depth > 0 and (busy >= current or (self.queue_wait or 0.0) > self.SCALE_UP_QUEUE_WAIT):
+                target = max(target, busy + queue_depth)
+            target = min(target, self.max_workers)
+
+            if target > current:
+                self._low_since = None
+                if now - self._changed_at < self.SCALE_UP_COOLDOWN:
+                    return current
+                self._changed_at = now
+                return target
+
+            # hysteresis: only an idle enough pool shrinks
+            if target < current and busy < current * self.SCALE_DOWN_UTILIZATION and queue_depth == 0:
+                if self._low_since is None:
+                    self._low_since = now
+                if (now - self._low_since >= self.SCALE_DOWN_DELAY
+                        and now - self._changed_at >= self.SCALE_DOWN_COOLDOWN):
+                    self._changed_at = now
+                    self._low_since = now
+                    return current - 1
+            else:
+                self._low_since = None
+            return current
+
+    def __str__(self):
+        return "%d to %d workers" % (self.min_workers, self.max_workers)
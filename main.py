@@ -1,20 +1,36 @@
+import asyncio
 import logging
 import os
+import sys
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import JSONResponse
+
+from components import metrics
 
 from components.ai_side.chatbot_client import ChatBotServerType
 from components.ai_side.chatbot_client_builder import ChatBotClientBuilder
 from components.dingtalk_message_handler import DingtalkMessageHandler
+from components.health import HealthCheck
 from components.im_side.dingtalk_client import DingtalkClient
+from components.im_side.dingtalk_stream import DingtalkStreamClient
+from components.structured_logging import setup_logging
+
+# Each process of SERVER_WORKERS runs this module as __mp_main__ first, the application is then imported from it
+# instead of a second copy with its own handler.
+if __name__ == '__mp_main__':
+    sys.modules['main'] = sys.modules[__name__]
 
 # Deciding on the type of server
 if os.getenv('CHATBOT_SERVER_TYPE') is None:
     print("Please set CHATBOT_SERVER_TYPE. ", [member.value for member in ChatBotServerType])
     exit()
 
-logging.getLogger().setLevel(logging.INFO)
+# Records are written by a background thread, logging never waits for the output.
+log_listener = setup_logging()
 
 chatbot_server_type = ChatBotServerType(os.getenv('CHATBOT_SERVER_TYPE').lower())
 logging.info("ChatBot Server Type: " + chatbot_server_type.name)
@@ -27,18 +43,69 @@ dingtalk_client = DingtalkClient()
 # create handler
 handler = DingtalkMessageHandler(chatbot_client_builder, dingtalk_client)
 
+# values read at each scrape of /metrics
+metrics.QUEUE_DEPTH.set_function(handler.coordination.size)
+metrics.BUSY_WORKERS.set_function(lambda: handler.busy_workers)
+metrics.WORKERS.set_function(lambda: handler.workers)
+
+# state reported to load balancers and supervisors
+health_check = HealthCheck.from_env(handler, dingtalk_client, chatbot_client_builder.provider_pool)
+
+
+class GracefulServer(uvicorn.Server):
+    """
+    On the shutdown signal this process is not ready at once, it stops serving after the grace period
+    so the load balancers stop sending to it first. A second signal does not wait.
+    """
+
+    def handle_exit(self, sig, frame) -> None:
+        if handler.draining or health_check.grace_period <= 0:
+            super().handle_exit(sig, frame)
+            return
+        handler.start_draining()
+        logging.info("Shutting down in %s s." % health_check.grace_period)
+        asyncio.get_event_loop().call_later(health_check.grace_period, super().handle_exit, sig, frame)
+
+
+async def handle_message(app_key: str, message: dict) -> dict:
+    with metrics.CALLBACK_SECONDS.labels(app_key=app_key).time():
+        return await handler.handle_message_from_dingtalk(app_key, message)
+
+
+# Longest wait for the DingTalk connections and access tokens on startup.
+WARM_UP_TIMEOUT = 10.0
+
+# Messages may also come through DingTalk Stream mode connections, no public endpoint is needed then.
+stream_client = DingtalkStreamClient.from_env(dingtalk_client, handle_message)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # The logic here is executed after startup. The logic here is executed before stopping.
+    keep_warm = None
+    if handler.keep_warm_interval > 0:
+        # Connections and access tokens ready before the first message, not opened by it.
+        try:
+            await asyncio.wait_for(dingtalk_client.warm_up(), WARM_UP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("DingTalk warm up not finished in %s s, starting anyway." % WARM_UP_TIMEOUT)
+        keep_warm = asyncio.create_task(dingtalk_client.keep_warm(handler.keep_warm_interval))
     logging.info('DingtalkMessagesHandler workers Starting up.')
     handler.start_workers()
+    if stream_client is not None:
+        stream_client.start()
 
     yield
 
     # The logic here is executed before stopping.
+    if stream_client is not None:
+        await stream_client.stop()
+    if keep_warm is not None:
+        keep_warm.cancel()
     logging.info('DingtalkMessagesHandler workers Shutting down.')
-    handler.stop_workers()
+    await asyncio.to_thread(handler.stop_workers)
+    await dingtalk_client.close()
+    log_listener.stop()
 
 
 application = FastAPI(lifespan=lifespan)
@@ -46,25 +113,58 @@ application = FastAPI(lifespan=lifespan)
 
 @application.post("/")
 async def root(request: Request):
-    # check signature
+    # reject stale or replayed signatures before reading the body
     timestamp = request.headers.get('timestamp')
     signature = request.headers.get('sign')
-    app_key = handler.check_signature(timestamp, signature)
+    handler.check_signature_headers(timestamp, signature)
 
     # receive from dingtalk
     message = await request.json()
 
+    # check signature, the robot code tells which secret to try
+    app_key = handler.check_signature(timestamp, signature, message.get('robotCode'))
+
     # handle and return
-    return await handler.handle_message_from_dingtalk(app_key, message)
+    return await handle_message(app_key, message)
 
 
-if __name__ == '__main__':
-    import uvicorn
-    import os
+@application.get("/healthz")
+async def healthz():
+    # alive: restart the process otherwise
+    report = await asyncio.to_thread(health_check.report)
+    return JSONResponse(content=report, status_code=200 if report["alive"] else 503)
+
 
+@application.get("/readyz")
+async def readyz():
+    # ready for more traffic: not draining, nor saturated, nor without workers or upstream
+    report = await asyncio.to_thread(health_check.report)
+    return JSONResponse(content=report, status_code=200 if report["ready"] else 503)
+
+
+@application.get("/metrics")
+async def prometheus_metrics():
+    # Each process of SERVER_WORKERS has its own metrics.
+    if not metrics.metrics_enabled():
+        raise HTTPException(status_code=404)
+    # the queue depth may be read from the shared backend (blocking I/O), out of the event loop
+    return Response(content=await asyncio.to_thread(metrics.REGISTRY.render), media_type=metrics.CONTENT_TYPE)
+
+
+if __name__ == '__main__':
     port = 8000
 
     if os.getenv("SERVER_PORT") is not None:
         port = int(os.getenv("SERVER_PORT"))
 
-    uvicorn.run(application, host="0.0.0.0", port=port)
+    # More than one process needs a shared COORDINATION_BACKEND (sqlite or redis).
+    workers = int(os.getenv("SERVER_WORKERS", "1"))
+    if workers > 1:
+        if not handler.coordination.shared:
+            print("Please set COORDINATION_BACKEND to run SERVER_WORKERS=%d processes." % workers)
+            exit()
+        config = uvicorn.Config("main:application", host="0.0.0.0", port=port, workers=workers)
+        server = GracefulServer(config)
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        GracefulServer(uvicorn.Config(application, host="0.0.0.0", port=port)).run()
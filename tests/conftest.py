@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the components are imported from the repository root, as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DINGTALK_APP_KEY", "appkey1")
+os.environ.setdefault("DINGTALK_APP_SECRET", "secret1")
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from components.ai_side.chatbot_client import CancellableStream, ChatBotClient, ChatBotServerType, TokenUsage
+
+
+class FakeStream(CancellableStream):
+    """
+    Streams the chunks, then hangs until it is closed, as a reply still being generated.
+    """
+
+    def __init__(self, token_usage: TokenUsage, chunks: list, first_chunk_delay: float = 0.0):
+        super().__init__(token_usage)
+        self.chunks = iter(chunks)
+        self.first_chunk_delay = first_chunk_delay
+        self.closed = threading.Event()
+
+    def _next_chunk(self) -> str:
+        if self.first_chunk_delay > 0 and self.closed.wait(self.first_chunk_delay):
+            raise IOError("closed")
+        self.first_chunk_delay = 0.0
+        for chunk in self.chunks:
+            self.token_usage.output_tokens += 1
+            return chunk
+        if self.closed.wait(10):
+            raise IOError("closed")
+        raise TimeoutError("never closed")
+
+    def _close(self) -> None:
+        self.closed.set()
+
+
+class SteadyStream(CancellableStream):
+    """
+    A chunk every `interval` seconds on the clock of the chatbot server, kept until the consumer reads it.
+    """
+
+    def __init__(self, chunks: int, interval: float, stall_at: int = None):
+        super().__init__(TokenUsage(input_tokens=3, output_tokens=0, image_tokens=0))
+        self.remaining = chunks
+        self.interval = interval
+        self.stall_at = stall_at
+        self.next_at = time.monotonic() + interval
+        self.closed = threading.Event()
+
+    def _next_chunk(self) -> str:
+        if self.remaining == 0:
+            raise StopIteration
+        stalled = self.stall_at is not None and self.remaining == self.stall_at
+        if self.closed.wait(10 if stalled else max(0.0, self.next_at - time.monotonic())):
+            raise IOError("closed")
+        self.next_at = max(self.next_at, time.monotonic()) + self.interval
+        self.remaining -= 1
+        return "chunk "
+
+    def _close(self) -> None:
+        self.closed.set()
+
+
+class FakeChatBotClient(ChatBotClient):
+    """
+    Replies with `chunks`, the first one after the delay of the target's api key in `first_chunk_delays`.
+    """
+
+    server_type = ChatBotServerType.OpenAI
+    supports_streaming_response = True
+    has_multi_modal_ability = False
+
+    def __init__(self, *args, chunks: list = None, first_chunk_delays: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunks = chunks if chunks is not None else ["Hello!"]
+        self.first_chunk_delays = first_chunk_delays if first_chunk_delays is not None else {}
+        self.streams = []
+        self.requested = []  # api keys of the targets, in request order
+        self._lock = threading.Lock()
+
+    def _create_completions(self, target, messages, system=None, cancellation_token=None):
+        usage = TokenUsage(input_tokens=3, output_tokens=0, image_tokens=0)
+        stream = FakeStream(usage, self.chunks, self.first_chunk_delays.get(target.api_key, 0.0))
+        with self._lock:
+            self.streams.append(stream)
+            self.requested.append(target.api_key)
+        return stream.bind(cancellation_token), usage
+
+
+class NullChatBotClient:
+    def close(self) -> None:
+        pass
+
+
+class FakeChatBotClientBuilder:
+    def build(self) -> NullChatBotClient:
+        return NullChatBotClient()
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class FakeClock:
+    """
+    Stands in for the time module of the code under test: time only passes by sleeping or advancing.
+    """
+
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
@@ -0,0 +1,104 @@
+import pytest
+from anthropic.types import ContentBlockDeltaEvent, Message, MessageDeltaEvent, MessageDeltaUsage, \
+    MessageStartEvent, ContentBlock, TextDelta, Usage
+from anthropic.types.message_delta_event import Delta
+
+from components.ai_side.anthropic_chatbot_client import AnthropicChatBotClient, IterableMessageChunk
+from components.ai_side.chatbot_client import ChatMessage, TokenUsage
+
+
+class FakeEvents:
+    def __init__(self, events: list):
+        self.events = iter(events)
+
+    def __next__(self):
+        return next(self.events)
+
+    def close(self) -> None:
+        pass
+
+
+def _events(texts: list, output_tokens: int = None) -> list:
+    events = [MessageStartEvent(type="message_start", message=Message(
+        id="msg_1", content=[], model="claude-3-haiku-20240307", role="assistant", stop_reason=None,
+        stop_sequence=None, type="message", usage=Usage(input_tokens=12, output_tokens=1)))]
+    events += [ContentBlockDeltaEvent(type="content_block_delta", index=0,
+                                      delta=TextDelta(type="text_delta", text=text)) for text in texts]
+    if output_tokens is not None:
+        events.append(MessageDeltaEvent(type="message_delta", delta=Delta(stop_reason="end_turn", stop_sequence=None),
+                                        usage=MessageDeltaUsage(output_tokens=output_tokens)))
+    return events
+
+
+def _client() -> AnthropicChatBotClient:
+    return AnthropicChatBotClient("key", None, "claude-3-haiku-20240307", None, True, False)
+
+
+def test_interrupted_stream_counts_the_generated_tokens():
+    client = _client()
+    usage = TokenUsage(input_tokens=0, output_tokens=0, image_tokens=0)
+    stream = IterableMessageChunk(FakeEvents(_events(["Hello, how are", " you today? 你好"])), usage, client)
+
+    assert "".join([next(stream), next(stream), next(stream)]) == "Hello, how are you today? 你好"
+    stream.cancel()
+
+    assert usage.input_tokens == 12
+    estimate = client.estimate_tokens("Hello, how are") + client.estimate_tokens(" you today? 你好")
+    assert usage.output_tokens == 1 + estimate
+
+
+def test_final_usage_replaces_the_estimate():
+    usage = TokenUsage(input_tokens=0, output_tokens=0, image_tokens=0)
+    stream = IterableMessageChunk(FakeEvents(_events(["Hello, how are", " you today?"], output_tokens=9)), usage,
+                                  _client())
+
+    assert "".join(stream) == "Hello, how are you today?"
+    assert usage.output_tokens == 9
+
+
+class FakeMessages:
+    """
+    Keeps the parameters of the request and answers at once, without streaming.
+    """
+
+    def __init__(self):
+        self.with_raw_response = self
+        self.requests = []
+        self.headers = {}
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self
+
+    def parse(self) -> Message:
+        return Message(id="msg_1", content=[ContentBlock(type="text", text="Hello!")], model="claude-3-haiku-20240307",
+                       role="assistant", stop_reason="end_turn", stop_sequence=None, type="message",
+                       usage=Usage(input_tokens=12, output_tokens=2))
+
+
+def _request(client: AnthropicChatBotClient, messages: list, system: str) -> dict:
+    fake_messages = FakeMessages()
+    client._sdk_client = lambda target: type("FakeAnthropic", (), {"messages": fake_messages})()
+    client._create_completions(client.provider_pool.targets[0], messages, system)
+    return fake_messages.requests[0]
+
+
+LARGE_TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 200
+
+
+@pytest.mark.parametrize("system, document, cached_system, cached_document", [
+    ("You are a very helpful assistant.", "What time is it?", False, False),
+    (LARGE_TEXT, "What time is it?", True, False),
+    ("You are a very helpful assistant.", LARGE_TEXT, False, True),
+])
+def test_only_large_texts_are_marked_for_caching(system, document, cached_system, cached_document):
+    client = AnthropicChatBotClient("key", None, "claude-3-haiku-20240307", None, False, False)
+    request = _request(client, [ChatMessage(role="user", content=document)], system)
+
+    assert isinstance(request["system"], list) == cached_system
+    if cached_system:
+        assert request["system"][0]["cache_control"] == {"type": "ephemeral"}
+    content = request["messages"][0]["content"]
+    assert (not isinstance(content, str) and "cache_control" in content[-1]) == cached_document
+    # the beta header only with a breakpoint
+    assert (request["extra_headers"] is not None) == (cached_system or cached_document)
@@ -0,0 +1,42 @@
+from components.ai_side.chatbot_client import ChatMessage
+from components.ai_side.hedging import HedgingPolicy
+from components.ai_side.provider_pool import ProviderPool
+from tests.fakes import FakeChatBotClient, wait_until
+
+
+def _client(api_keys: str, first_chunk_delays: dict) -> FakeChatBotClient:
+    return FakeChatBotClient(None, model_name="fake-model", enable_streaming=True,
+                             provider_pool=ProviderPool.from_config(api_keys),
+                             hedging_policy=HedgingPolicy(min_delay=0.1, initial_delay=0.1),
+                             first_chunk_delays=first_chunk_delays)
+
+
+def _outstanding(client: FakeChatBotClient) -> int:
+    return sum(target.outstanding for target in client.provider_pool.targets)
+
+
+def test_late_first_token_is_hedged_on_another_target():
+    client = _client("slow,fast", {"slow": 1.0})
+    client.provider_pool.targets[1].latency_ewma = 1.0  # the slow target is chosen first
+
+    reply, usage = client.completions([ChatMessage(role="user", content="hello")])
+
+    assert client.requested == ["slow", "fast"]
+    assert client.hedging_policy.hedges == 1
+    assert next(reply) == "Hello!"
+    # the loser is cancelled, and released with the winner once the reply is over
+    assert client.streams[0].closed.is_set()
+    reply.cancel()
+    assert wait_until(lambda: _outstanding(client) == 0)
+
+
+def test_no_hedge_without_another_target():
+    client = _client("slow", {"slow": 0.5})
+
+    reply, usage = client.completions([ChatMessage(role="user", content="hello")])
+
+    assert client.requested == ["slow"]
+    assert client.hedging_policy.hedges == 0
+    assert next(reply) == "Hello!"
+    reply.cancel()
+    assert wait_until(lambda: _outstanding(client) == 0)
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from benchmarks.fake_redis_server import FakeRedis, serve
+from components.ai_side.chatbot_client import CancellationToken
+from components.coordination import QueuedRequest, RedisCoordination, SqliteCoordination, _RedisConnection
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    """
+    The local stand-in for Redis, served by a background event loop.
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(serve(FakeRedis()), "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield "redis://127.0.0.1:%d/0" % server.sockets[0].getsockname()[1]
+
+    async def stop():
+        server.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def coordination(request, tmp_path):
+    if request.param == "sqlite":
+        coordination = SqliteCoordination(str(tmp_path / "coordination.db"))
+    else:
+        coordination = RedisCoordination(request.getfixturevalue("redis_url"))
+        coordination.KEY_PREFIX = "test:%s:" % request.node.name  # the server is shared by the tests
+    yield coordination
+    coordination.close()
+
+
+def _request(conversation: str, request_id: str, content: str = "hello") -> QueuedRequest:
+    return QueuedRequest(conversation, {"content": content}, cancellation=CancellationToken(),
+                         request_id=request_id, enqueued_at=time.time(), trace_id="trace-" + request_id)
+
+
+def test_put_and_get(coordination):
+    coordination.put(_request("user1", "r1", "first"))
+    coordination.put(_request("user2", "r2", "second"))
+    assert coordination.size() == 2
+
+    first = coordination.get(1)
+    assert (first.request_id, first.parameters, first.trace_id) == ("r1", {"content": "first"}, "trace-r1")
+    assert first.cancellation is not None
+    assert coordination.get(1).request_id == "r2"
+    assert coordination.size() == 0
+    assert coordination.get(1) is None
+
+
+def test_lease_acquire_and_release(coordination):
+    request = _request("user1", "r1")
+    assert coordination.acquire_in_flight(request) is None
+    assert coordination.in_flight("user1").request_id == "r1"
+    assert coordination.refresh_in_flight(request)
+
+    coordination.release_in_flight(request)
+    assert coordination.in_flight("user1") is None
+    assert not coordination.refresh_in_flight(request)
+
+
+def test_newer_request_supersedes(coordination):
+    older, newer = _request("user1", "r1"), _request("user1", "r2")
+    coordination.acquire_in_flight(older)
+
+    assert coordination.acquire_in_flight(newer).request_id == "r1"
+    # the older one finishing does not release the newer one
+    coordination.release_in_flight(older)
+    assert coordination.in_flight("user1").request_id == "r2"
+    assert not coordination.refresh_in_flight(older)
+
+
+def test_without_replace_the_request_in_flight_is_kept(coordination):
+    coordination.acquire_in_flight(_request("user1", "r1"))
+
+    assert coordination.acquire_in_flight(_request("user1", "r2"), replace=False).request_id == "r1"
+    assert coordination.in_flight("user1").request_id == "r1"
+
+
+@pytest.mark.parametrize("replace", [True, False])
+def test_lease_expires(coordination, replace):
+    coordination.LEASE_SECONDS = 0.2
+    coordination.acquire_in_flight(_request("user1", "r1"), replace=replace)
+    assert coordination.in_flight("user1") is not None
+
+    time.sleep(0.3)
+    assert coordination.in_flight("user1") is None
+
+
+def test_cancellation_reasons(coordination):
+    cancelled, other = _request("user1", "r1"), _request("user1", "r2")
+    coordination.cancel(cancelled, "superseded")
+
+    assert coordination.cancellation_reason(cancelled) == "superseded"
+    assert coordination.cancellation_reason(other) is None
+
+
+def test_first_seen(coordination):
+    assert coordination.first_seen("message:m1", 60)
+    assert not coordination.first_seen("message:m1", 60)
+    assert coordination.first_seen("message:m2", 60)
+
+
+def test_redis_connection_closed_while_idle_is_opened_again(redis_url):
+    coordination = RedisCoordination(redis_url)
+    coordination.KEY_PREFIX = "test:idle:"
+    coordination._connection().execute("QUIT")  # as the server closing an idle connection
+    time.sleep(0.1)
+
+    coordination.put(_request("user1", "r1"))
+    assert coordination.size() == 1
+    coordination.close()
+
+
+def test_redis_command_failing_after_it_was_written_is_not_sent_again(redis_url, monkeypatch):
+    coordination = RedisCoordination(redis_url)
+    coordination.KEY_PREFIX = "test:timeout:"
+    read_reply = _RedisConnection._read_reply
+    failures = [TimeoutError("timed out")]
+
+    def time_out_once(connection):
+        if failures:
+            raise failures.pop()
+        return read_reply(connection)
+
+    monkeypatch.setattr(_RedisConnection, "_read_reply", time_out_once)
+    with pytest.raises(TimeoutError):
+        coordination.put(_request("user1", "r1"))
+    assert coordination.size() == 1  # enqueued once
+    coordination.close()
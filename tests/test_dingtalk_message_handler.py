@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+import time
+
+from components.ai_side.chatbot_client import CancellationToken
+from components.conversation_memory import InMemoryConversationMemory
+from components.coordination import QueuedRequest
+from components.dingtalk_message_handler import DingtalkMessageHandler
+from components.im_side.dingtalk_client import DingtalkClient
+from components.response_cache import ResponseCache
+from tests.fakes import FakeChatBotClient
+
+# the first paragraph is sent while the second one is generated
+CHUNKS = ["First paragraph. " * 8, "\n\nSecond"]
+
+
+class FakeDingtalkClient(DingtalkClient):
+    def __init__(self):
+        super().__init__()
+        self.markdowns = []
+
+    async def send_markdown(self, title, text, session_webhook):
+        self.markdowns.append(title)
+
+
+class FailingSendHandler(DingtalkMessageHandler):
+    async def send_message_to_dingtalk(self, session_webhook, send_to, content, chat_model_name) -> bool:
+        raise ConnectionError("DingTalk is down")
+
+
+def _request() -> QueuedRequest:
+    return QueuedRequest("user1", {
+        "session_webhook": "http://127.0.0.1/webhook", "send_to": "user1", "content": "hello",
+        "is_group_chat": False, "app_key": "appkey1"}, cancellation=CancellationToken(), request_id="r1")
+
+
+def test_failure_midway_releases_the_upstream_request():
+    chatbot_client = FakeChatBotClient("key", model_name="fake-model", enable_streaming=True, chunks=CHUNKS)
+    cache = ResponseCache(ttl=60)
+    dingtalk_client = FakeDingtalkClient()
+    handler = FailingSendHandler(None, dingtalk_client, response_cache=cache)
+    request = _request()
+
+    start_time = time.monotonic()
+    asyncio.run(handler.process_request(request, chatbot_client))
+
+    # told about the error, the stream is closed without waiting for its end
+    assert time.monotonic() - start_time < 5
+    assert dingtalk_client.markdowns == ["我错了 orz"]
+    assert request.cancellation.reason == handler.ABORTED_REASON
+    assert chatbot_client.streams[0].closed.is_set()
+    assert chatbot_client.provider_pool.targets[0].outstanding == 0
+    assert cache.stats()["in_flight"] == 0
+
+
+class BrokenConversationMemory(InMemoryConversationMemory):
+    def history(self, key, max_tokens):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_failure_while_preparing_is_told_to_the_user():
+    chatbot_client = FakeChatBotClient("key", model_name="fake-model", enable_streaming=True, chunks=CHUNKS)
+    dingtalk_client = FakeDingtalkClient()
+    handler = DingtalkMessageHandler(None, dingtalk_client, conversation_memory=BrokenConversationMemory())
+    request = _request()
+    request.parameters["conversation_key"] = "user1"
+
+    asyncio.run(handler.process_request(request, chatbot_client))
+
+    assert dingtalk_client.markdowns == ["我错了 orz"]
+    assert chatbot_client.streams == []
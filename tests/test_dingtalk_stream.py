@@ -0,0 +1,149 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+from components.im_side.dingtalk_client import DingtalkClient
+from components.im_side.dingtalk_stream import BOT_MESSAGE_TOPIC, DingtalkStreamClient
+
+
+class StreamServer:
+    """
+    Stands in for the DingTalk Stream gateway: hands out tickets and queues the WebSocket of each connection.
+    """
+
+    def __init__(self):
+        self.connections: asyncio.Queue = asyncio.Queue()
+        self.base_url = None
+        self._runner = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v1.0/gateway/connections/open", self._open)
+        app.router.add_get("/connect", self._connect)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = "http://127.0.0.1:%d" % site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    async def _open(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        assert payload["subscriptions"] == [{"type": "CALLBACK", "topic": BOT_MESSAGE_TOPIC}]
+        return web.json_response({"endpoint": self.base_url.replace("http", "ws", 1) + "/connect",
+                                  "ticket": "ticket-" + payload["clientId"]})
+
+    async def _connect(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        websocket.closed_event = asyncio.Event()
+        await self.connections.put(websocket)
+        await websocket.closed_event.wait()
+        await websocket.close()
+        return websocket
+
+
+def _frame(frame_type: str, topic: str, message_id: str, data) -> str:
+    return json.dumps({"specVersion": "1.0", "type": frame_type,
+                       "headers": {"topic": topic, "messageId": message_id, "contentType": "application/json"},
+                       "data": json.dumps(data)})
+
+
+def _message(text: str) -> dict:
+    return {"msgtype": "text", "text": {"content": text}, "sessionWebhook": "http://127.0.0.1/webhook"}
+
+
+async def _receive_ack(websocket: web.WebSocketResponse) -> dict:
+    return json.loads(await asyncio.wait_for(websocket.receive_str(), 5))
+
+
+def _run(test) -> None:
+    async def run():
+        server = StreamServer()
+        await server.start()
+        dingtalk_client = DingtalkClient(app_keys="appkey1", secret_keys="secret1", server_base_url=server.base_url)
+        try:
+            await test(server, dingtalk_client)
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_ping_and_message_are_acknowledged():
+    async def test(server: StreamServer, dingtalk_client: DingtalkClient):
+        received = []
+
+        async def on_message(app_key: str, message: dict) -> dict:
+            received.append((app_key, message["text"]["content"]))
+            return {"msgtype": "empty"}
+
+        client = DingtalkStreamClient(dingtalk_client, on_message)
+        client.start()
+        websocket = await asyncio.wait_for(server.connections.get(), 5)
+
+        await websocket.send_str(_frame("SYSTEM", "ping", "ping-1", {"opaque": "42"}))
+        ack = await _receive_ack(websocket)
+        assert (ack["code"], ack["headers"]["messageId"], json.loads(ack["data"])) == (200, "ping-1", {"opaque": "42"})
+
+        await websocket.send_str(_frame("CALLBACK", BOT_MESSAGE_TOPIC, "msg-1", _message("hello")))
+        ack = await _receive_ack(websocket)
+        assert (ack["code"], ack["headers"]["messageId"]) == (200, "msg-1")
+        assert received == [("appkey1", "hello")]
+
+        websocket.closed_event.set()
+        await client.stop()
+
+    _run(test)
+
+
+def test_reconnects_after_disconnect():
+    async def test(server: StreamServer, dingtalk_client: DingtalkClient):
+        async def on_message(app_key: str, message: dict) -> dict:
+            return {"msgtype": "empty"}
+
+        client = DingtalkStreamClient(dingtalk_client, on_message)
+        client.INITIAL_BACKOFF = 0.1
+        client.start()
+        first = await asyncio.wait_for(server.connections.get(), 5)
+
+        # asked to reconnect, then closed by the server
+        await first.send_str(_frame("SYSTEM", "disconnect", "disconnect-1", {}))
+        first.closed_event.set()
+        second = await asyncio.wait_for(server.connections.get(), 5)
+        assert client.connections == 2
+
+        await second.send_str(_frame("CALLBACK", BOT_MESSAGE_TOPIC, "msg-2", _message("again")))
+        assert (await _receive_ack(second))["headers"]["messageId"] == "msg-2"
+
+        second.closed_event.set()
+        await client.stop()
+
+    _run(test)
+
+
+def test_stop_acknowledges_the_messages_being_handled():
+    async def test(server: StreamServer, dingtalk_client: DingtalkClient):
+        handling = asyncio.Event()
+
+        async def on_message(app_key: str, message: dict) -> dict:
+            handling.set()
+            await asyncio.sleep(0.2)
+            return {"msgtype": "empty"}
+
+        client = DingtalkStreamClient(dingtalk_client, on_message)
+        client.start()
+        websocket = await asyncio.wait_for(server.connections.get(), 5)
+        await websocket.send_str(_frame("CALLBACK", BOT_MESSAGE_TOPIC, "msg-3", _message("slow")))
+        await asyncio.wait_for(handling.wait(), 5)
+
+        stopping = asyncio.create_task(client.stop())
+        ack = await _receive_ack(websocket)
+        assert (ack["code"], ack["headers"]["messageId"]) == (200, "msg-3")
+        await asyncio.wait_for(stopping, 5)
+        websocket.closed_event.set()
+
+    _run(test)
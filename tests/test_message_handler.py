@@ -0,0 +1,33 @@
+from components.coordination import InProcessCoordination
+from components.message_handler import MessageHandler
+from tests.fakes import FakeChatBotClientBuilder, wait_until
+
+
+class FailingHandler(MessageHandler):
+    def __init__(self):
+        super().__init__(FakeChatBotClientBuilder(), worker_threads=1, coordination=InProcessCoordination())
+        self.processed = []
+
+    async def warm_up(self, chatbot_client) -> None:
+        pass
+
+    async def process_request(self, request, chatbot_client) -> None:
+        self.processed.append(request.parameters["content"])
+        if request.parameters["content"] == "fail":
+            raise RuntimeError("unexpected")
+
+
+def test_worker_survives_a_failed_request():
+    handler = FailingHandler()
+    handler.start_workers()
+    try:
+        handler.add_new_request_to_queue("user1", {"content": "fail"})
+        assert wait_until(lambda: len(handler.processed) == 1 and handler.busy_workers == 0)
+        assert handler.processing == {}
+        assert handler.coordination.in_flight("user1") is None
+
+        handler.add_new_request_to_queue("user1", {"content": "next"})
+        assert wait_until(lambda: handler.processed == ["fail", "next"])
+        assert handler.alive_workers == 1
+    finally:
+        handler.stop_workers(drain_timeout=1)
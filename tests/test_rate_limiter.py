@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from components.ai_side import rate_limiter
+from components.ai_side.rate_limiter import RateLimitedException, RateLimiter, TokenBucket, _parse_reset_seconds
+from tests.fakes import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def test_bucket_refills_continuously_up_to_its_capacity():
+    bucket = TokenBucket(60, 1.0)
+    bucket.updated_at = 0.0
+    bucket.consume(60, 0.0)
+
+    assert bucket.wait_time(10, 0.0) == 10.0
+    assert bucket.wait_time(10, 5.0) == 5.0
+    assert bucket.wait_time(10, 1000.0) == 0.0
+    assert bucket.level == 60
+
+
+def test_bucket_debt_is_paid_back_before_the_next_request():
+    bucket = TokenBucket(60, 1.0)
+    bucket.updated_at = 0.0
+    bucket.consume(80, 0.0)  # the actual usage exceeded the estimate
+
+    assert bucket.level == -20
+    assert bucket.wait_time(10, 0.0) == 30.0
+    # a request larger than the bucket only waits for a full bucket
+    assert bucket.wait_time(100, 0.0) == 80.0
+
+
+def test_acquire_waits_for_the_budget(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+    for _ in range(60):
+        limiter.acquire(10, max_wait=0)
+    started_at = clock.now
+
+    limiter.acquire(10, max_wait=5)
+    assert clock.now - started_at == pytest.approx(1.0)
+    with pytest.raises(RateLimitedException):
+        limiter.acquire(10, max_wait=0.5)
+
+
+def test_acquire_waits_for_the_tokens_of_the_prompt(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.acquire(600, max_wait=0)
+    limiter.reconcile(estimated_tokens=600, actual_tokens=700)
+
+    with pytest.raises(RateLimitedException):
+        limiter.acquire(100, max_wait=15)
+    assert limiter.wait_time(100) == pytest.approx(20.0)
+
+
+def test_headers_correct_the_buckets(clock):
+    limiter = RateLimiter(requests_per_minute=60)
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "120", "x-ratelimit-remaining-requests": "0",
+                                 "anthropic-ratelimit-tokens-limit": "6000",
+                                 "anthropic-ratelimit-tokens-remaining": "100"})
+
+    assert limiter.requests.capacity == 120 and limiter.requests.refill_per_second == 2.0
+    assert limiter.wait_time(1) == pytest.approx(0.5)
+    assert limiter.tokens.capacity == 6000
+    assert limiter.wait_time(300) == pytest.approx(2.0)  # 200 tokens at 100 per second
+
+
+def test_rate_limited_response_blocks_the_key(clock):
+    limiter = RateLimiter()
+    limiter.update_from_headers({"retry-after": "7"}, status_code=429)
+    assert limiter.wait_time(1) == 7.0
+
+    limiter = RateLimiter()
+    limiter.update_from_headers({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0s"},
+                                status_code=429)
+    assert limiter.wait_time(1) == 360.0
+
+    clock.advance(360)
+    assert limiter.wait_time(1) == 0.0
+
+
+@pytest.mark.parametrize("value, seconds", [("20", 20.0), ("1.5", 1.5), ("20ms", 0.02), ("6m0s", 360.0),
+                                            ("1h2m3s", 3723.0)])
+def test_reset_durations(value, seconds):
+    assert _parse_reset_seconds(value) == pytest.approx(seconds)
+
+
+@pytest.mark.parametrize("value", ["soon", "", None])
+def test_unknown_reset_values(value):
+    assert _parse_reset_seconds(value) is None
+
+
+def test_reset_timestamp():
+    reset_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 30))
+    assert 28 <= _parse_reset_seconds(reset_at) <= 30
@@ -0,0 +1,51 @@
+import json
+import time
+
+from components.ai_side.chatbot_client import ChatMessage
+from components.ai_side.recording import RecordingChatBotClient
+from tests.fakes import FakeChatBotClient, SteadyStream
+
+
+class SteadyChatBotClient(FakeChatBotClient):
+    def _create_completions(self, target, messages, system=None, cancellation_token=None):
+        stream = SteadyStream(chunks=4, interval=0.1)
+        self.streams.append(stream)
+        return stream.bind(cancellation_token), stream.token_usage
+
+
+def _records(path):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_gaps_are_the_ones_of_the_chatbot_server_with_a_slow_consumer(tmp_path):
+    path = str(tmp_path / "recordings.jsonl")
+    client = RecordingChatBotClient(SteadyChatBotClient("key", model_name="fake-model", enable_streaming=True), path)
+
+    reply, _ = client.completions([ChatMessage(content="Hello", role="user")])
+    answer = ""
+    for chunk in reply:
+        answer += chunk
+        time.sleep(0.3)  # sending the chunk to DingTalk
+
+    record = _records(path)[0]
+    assert answer == "chunk " * 4
+    assert record["chunks"] == ["chunk "] * 4 and record["error"] is None
+    assert 80 <= record["gaps"][0] <= 200
+    # chunks waiting for the consumer keep their arrival times, neither ~0 (pulled together) nor ~300 (pull pace)
+    assert all(80 <= gap <= 200 for gap in record["gaps"][1:]), record["gaps"]
+    assert record["tail"] < 50
+
+
+def test_abandoned_reply_is_recorded_and_cancelled(tmp_path):
+    path = str(tmp_path / "recordings.jsonl")
+    chatbot_client = SteadyChatBotClient("key", model_name="fake-model", enable_streaming=True)
+    client = RecordingChatBotClient(chatbot_client, path)
+
+    reply, _ = client.completions([ChatMessage(content="Hello", role="user")])
+    next(iter(reply))
+    reply.close()
+
+    record = _records(path)[0]
+    assert record["error"] == "abandoned" and record["chunks"] == ["chunk "]
+    assert chatbot_client.streams[0].closed.is_set()
@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+from components.coordination import InProcessCoordination
+from components.message_handler import MessageHandler
+from components.request_journal import RequestJournal, RequestState
+from tests.fakes import FakeChatBotClientBuilder
+
+
+class ReplayingHandler(MessageHandler):
+    """
+    Replays the journal without workers, the queued requests stay in the queue.
+    """
+
+    def __init__(self, journal: RequestJournal):
+        super().__init__(FakeChatBotClientBuilder(), worker_threads=1, journal=journal,
+                         coordination=InProcessCoordination())
+
+    def can_replay(self, parameters: dict) -> bool:
+        return not parameters.get("expired", False)
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "request_journal.db")
+
+
+def _states(path: str) -> dict:
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT request_id, state FROM request_journal").fetchall())
+    finally:
+        connection.close()
+
+
+def test_unfinished_requests_survive_a_restart(journal_path):
+    journal = RequestJournal(journal_path)
+    journal.append("r1", "user1", {"content": "first"}).result(5)
+    journal.append("r2", "user2", {"content": "second"}).result(5)
+    journal.append("r3", "user3", {"content": "third"}).result(5)
+    journal.update("r2", RequestState.PROCESSING).result(5)
+    journal.update("r3", RequestState.DONE).result(5)
+    journal.close()
+
+    unfinished = RequestJournal(journal_path).unfinished()
+    assert [(request.request_id, request.state, request.attempts) for request in unfinished] == [
+        ("r1", RequestState.QUEUED, 0), ("r2", RequestState.PROCESSING, 1)]
+    assert unfinished[0].parameters == {"content": "first"}
+
+
+def test_replay_queues_the_unfinished_requests_again(journal_path):
+    journal = RequestJournal(journal_path)
+    journal.append("r1", "user1", {"content": "first"})
+    journal.append("crashing", "user2", {"content": "crashes the process"})
+    for _ in range(MessageHandler.MAX_REPLAYS + 1):
+        journal.update("crashing", RequestState.PROCESSING)
+    journal.append("expired", "user3", {"content": "too late", "expired": True})
+    journal.close()
+
+    journal = RequestJournal(journal_path)
+    handler = ReplayingHandler(journal)
+    handler._replay_journal()
+    journal.close()
+
+    replayed = handler.coordination.get(0.1)
+    assert (replayed.request_id, replayed.unique_identifier, replayed.parameters) == ("r1", "user1",
+                                                                                       {"content": "first"})
+    assert handler.coordination.get(0.1) is None
+    assert _states(journal_path) == {"r1": "queued", "crashing": "failed", "expired": "expired"}
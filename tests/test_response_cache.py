@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from components.ai_side.chatbot_client import CancellationToken, ChatMessage, CompletionCancelledException, \
+    TokenUsage
+from components.response_cache import ResponseCache
+
+MESSAGES = [ChatMessage(content="Hello", role="user")]
+
+
+class GatedChatBotClient:
+    """
+    Sends the request when the gate opens, as a chatbot server slow to answer.
+    """
+
+    chat_model_name = "fake-model"
+    preset_system_prompt = None
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.sent = threading.Event()
+        self.requests = 0
+
+    def completions(self, messages, system=None, cancellation_token=None):
+        self.requests += 1
+        self.sent.set()
+        self.gate.wait(5)
+        return iter(["Hel", "lo"]), TokenUsage(input_tokens=3, output_tokens=2, image_tokens=0)
+
+
+def _answer_in_thread(cache, client, cancellation_token=None):
+    result = {}
+
+    def answer():
+        try:
+            reply, _, shared = cache.completions(client, MESSAGES, cancellation_token)
+            result["answer"], result["shared"] = "".join(reply), shared
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    return thread, result
+
+
+def test_identical_requests_share_one_reply():
+    cache, client = ResponseCache(ttl=60), GatedChatBotClient()
+    leader, leader_result = _answer_in_thread(cache, client)
+    assert client.sent.wait(5)
+    follower, follower_result = _answer_in_thread(cache, client)
+    time.sleep(0.1)
+
+    client.gate.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert leader_result == {"answer": "Hello", "shared": False}
+    assert follower_result == {"answer": "Hello", "shared": True}
+    reply, _, cached = cache.completions(client, MESSAGES)
+    assert ("".join(reply), cached) == ("Hello", True)
+    assert client.requests == 1
+    assert cache.stats()["shared"] == 1 and cache.stats()["hits"] == 1
+
+
+def test_follower_cancelled_while_the_request_is_sent():
+    cache, client = ResponseCache(ttl=60), GatedChatBotClient()
+    leader, leader_result = _answer_in_thread(cache, client)
+    assert client.sent.wait(5)
+    token = CancellationToken()
+    follower, follower_result = _answer_in_thread(cache, client, token)
+    time.sleep(0.1)
+
+    token.cancel("new message")
+    follower.join(0.2)  # not left waiting for the reply of the chatbot server
+    assert not follower.is_alive()
+    with pytest.raises(CompletionCancelledException):
+        raise follower_result["error"]
+
+    client.gate.set()
+    leader.join(5)
+    assert leader_result == {"answer": "Hello", "shared": False}
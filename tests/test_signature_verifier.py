@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import hmac
+import time
+
+import pytest
+
+from components.im_side.signature_verifier import SignatureVerifier
+
+APP_KEYS = "dingapp1,dingapp2,dingapp3"
+SECRETS = "secret1,secret2,secret3"
+
+
+def _sign(secret: str, timestamp: str) -> str:
+    mac = hmac.new(secret.encode('utf-8'), (timestamp + "\n" + secret).encode('utf-8'), digestmod=hashlib.sha256)
+    return base64.b64encode(mac.digest()).decode('utf-8')
+
+
+def _now(offset: float = 0.0) -> str:
+    return str(int((time.time() + offset) * 1000))
+
+
+@pytest.fixture
+def verifier():
+    return SignatureVerifier(APP_KEYS, SECRETS, max_age=60)
+
+
+@pytest.mark.parametrize("offset", [-120, 120])
+def test_timestamp_out_of_the_window_is_rejected(verifier, offset):
+    timestamp = _now(offset)
+    with pytest.raises(SystemError, match="window"):
+        verifier.check_headers(timestamp, _sign("secret2", timestamp))
+    with pytest.raises(SystemError, match="window"):
+        verifier.verify(timestamp, _sign("secret2", timestamp), "dingapp2")
+
+
+@pytest.mark.parametrize("timestamp, signature", [(None, "sign"), ("not a number", "sign"), (_now(), None)])
+def test_missing_or_invalid_headers_are_rejected(verifier, timestamp, signature):
+    with pytest.raises(SystemError):
+        verifier.check_headers(timestamp, signature)
+
+
+def test_replayed_signature_is_rejected(verifier):
+    timestamp = _now()
+    signature = _sign("secret2", timestamp)
+    verifier.check_headers(timestamp, signature)
+    assert verifier.verify(timestamp, signature, "dingapp2") == "dingapp2"
+
+    with pytest.raises(SystemError, match="replayed"):
+        verifier.check_headers(timestamp, signature)
+    with pytest.raises(SystemError, match="replayed"):
+        verifier.verify(timestamp, signature, "dingapp2")
+
+
+def test_known_hint_is_authoritative(verifier, monkeypatch):
+    timestamp = _now()
+    signed = []
+    sign = verifier._sign
+    monkeypatch.setattr(verifier, "_sign", lambda app_key, at: signed.append(app_key) or sign(app_key, at))
+
+    # signed with the secret of another app key than the robot code of the message
+    with pytest.raises(SystemError):
+        verifier.verify(timestamp, _sign("secret3", timestamp), "dingapp1")
+    assert signed == ["dingapp1"]
+
+
+@pytest.mark.parametrize("hint", [None, "unknown"])
+def test_every_secret_is_tried_without_a_known_hint(verifier, hint):
+    timestamp = _now()
+    assert verifier.verify(timestamp, _sign("secret3", timestamp), hint) == "dingapp3"
+    with pytest.raises(SystemError):
+        verifier.verify(_now(1), _sign("other", _now(1)), hint)
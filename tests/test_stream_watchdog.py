@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from components.ai_side.chatbot_client import StreamTimeoutException
+from components.ai_side.stream_watchdog import StreamDeadlines, StreamWatchdog
+from tests.fakes import SteadyStream
+
+
+def test_idle_clock_is_paused_while_the_consumer_holds_a_chunk():
+    deadlines = StreamDeadlines(first_token_timeout=1.0, idle_timeout=1.0)
+    stream = SteadyStream(chunks=3, interval=0.1)
+    next(stream)
+    started_waiting = time.monotonic()
+
+    # the consumer spent long on the chunk, the chatbot server is not idle for that
+    assert StreamWatchdog._check(stream, deadlines, started_waiting + 5.0) is None
+
+    stream.waiting_since = started_waiting
+    timeout = StreamWatchdog._check(stream, deadlines, started_waiting + 1.5)
+    assert isinstance(timeout, StreamTimeoutException) and timeout.phase == 'idle'
+
+
+def test_slow_consumer_of_a_steady_stream_is_not_aborted():
+    stream = SteadyStream(chunks=4, interval=0.05)
+    StreamDeadlines(first_token_timeout=1.0, idle_timeout=0.3).watch(stream)
+
+    answer = ""
+    for chunk in stream:
+        answer += chunk
+        time.sleep(0.5)  # sending the chunk to DingTalk
+
+    assert answer == "chunk " * 4
+    assert stream.cancel_exception is None
+
+
+def test_stalled_stream_is_aborted():
+    stream = SteadyStream(chunks=4, interval=0.05, stall_at=2)
+    StreamDeadlines(first_token_timeout=1.0, idle_timeout=0.3).watch(stream)
+
+    with pytest.raises(StreamTimeoutException):
+        for _ in stream:
+            pass
+    assert stream.closed.is_set()
@@ -0,0 +1,43 @@
+import io
+import json
+import logging
+
+import pytest
+
+from components.structured_logging import log_context, setup_logging
+
+
+@pytest.fixture
+def log_output(monkeypatch):
+    """
+    Lines written by the logging set up as JSON, the handlers of the root logger are restored afterwards.
+    """
+    monkeypatch.setenv("LOG_FORMAT", "json")
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    stream = io.StringIO()
+    listener = setup_logging(stream)
+
+    def lines() -> list:
+        listener.stop()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    yield lines
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_exception_is_a_field_of_the_json_line(log_output):
+    try:
+        raise ValueError("bad value")
+    except ValueError:
+        with log_context(trace_id="trace-1"):
+            logging.exception("Failed to handle %s", "the message")
+
+    entry = log_output()[0]
+    assert entry["message"] == "Failed to handle the message"
+    assert entry["trace_id"] == "trace-1"
+    assert entry["exception"].startswith("Traceback") and "ValueError: bad value" in entry["exception"]
@@ -0,0 +1,69 @@
+import pytest
+
+from components import worker_autoscaler
+from components.worker_autoscaler import WorkerAutoscaler
+from tests.fakes import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(worker_autoscaler, "time", clock)
+    return clock
+
+
+def _observe(autoscaler: WorkerAutoscaler, clock: FakeClock, arrivals: int, processing_time: float) -> None:
+    for _ in range(arrivals):
+        autoscaler.observe_enqueued()
+    autoscaler.observe_processed(processing_time)
+    clock.advance(1)
+
+
+def test_scales_up_to_the_load_with_headroom(clock):
+    autoscaler = WorkerAutoscaler(1, 10)
+    _observe(autoscaler, clock, arrivals=10, processing_time=0.3)
+
+    # 10 requests/s of 0.3 s is 3 busy workers, 4 at 75% utilization
+    assert autoscaler.desired_workers(current=1, busy=1, queue_depth=0) == 4
+
+
+def test_waiting_requests_scale_up_at_once_within_the_maximum(clock):
+    autoscaler = WorkerAutoscaler(1, 6)
+    assert autoscaler.desired_workers(current=2, busy=2, queue_depth=3) == 5
+    clock.advance(WorkerAutoscaler.SCALE_UP_COOLDOWN)
+    assert autoscaler.desired_workers(current=5, busy=5, queue_depth=3) == 6
+
+
+def test_scale_up_cooldown(clock):
+    autoscaler = WorkerAutoscaler(1, 10)
+    assert autoscaler.desired_workers(current=1, busy=1, queue_depth=2) == 3
+
+    clock.advance(1)
+    assert autoscaler.desired_workers(current=3, busy=3, queue_depth=2) == 3
+    clock.advance(WorkerAutoscaler.SCALE_UP_COOLDOWN)
+    assert autoscaler.desired_workers(current=3, busy=3, queue_depth=2) == 5
+
+
+def test_scales_down_one_worker_at_a_time_once_the_need_stays_low(clock):
+    autoscaler = WorkerAutoscaler(1, 10)
+    autoscaler._changed_at = clock.now  # just scaled up
+
+    assert autoscaler.desired_workers(current=4, busy=0, queue_depth=0) == 4
+    clock.advance(WorkerAutoscaler.SCALE_DOWN_DELAY)
+    assert autoscaler.desired_workers(current=4, busy=0, queue_depth=0) == 4  # cooldown since the scale up
+    clock.advance(WorkerAutoscaler.SCALE_DOWN_COOLDOWN - WorkerAutoscaler.SCALE_DOWN_DELAY)
+    assert autoscaler.desired_workers(current=4, busy=0, queue_depth=0) == 3
+
+    clock.advance(WorkerAutoscaler.SCALE_DOWN_DELAY)
+    assert autoscaler.desired_workers(current=3, busy=0, queue_depth=0) == 3
+    clock.advance(WorkerAutoscaler.SCALE_DOWN_COOLDOWN)
+    assert autoscaler.desired_workers(current=3, busy=0, queue_depth=0) == 2
+
+
+def test_busy_pool_does_not_shrink(clock):
+    autoscaler = WorkerAutoscaler(1, 10)
+    for _ in range(3):
+        clock.advance(WorkerAutoscaler.SCALE_DOWN_COOLDOWN)
+        # half the workers busy, above the scale down utilization
+        assert autoscaler.desired_workers(current=4, busy=2, queue_depth=0) == 4
+    assert autoscaler.desired_workers(current=4, busy=1, queue_depth=0) == 4  # low only since now